@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 """
 Collection of Python tools to parse common forms of string output
+
+Parser submodules (e.g., hpcparse.ior) are only imported the first time they
+are accessed so that importing this package is essentially free.
 """
 
-import ior
+import sys
+
+_SUBMODULES = ('ior', 'cache', 'benchmark')
 
 FS_MAP = {
     "scratch1": "edison_snx11025",
@@ -12,4 +17,19 @@ FS_MAP = {
     "cscratch": "cori_snx11168",
 }
 
-FS_MAP_REV = {val: key for key, val in FS_MAP.iteritems()}
+FS_MAP_REV = {val: key for key, val in FS_MAP.items()}
+
+def __getattr__(name):
+    """Import parser submodules on first access (PEP 562)
+    """
+    if name in _SUBMODULES:
+        import importlib
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_SUBMODULES))
+
+### module-level __getattr__ is not supported before Python 3.7
+if sys.version_info < (3, 7):
+    from . import ior
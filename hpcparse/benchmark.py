@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for the hpcparse parsers
+
+Generates synthetic IOR output and reports how many lines per second
+hpcparse.ior can parse, and measures how long it takes a fresh interpreter to
+import hpcparse.  Run as
+
+    python -m hpcparse.benchmark [--runs N] [--repeat N] [--imports N]
+"""
+import os
+import sys
+import time
+import subprocess
+import random
+import argparse
+import hpcparse.ior
+
+_IOR_RUN_TEMPLATE = """IOR-2.10.3: MPI Coordinated Test of Parallel I/O
+
+Run began: Mon Feb 13 10:%(minute)02d:00 2017
+Command line used: /usr/bin/ior -a POSIX -F -C -e -g -b %(blocksize_gib)dg -t 1m -o /scratch2/fbench/ior/file
+Machine: Linux nid%(nid)05d
+
+Summary:
+	api                = POSIX
+	test filename      = /scratch2/fbench/ior/file
+	access             = file-per-process
+	pattern            = segmented (1 segment)
+	ordering in a file = sequential offsets
+	ordering inter file=constant task offsets = 1
+	clients            = %(clients)d (%(ppn)d per node)
+	repetitions        = 1
+	xfersize           = 1 MiB
+	blocksize          = %(blocksize_gib)d GiB
+	aggregate filesize = %(aggregate_gib)d GiB
+
+Path: /scratch2/fbench/ior
+FS: 7270.4 TiB   Used FS: %(used_pct).1f%%   Inodes: 150.0 Mi   Used Inodes: 12.5%%
+
+access    bw(MiB/s)  block(KiB) xfer(KiB)  open(s)    wr/rd(s)   close(s)   total(s)   iter
+------    ---------  ---------- ---------  --------   --------   --------   --------   ----
+write     %(write_mibs)-10.2f 1048576    1024.00    0.010000   5.30       0.001000   5.31       0
+read      %(read_mibs)-10.2f 1048576    1024.00    0.010000   2.79       0.001000   2.79       0
+
+Max Write: %(write_mibs).2f MiB/sec
+Max Read:  %(read_mibs).2f MiB/sec
+
+Summary of all tests:
+Operation  Max (MiB)  Min (MiB)  Mean (MiB)   Std Dev  Mean (s)  Op grep #Tasks tPN reps  fPP reord reordoff reordrand seed segcnt blksiz xsize aggsize API RefNum
+write      %(write_mibs).2f %(write_mibs).2f %(write_mibs).2f 0.00 5.30852 0 %(clients)d %(ppn)d 1 1 1 1 0 0 1 %(blocksize)d 1048576 %(aggregate)d POSIX 0
+read       %(read_mibs).2f %(read_mibs).2f %(read_mibs).2f 0.00 2.79384 0 %(clients)d %(ppn)d 1 1 1 1 0 0 1 %(blocksize)d 1048576 %(aggregate)d POSIX 0
+
+Finished: Mon Feb 13 10:%(minute)02d:09 2017
+Run finished: Mon Feb 13 10:%(minute)02d:09 2017
+"""
+
+def synthetic_ior_output(num_runs, seed=0):
+    """Generate the lines of num_runs concatenated synthetic IOR outputs
+
+    Args:
+        num_runs (int): number of IOR runs to generate
+        seed: seed for the random number generator
+
+    Returns:
+        list: lines of IOR output, each terminated by a newline
+    """
+    rng = random.Random(seed)
+    lines = []
+    for run in range(num_runs):
+        ppn = rng.choice([1, 2, 4, 8, 16, 32])
+        nodes = rng.choice([1, 2, 4, 8, 16, 32, 64])
+        blocksize_gib = rng.choice([1, 2, 4])
+        run_output = _IOR_RUN_TEMPLATE % {
+            'minute': run % 60,
+            'nid': rng.randint(0, 99999),
+            'clients': nodes * ppn,
+            'ppn': ppn,
+            'blocksize_gib': blocksize_gib,
+            'blocksize': blocksize_gib * 2**30,
+            'aggregate_gib': blocksize_gib * nodes * ppn,
+            'aggregate': blocksize_gib * nodes * ppn * 2**30,
+            'used_pct': rng.uniform(0.0, 100.0),
+            'write_mibs': rng.uniform(100.0, 100000.0),
+            'read_mibs': rng.uniform(100.0, 100000.0),
+        }
+        lines.extend(run_output.splitlines(True))
+    return lines
+
+def benchmark_ior(num_runs, repeat):
+    """Time hpcparse.ior.iter_runs on synthetic IOR output
+
+    Args:
+        num_runs (int): number of concatenated IOR runs to parse per trial
+        repeat (int): number of trials
+
+    Returns:
+        dict: number of lines parsed per trial and the best lines/sec
+    """
+    lines = synthetic_ior_output(num_runs)
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        parsed = sum(1 for _ in hpcparse.ior.iter_runs(lines))
+        elapsed = time.time() - t0
+        if parsed != num_runs:
+            raise Exception("parsed %d runs but expected %d" % (parsed, num_runs))
+        if best is None or elapsed < best:
+            best = elapsed
+    return {
+        'lines': len(lines),
+        'runs': num_runs,
+        'seconds': best,
+        'lines_per_sec': len(lines) / best,
+    }
+
+def _time_interpreter(statement, env):
+    """Return the wall time of running statement in a fresh interpreter
+    """
+    t0 = time.time()
+    subprocess.check_call([sys.executable, '-c', statement], env=env)
+    return time.time() - t0
+
+def benchmark_import(repeat):
+    """Time how long importing hpcparse adds to interpreter startup
+
+    Args:
+        repeat (int): number of fresh interpreters to launch per statement
+
+    Returns:
+        dict: best wall seconds of a bare interpreter and the extra seconds
+        needed to import hpcparse and hpcparse.ior
+    """
+    env = os.environ.copy()
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_parent] + [x for x in [env.get('PYTHONPATH')] if x])
+
+    statements = {
+        'baseline': 'pass',
+        'hpcparse': 'import hpcparse',
+        'hpcparse.ior': 'import hpcparse.ior',
+    }
+    best = {}
+    for _ in range(repeat):
+        for key, statement in statements.items():
+            elapsed = _time_interpreter(statement, env)
+            if key not in best or elapsed < best[key]:
+                best[key] = elapsed
+    return {
+        'baseline': best['baseline'],
+        'hpcparse': best['hpcparse'] - best['baseline'],
+        'hpcparse.ior': best['hpcparse.ior'] - best['baseline'],
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark hpcparse parsers')
+    parser.add_argument('--runs', type=int, default=2000, help='number of synthetic IOR runs to parse')
+    parser.add_argument('--repeat', type=int, default=5, help='number of trials; the fastest is reported')
+    parser.add_argument('--imports', type=int, default=10, help='number of fresh interpreters used to time imports; 0 to skip')
+    args = parser.parse_args(argv)
+
+    result = benchmark_ior(args.runs, args.repeat)
+    sys.stdout.write("hpcparse.ior: %(runs)d runs, %(lines)d lines in %(seconds).3f sec (%(lines_per_sec).0f lines/sec)\n" % result)
+
+    if args.imports > 0:
+        result = benchmark_import(args.imports)
+        sys.stdout.write("interpreter startup: %.1f ms\n" % (result['baseline'] * 1000.0))
+        sys.stdout.write("import hpcparse: +%.1f ms\n" % (result['hpcparse'] * 1000.0))
+        sys.stdout.write("import hpcparse.ior: +%.1f ms\n" % (result['hpcparse.ior'] * 1000.0))
+
+if __name__ == '__main__':
+    main()
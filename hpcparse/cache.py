@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""Persistent on-disk cache of parsed results
+
+Parsed results are keyed by the real path, size and modification time of the
+file they came from and are stored as zlib-compressed pickles, one file per
+entry, in a cache directory.  The total size of the cache directory is bounded
+by evicting the least recently used entries.
+
+The cache is off by default.  It is turned on for every parser in hpcparse
+either by calling enable() or by setting the HPCPARSE_CACHE_DIR (and,
+optionally, HPCPARSE_CACHE_MAX_BYTES) environment variables.
+"""
+import os
+import sys
+
+DEFAULT_MAX_BYTES = 256 * 2**20
+
+### fraction of max_bytes to shrink the cache to when evicting
+_EVICT_TARGET = 0.9
+
+_SUFFIX = ".pkz"
+
+_ACTIVE_CACHE = None
+_ENV_CHECKED = False
+
+def _import_pickle():
+    """Import the serialization modules only once the cache is actually used
+    """
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+    import zlib
+    return pickle, zlib
+
+class ParseCache(object):
+    """Directory of cached parse results with LRU size-bounded eviction
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._total_bytes = None
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _entry_path(self, filename, tag):
+        """Return the cache entry path for a source file and parser tag
+        """
+        import hashlib
+        stat = os.stat(filename)
+        key = "\0".join([
+            os.path.realpath(filename),
+            str(stat.st_size),
+            repr(stat.st_mtime),
+            tag,
+            str(sys.version_info[0]),
+        ])
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest() + _SUFFIX)
+
+    def _entries(self):
+        """Return (mtime, size, path) for every entry in the cache directory
+        """
+        entries = []
+        for entry in os.listdir(self.cache_dir):
+            if not entry.endswith(_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, entry)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get(self, filename, tag):
+        """Retrieve the cached result of parsing a file
+
+        Args:
+            filename (str): path to the file that was parsed
+            tag (str): name of the parser that produced the result
+
+        Returns:
+            The cached object, or None if it is not in the cache
+        """
+        pickle, zlib = _import_pickle()
+        try:
+            path = self._entry_path(filename, tag)
+            with open(path, 'rb') as fp:
+                value = pickle.loads(zlib.decompress(fp.read()))
+        except (IOError, OSError):
+            return None
+        except Exception:
+            ### corrupt or incompatible entry; drop it and reparse
+            self._remove(path)
+            return None
+
+        ### mark this entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, filename, tag, value):
+        """Store the result of parsing a file
+
+        Args:
+            filename (str): path to the file that was parsed
+            tag (str): name of the parser that produced the result
+            value: picklable parse result
+        """
+        import tempfile
+        pickle, zlib = _import_pickle()
+        try:
+            path = self._entry_path(filename, tag)
+        except OSError:
+            return
+        blob = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+        ### size of the entry being overwritten, if any
+        try:
+            old_bytes = os.stat(path).st_size
+        except OSError:
+            old_bytes = 0
+
+        ### write to a temporary file and rename so concurrent readers never
+        ### see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(blob)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            self._remove(temp_path)
+            return
+
+        if self._total_bytes is None:
+            self._total_bytes = sum(x[1] for x in self._entries())
+        else:
+            self._total_bytes += len(blob) - old_bytes
+        if self._total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits
+        """
+        entries = sorted(self._entries())
+        total_bytes = sum(x[1] for x in entries)
+        target_bytes = self.max_bytes * _EVICT_TARGET
+        for _, size, path in entries:
+            if total_bytes <= target_bytes:
+                break
+            if self._remove(path):
+                total_bytes -= size
+        self._total_bytes = total_bytes
+
+    def clear(self):
+        """Remove every entry from the cache
+        """
+        for _, _, path in self._entries():
+            self._remove(path)
+        self._total_bytes = 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            return False
+        return True
+
+def enable(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    """Turn on caching of parse results for all hpcparse parsers
+
+    Args:
+        cache_dir (str): directory in which cached results are kept
+        max_bytes (int): maximum total size of cached results
+
+    Returns:
+        ParseCache: the newly active cache
+    """
+    global _ACTIVE_CACHE, _ENV_CHECKED
+    _ACTIVE_CACHE = ParseCache(cache_dir, max_bytes)
+    _ENV_CHECKED = True
+    return _ACTIVE_CACHE
+
+def disable():
+    """Turn off caching of parse results
+    """
+    global _ACTIVE_CACHE, _ENV_CHECKED
+    _ACTIVE_CACHE = None
+    _ENV_CHECKED = True
+
+def get_cache():
+    """Return the active ParseCache, or None if caching is off
+    """
+    global _ENV_CHECKED
+    if not _ENV_CHECKED:
+        _ENV_CHECKED = True
+        cache_dir = os.environ.get('HPCPARSE_CACHE_DIR')
+        if cache_dir:
+            enable(cache_dir,
+                   int(os.environ.get('HPCPARSE_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)))
+    return _ACTIVE_CACHE
+
+def cacheable_file(fileobj):
+    """Return the path of a file object if its parse result may be cached
+
+    Only file objects that refer to a regular file and that have not yet been
+    read from are cacheable.
+
+    Args:
+        fileobj: an object being passed to a parser
+
+    Returns:
+        str: path to the file backing fileobj, or None if it is not cacheable
+    """
+    if get_cache() is None:
+        return None
+    try:
+        filename = fileobj.name
+        if not os.path.isfile(filename) or fileobj.tell() != 0:
+            return None
+    except (AttributeError, TypeError, ValueError, IOError, OSError):
+        return None
+    return filename
+
+def lookup(filename, tag):
+    """Retrieve a cached parse result from the active cache
+
+    Returns:
+        The cached object, or None if caching is off or there is no entry
+    """
+    cache = get_cache()
+    if cache is None:
+        return None
+    return cache.get(filename, tag)
+
+def store(filename, tag, value):
+    """Save a parse result into the active cache, if there is one
+    """
+    cache = get_cache()
+    if cache is not None:
+        cache.put(filename, tag, value)
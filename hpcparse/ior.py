@@ -1,43 +1,117 @@
 #!/usr/bin/env python
 """Parse the stdout of one or more IOR invocations
+
+Run as a script using
+
+    python -m hpcparse.ior <ior-stdout>
 """
 import sys
 import datetime
+import itertools
 import re
-import json
+from . import cache
+
+### multipliers for the units emitted by IOR's HumanReadable()
+_UNIT_MULTIPLIERS = {
+    "-": 1.0,
+    "bytes": 1.0,
+    "MiB": 2.0**20,
+    "GiB": 2.0**30,
+    "MB": 10.0**6.0,
+    "GB": 10.0**9.0,
+    "TiB": 2.0**40, # from ShowFileSystemSize()
+    "Mi": 2.0**20,
+}
+
+### prefixes of the lines that are recognized outside of the summary sections,
+### keyed by their first three characters
+_LINE_PREFIXES = {
+    'Run': ('Run began', 'Run finished'),
+    'Pat': ('Path',),
+    'FS:': ('FS:',),
+    'Max': ('Max Write:', 'Max Read:'),
+    'Sum': ('Summary:', 'Summary of all tests:'),
+}
+
+_CLIENTS_REX = re.compile(r'(\d+) \((\d+) per node')
+_PATTERN_REX = re.compile(r'(\S+)\s+\((\d+) segments')
+
+### names of the FS: line's fields and how to store them.  these conversions
+### lose precision due to the way IOR prints values
+_FS_FIELDS = {
+    'FS': ('approx_total_bytes', int),
+    'Used FS': ('approx_used_bytes_pct', float),
+    'Inodes': ('approx_total_inodes', int),
+    'Used Inodes': ('approx_used_inodes_pct', float),
+}
+
+### columns of each row in the "Summary of all tests" section
+_RUN_SUMMARY_COLUMNS = (
+    ('operation', str),
+    ('max_mibs', float),
+    ('min_mibs', float),
+    ('avg_mibs', float),
+    ('stdev_mibs', float),
+    ('mean_time', float),
+    ('test_num', int),
+    ('num_tasks', int),
+    ('ppn', int),
+    ('repetitions', int),
+    ('file-per-proc?', int),
+    ('reordertasks(-C)?', int),
+    ('reorder_off?', int),
+    ('random(-z)?', int),
+    ('random_seed', int),
+    ('segment_ct', int),
+    ('block_size', int),
+    ('transfer_size', int),
+    ('aggregate_size', int),
+    ('api', str),
+    ('ref_num', int),
+)
+_RUN_SUMMARY_KEYS = [x[0] for x in _RUN_SUMMARY_COLUMNS]
+_RUN_SUMMARY_TYPES = [x[1] for x in _RUN_SUMMARY_COLUMNS]
 
 def un_human_readable(value_str):
     """
     Takes the output of IOR's HumanReadable() and converts it back to a byte
     value
     """
-    args = value_str.strip().split()
+    args = value_str.split()
     if len(args) == 1 and args[0].endswith("%"):
         return float(args[0].rstrip("%"))
     elif len(args) != 2:
         raise Exception("Invalid input string[%s]" % value_str)
 
-    value = float(args[0])
-    unit = args[1]
-    if unit == "-":
-        mult = 1.0
-    elif unit == "bytes":
-        mult = 1.0
-    elif unit == "MiB":
-        mult = 2.0**20
-    elif unit == "GiB":
-        mult = 2.0**30
-    elif unit == "MB":
-        mult = 10.0**6.0
-    elif unit == "GB":
-        mult = 10.0**9.0
-    elif unit == "TiB": # from ShowFileSystemSize()
-        mult = 2.0**40
-    elif unit == "Mi":
-        mult = 2.0**20
-    else:
+    try:
+        mult = _UNIT_MULTIPLIERS[args[1]]
+    except KeyError:
         raise Exception("Unknown value_str " + value_str)
-    return value * mult
+    return float(args[0]) * mult
+
+def _parse_clients(input_summary, val):
+    rex_match = _CLIENTS_REX.match(val)
+    if rex_match is None:
+        return val
+    input_summary['ppn'] = int(rex_match.group(2))
+    return int(rex_match.group(1))
+
+def _parse_pattern(input_summary, val):
+    rex_match = _PATTERN_REX.match(val)
+    if rex_match is None:
+        return val
+    input_summary['segments'] = int(rex_match.group(2))
+    return rex_match.group(1)
+
+### input summary keys whose values are converted; all others remain strings
+_INPUT_SUMMARY_CONVERTERS = {
+    'clients': _parse_clients,
+    'pattern': _parse_pattern,
+    'repetitions': lambda input_summary, val: int(val),
+    'xfersize': lambda input_summary, val: un_human_readable(val),
+    'blocksize': lambda input_summary, val: un_human_readable(val),
+    'aggregate_filesize': lambda input_summary, val: un_human_readable(val),
+}
 
 def parse(ior_output):
     """Convert the output of IOR into 
@@ -48,113 +122,247 @@ def parse(ior_output):
 
     Returns:
         dict: Keys and values describing the results of the IOR output(s)
+
+    Reading stops after the first "Run finished" line so that parse() can be
+    called again on the same file object to get the next run.  For that
+    reason it never consults the parse cache; use iter_runs() or parse_file()
+    to benefit from it.
+    """
+    return _parse(ior_output)
+
+def _parse(ior_output):
+    """Parse lines of IOR output up to and including the first "Run finished"
     """
     data = {}
 
     section = None
     for line in ior_output:
-        if line.startswith("Run began"):
+        prefix = None
+        candidates = _LINE_PREFIXES.get(line[:3])
+        if candidates is not None:
+            for candidate in candidates:
+                if line.startswith(candidate):
+                    prefix = candidate
+                    break
+
+        if prefix == "Run began":
+            ### a previous run that never finished is superseded by this one
+            if 'start' in data:
+                data = {}
+                section = None
             data['start'] = datetime.datetime.strptime(line.split(':',1)[1].strip(), "%c")
-        elif line.startswith('Path'):
+        elif prefix == 'Path':
             data['path'] = line.split()[1]
-        elif line.startswith("Run finished"):
+        elif prefix == "Run finished":
             data['stop'] = datetime.datetime.strptime(line.split(':',1)[1].strip(), "%c")
             ### don't proceed, just in case there is another concatenated output
             ### on the same iterable
             break
-        elif line.startswith("FS:"):
+        elif prefix == "FS:":
             data['file_system'] = {}
-            for fsfield in [ x.strip() for x in line.split("  ") ]:
-                key, value = [ x.strip() for x in fsfield.split(":") ]
-                value = un_human_readable(value)
-                ### these conversions lose precision due to the way IOR prints
-                ### values
-                if fsfield.startswith('FS:'):
-                    data['file_system']['approx_total_bytes'] = long(value)
-                elif fsfield.startswith('Used FS:'):
-                    data['file_system']['approx_used_bytes_pct'] = value
-                elif fsfield.startswith('Inodes:'):
-                    data['file_system']['approx_total_inodes'] = long(value)
-                elif fsfield.startswith('Used Inodes:'):
-                    data['file_system']['approx_used_inodes_pct'] = value
-        ### parse the input parameter summary section
-        elif section is None and line.strip() == "Summary:":
-            section = 'input_summary'
-            data['input_summary'] = {}
-        elif section == 'input_summary' and line.strip() == "":
-            ### calculate the number of nodes
-            data['input_summary']['nodes'] = data['input_summary']['clients'] / data ['input_summary']['ppn']
-            section = None
+            for fsfield in line.split("  "):
+                key, value = fsfield.split(":")
+                field = _FS_FIELDS.get(key.strip())
+                if field is not None:
+                    data['file_system'][field[0]] = field[1](un_human_readable(value))
+        ### lines within the input parameter summary section
         elif section == 'input_summary':
-            key, val = line.split('=', 1)
-            key = key.strip()
-            val = val.strip()
-            key = key.replace(' ', '_')
-            if key == 'clients':
-                rex_match = re.match('(\d+) \((\d+) per node', val)
-                if rex_match is not None:
-                    val = int(rex_match.group(1))
-                    data['input_summary']['ppn'] = int(rex_match.group(2))
-            elif key == 'pattern':
-                rex_match = re.match('(\S+)\s+\((\d+) segments', val)
-                if rex_match is not None:
-                    val = rex_match.group(1)
-                    data['input_summary']['segments'] = int(rex_match.group(2))
-            elif key == 'repetitions':
-                val = int(val)
-            elif (key == 'xfersize'
-               or key == 'blocksize'
-               or key == 'aggregate_filesize'):
-                val = un_human_readable(val)
-            data['input_summary'][key] = val
-        ### run results section
-        elif section is None and line.strip() == "Summary of all tests:":
-            section = 'run_summary'
+            if not line.strip():
+                ### calculate the number of nodes
+                input_summary['nodes'] = input_summary['clients'] // input_summary['ppn']
+                section = None
+            else:
+                key, val = line.split('=', 1)
+                key = key.strip().replace(' ', '_')
+                val = val.strip()
+                converter = _INPUT_SUMMARY_CONVERTERS.get(key)
+                if converter is not None:
+                    val = converter(input_summary, val)
+                input_summary[key] = val
+        ### lines within the run results section
+        elif section == 'run_summary':
+            if not line.strip():
+                section = None
+            elif line.startswith('read') or line.startswith('write'):
+                data['run_summary'].append(dict(zip(
+                    _RUN_SUMMARY_KEYS,
+                    [convert(col) for convert, col in zip(_RUN_SUMMARY_TYPES, line.split())])))
+        elif prefix is None:
+            continue
+        elif prefix.startswith('Max'):
             if 'run_summary' not in data:
                 data['run_summary'] = []
-        elif section == 'run_summary' and line.strip() == "":
-            section = None
-        elif section == 'run_summary' and (line.startswith('read') or line.startswith('write')):
             cols = line.split()
             data['run_summary'].append({
-                'operation':    cols[0],
-                'max_mibs':     float(cols[1]),
-                'min_mibs':     float(cols[2]),
-                'avg_mibs':     float(cols[3]),
-                'stdev_mibs':   float(cols[4]),
-                'mean_time':    float(cols[5]),
-                'test_num':     int(cols[6]),
-                'num_tasks':    int(cols[7]),
-                'ppn':          int(cols[8]),
-                'repetitions':  int(cols[9]),
-                'file-per-proc?': int(cols[10]),
-                'reordertasks(-C)?': int(cols[11]),
-                'reorder_off?': int(cols[12]),
-                'random(-z)?':  int(cols[13]),
-                'random_seed':  int(cols[14]),
-                'segment_ct':   int(cols[15]),
-                'block_size':   int(cols[16]),
-                'transfer_size': int(cols[17]),
-                'aggregate_size': int(cols[18]),
-                'api': cols[19],
-                'ref_num': int(cols[20])
+                'operation': cols[1].lower().rstrip(':'),
+                'max_mibs': float(cols[2]),
             })
-        elif section is None:
-            if line.startswith('Max Write:') or line.startswith('Max Read:'):
-                if 'run_summary' not in data:
-                    data['run_summary'] = []
-                cols = line.split()
-                data['run_summary'].append({
-                    'operation': cols[1].lower().rstrip(':'),
-                    'max_mibs': float(cols[2]),
-                })
-            
+        ### start of the input parameter summary section
+        elif line.strip() == "Summary:":
+            section = 'input_summary'
+            input_summary = data['input_summary'] = {}
+        ### start of the run results section
+        elif line.strip() == "Summary of all tests:":
+            section = 'run_summary'
+            if 'run_summary' not in data:
+                data['run_summary'] = []
+
     return data
 
+def iter_runs(ior_output):
+    """Parse every concatenated IOR output contained in an iterable
+
+    Makes a single pass over ior_output and yields the result of parse() for
+    each run as soon as its "Run finished" line is consumed.  Lines preceding
+    the first "Run began" are ignored.  A trailing run that never finished is
+    still yielded, so callers should check for the 'stop' key.
+
+    If the parse cache is enabled (see hpcparse.cache) and ior_output is an
+    unread file object, the runs are looked up in the cache.  On a miss, the
+    whole file is parsed and saved to the cache before the first run is
+    yielded, so the cached runs are never ones that a caller has modified.
+
+    Args:
+        ior_output: iterable of lines (e.g., a file object) containing the
+            stdout of one or more IOR invocations
+
+    Yields:
+        dict: Keys and values describing the results of each IOR run
+    """
+    filename = cache.cacheable_file(ior_output)
+    if filename is None:
+        return _iter_runs(ior_output)
+
+    runs = cache.lookup(filename, 'ior.iter_runs')
+    if runs is None:
+        runs = list(_iter_runs(ior_output))
+        cache.store(filename, 'ior.iter_runs', runs)
+    return iter(runs)
+
+def _iter_runs(ior_output):
+    """Yield the result of _parse() for each run in an iterable of lines
+    """
+    lines = iter(ior_output)
+    for line in lines:
+        if line.startswith("Run began"):
+            yield _parse(itertools.chain((line,), lines))
+
+def flatten_runs(ior_data, filename=None):
+    """Convert the output of parse() into one flat record per run_summary row
+
+    Each record contains the fields of a single run_summary row with the run's
+    start/stop/path and input_summary fields broadcast onto it.  Fields that
+    appear in both run_summary and input_summary (e.g., ppn) keep their
+    run_summary value.  The abbreviated "Max Write:"/"Max Read:" records,
+    which only carry max_mibs, are dropped.
+
+    Args:
+        ior_data (dict): output of parse()
+        filename (str): optional name of the source file to record in each row
+
+    Returns:
+        list: dicts, one per run_summary row
+    """
+    common = {}
+    for key in 'start', 'stop', 'path':
+        if key in ior_data:
+            common[key] = ior_data[key]
+    if filename is not None:
+        common['filename'] = filename
+    common.update(ior_data.get('input_summary', {}))
+
+    rows = []
+    for run_record in ior_data.get('run_summary', []):
+        if 'avg_mibs' not in run_record:
+            continue
+        row = common.copy()
+        row.update(run_record)
+        rows.append(row)
+    return rows
+
+def parse_file(filename):
+    """Parse every IOR run in a file into flat run_summary records
+
+    Args:
+        filename (str): file containing the stdout of one or more IOR runs
+
+    Returns:
+        list: dicts as returned by flatten_runs() for every run in the file
+
+    The flattened records are saved to and looked up in the parse cache, if it
+    is enabled.
+    """
+    with open(filename, 'r') as fp:
+        cache_file = cache.cacheable_file(fp)
+        if cache_file is not None:
+            rows = cache.lookup(cache_file, 'ior.parse_file')
+            if rows is not None:
+                ### the cache is keyed by real path, so the entry may have been
+                ### stored under a symlink or relative spelling of this file
+                for row in rows:
+                    row['filename'] = filename
+                return rows
+
+        rows = []
+        for run_index, ior_data in enumerate(_iter_runs(fp)):
+            for row in flatten_runs(ior_data, filename):
+                row['run_index'] = run_index
+                rows.append(row)
+
+    if cache_file is not None:
+        cache.store(cache_file, 'ior.parse_file', rows)
+    return rows
+
+def parse_files(filenames, processes=None, chunksize=16):
+    """Parse many IOR output files in parallel
+
+    Fans parse_file() out across a process pool and concatenates the results
+    in the order of filenames.  Files are parsed serially in this process if
+    there are too few of them to fill more than one chunk, since a pool would
+    hand them all to a single worker anyway.
+
+    Args:
+        filenames (list): files containing IOR stdout
+        processes (int): number of worker processes; defaults to one per CPU.
+            If 1, files are parsed serially in this process.
+        chunksize (int): number of files to hand to a worker at once
+
+    Returns:
+        list: dicts as returned by flatten_runs() for every run in every file
+    """
+    rows = []
+    if processes == 1 or len(filenames) <= chunksize:
+        for filename in filenames:
+            rows.extend(parse_file(filename))
+        return rows
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        for file_rows in pool.imap(parse_file, filenames, chunksize):
+            rows.extend(file_rows)
+    finally:
+        pool.close()
+        pool.join()
+    return rows
+
+def to_dataframe(rows):
+    """Convert flat run_summary records into a pandas DataFrame
+
+    Args:
+        rows (list): dicts as returned by parse_files() or flatten_runs()
+
+    Returns:
+        pandas.DataFrame: one row per record and one column per field
+    """
+    import pandas
+    return pandas.DataFrame.from_records(rows)
+
 if __name__ == '__main__':
+    import json
     data = parse(open(sys.argv[1], 'r'))
     if 'start' in data:
         data['start'] = str(data['start'])
     if 'stop' in data:
         data['stop'] = str(data['stop'])
-    print json.dumps(data, indent=4, sort_keys=True)
+    print(json.dumps(data, indent=4, sort_keys=True))
@@ -2,27 +2,87 @@
 #
 # Given an h5lmt file, returns the total MiB moved as well as peak transfer rate
 #
+# With --per-timestep, instead makes a single vectorized pass over the file to
+# compute the file-system-wide bandwidth at every timestep and reports
+#
+#   fs epoch read_mib write_mib peak_read_mibs peak_write_mibs
+#      p50_read_mibs p90_read_mibs p99_read_mibs
+#      p50_write_mibs p90_write_mibs p99_write_mibs timestep_sec
+#
+# where the OST datasets are taken to be rates in bytes/sec and the timestep
+# is read from FSStepsDataSet.
+#
 
 import datetime
+import argparse
+import numpy
 import h5py
 import sys
 import os
+import ioutil
 
 ### Transposing gives per-time maxes instead of per-OST, but it is VERY slow
 _TRANSPOSE = False
 
 _BYTES_TO_MIB = 1.0 / 1024.0 / 1024.0
 
+_PERCENTILES = [ 50, 90, 99 ]
+
+def aggregate_rates(dataset, slab_bytes=ioutil.SLAB_BYTES):
+    """
+    Return the sum over all OSTs of an (OST, timestep) dataset at each
+    timestep, reading the dataset in HDF5-chunk-aligned slabs of timesteps
+    """
+    rates = numpy.zeros(dataset.shape[1])
+    for start, stop in ioutil.iter_slabs(dataset, slab_bytes):
+        rates[start:stop] = dataset[:, start:stop].sum(axis=0)
+    return rates
+
+def summarize_per_timestep(f):
+    """
+    Compute file-system-wide bytes moved and the peak and percentile aggregate
+    rates from an open h5lmt file
+    """
+    timestep = float(numpy.median(numpy.diff(f['FSStepsGroup/FSStepsDataSet'][:])))
+    result = { 'timestep': timestep }
+    for op, dataset in ('read', 'OSTReadGroup/OSTBulkReadDataSet'), \
+                       ('write', 'OSTWriteGroup/OSTBulkWriteDataSet'):
+        rates = aggregate_rates(f[dataset])
+        result[op + '_bytes'] = rates.sum() * timestep
+        result['peak_' + op + '_rate'] = rates.max()
+        result[op + '_percentiles'] = numpy.percentile(rates, _PERCENTILES)
+    return result
+
+parser = argparse.ArgumentParser(description='report the data moved through a file system from an h5lmt file')
+parser.add_argument('file', type=str, help='h5lmt file to process')
+parser.add_argument('-p', '--per-timestep', action='store_true',
+                    help='report true aggregate peak and percentile rates from per-timestep bandwidth')
+args = parser.parse_args()
+
 ### Decode some additional metadata from the file path.  This will not work
 ### outside of NERSC systems.  Assumes paths that look like
 ###     YYYY-MM_DD/filesystem.h5lmt
-filepath = os.path.abspath( sys.argv[1] )
+filepath = os.path.abspath( args.file )
 date_str, fs_str = filepath.split( os.sep )[-2:]
 date = datetime.datetime.strptime( date_str, "%Y-%m-%d" )
 fs_str = fs_str.rsplit('.', 1)[0]
 
 f = h5py.File( filepath, 'r' )
 
+if args.per_timestep:
+    result = summarize_per_timestep(f)
+    print "%s %s %.2f %.2f %.2f %.2f %s %s %.1f" % (
+        fs_str,
+        date.strftime("%s"),
+        result['read_bytes'] * _BYTES_TO_MIB,
+        result['write_bytes'] * _BYTES_TO_MIB,
+        result['peak_read_rate'] * _BYTES_TO_MIB,
+        result['peak_write_rate'] * _BYTES_TO_MIB,
+        ' '.join([ "%.2f" % (x * _BYTES_TO_MIB) for x in result['read_percentiles'] ]),
+        ' '.join([ "%.2f" % (x * _BYTES_TO_MIB) for x in result['write_percentiles'] ]),
+        result['timestep'] )
+    sys.exit(0)
+
 write_bytes = 0.0
 read_bytes = 0.0
 max_write_bytes = 0.0
@@ -2,13 +2,45 @@
 """
 Dump a lot of data out of ElasticSearch using the Python API and native
 scrolling support
+
+With --slices N, the scroll is split into N sliced scrolls that are each
+consumed by a separate worker process and written to their own series of
+bundles (cori-collectd.sXX.NNNNNNNN.json.gz).  Requires ElasticSearch 5.0 or
+newer.
+
+Completed bundles are handed to --writers background threads to be serialized
+and written while scrolling continues.  At most --queue-depth bundles wait for
+a writer; beyond that, scrolling blocks until a writer catches up.  The first
+bundle that fails to write aborts the dump.  If scrolling fails, the bundles
+already queued are still written and recorded in the manifest before the
+error is raised.
+
+--format npy or --format parquet flattens each bundle's source fields into
+typed columns (see es_columnar.py) instead of saving the raw hits.
+
+Every bundle that is successfully written is appended to a manifest
+(cori-collectd[.sXX].manifest) along with its first and last @timestamp and
+the _ids of the documents at its last timestamp.  If a dump dies, rerunning
+it with --resume restarts the scroll at the last timestamp of the last
+bundle written without gaps, skips the documents that bundle already holds,
+and continues the bundle numbering from there.  The manifest is first
+truncated to the bundles before the gap, since the ones after it are
+rewritten.
 """
 
+import os
+import sys
 import copy
 import json
 import gzip
 import datetime
 import argparse
+import threading
+import multiprocessing
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 try:
     import cPickle as pickle
@@ -23,6 +55,12 @@ MAX_DOC_BUNDLE = 50000
 
 DEFAULT_PAGE_SIZE = 10000
 
+### number of background threads that serialize bundles
+DEFAULT_WRITERS = 2
+
+### number of completed bundles that may wait for a writer thread
+DEFAULT_QUEUE_DEPTH = 2
+
 _DATE_FMT = "%Y-%m-%d %H:%M:%S"
 
 _ES_INDEX = "cori-collectd-*"
@@ -66,79 +104,367 @@ _SOURCE_FIELDS = [
 
 def serialize_bundle_json(bundle, output_file):
     """
-    save our bundled pages into gzipped json
+    save our bundled pages into gzipped json; returns the path written
     """
     t0 = datetime.datetime.now()
     with gzip.open( filename=output_file, mode='w', compresslevel=1 ) as fp:
         json.dump(bundle, fp)
     print "  Serialization took %.2f seconds" % (datetime.datetime.now() - t0).total_seconds()
+    return output_file
 
 def serialize_bundle_pickle(bundle, output_file):
     """
-    save our bundled pages into gzipped pickle
+    save our bundled pages into gzipped pickle; returns the path written
     """
     t0 = datetime.datetime.now()
-    with gzip.open( filename=output_file.replace('json', 'pickle'), mode='w', compresslevel=1 ) as fp:
+    output_file = output_file.replace('json', 'pickle')
+    with gzip.open( filename=output_file, mode='w', compresslevel=1 ) as fp:
         pickle.dump(bundle, fp, pickle.HIGHEST_PROTOCOL)
     print "  Serialization took %.2f seconds" % (datetime.datetime.now() - t0).total_seconds()
+    return output_file
 
-def query_and_page( esdb, query, index=_ES_INDEX, scroll='1m', size=DEFAULT_PAGE_SIZE, _source=_SOURCE_FIELDS, serialize_bundle=serialize_bundle_json ):
-    t_begin = datetime.datetime.now()
+class BundleWriter(object):
+    """
+    Pool of threads that serialize bundles in the background.  write() blocks
+    once queue_depth bundles are waiting so that memory use stays bounded.
+    With zero writers, bundles are serialized synchronously.
+
+    Only gzip compression, numpy and file I/O release the GIL.  Encoding the
+    hits with json or pickle is pure Python and holds it, so it does not
+    overlap with scrolling; the writers mostly hide compression and I/O.
 
-    ### Get first set of results and a scroll id
-    result = esdb.search(
-        index=index,
-        body=query,
-        scroll=scroll,
-        size=size,
-        sort='@timestamp',
-        _source=_source,
-    )
+    Once any bundle fails to write, the remaining queued bundles are dropped
+    and the next write() or close() raises IOError.
+    """
+    def __init__(self, serialize_bundle, writers=DEFAULT_WRITERS, queue_depth=DEFAULT_QUEUE_DEPTH, manifest_file=None):
+        self.serialize_bundle = serialize_bundle
+        self.manifest_file = manifest_file
+        self.lock = threading.Lock()
+        self.error = None
+        self.queue = queue.Queue(maxsize=max(1, queue_depth))
+        self.threads = []
+        for _ in range(writers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
 
-    print "Fetching first page took %.2f seconds" % (datetime.datetime.now() - t_begin).total_seconds()
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if self.error is not None:
+                ### the dump is being aborted; don't bother writing
+                continue
+            try:
+                self._write(*job)
+            except Exception as error:
+                with self.lock:
+                    if self.error is None:
+                        self.error = (job[1], error)
 
+    def _write(self, bundle, output_file, record):
+        written_file = self.serialize_bundle(bundle, output_file)
+        if self.manifest_file is not None and record is not None:
+            ### serializers may change the file name to match their format
+            if written_file is not None:
+                record['file'] = written_file
+            with self.lock:
+                with open(self.manifest_file, 'a') as fp:
+                    fp.write(json.dumps(record) + "\n")
+
+    def _check(self):
+        if self.error is not None:
+            raise IOError("failed to write %s: %s" % self.error)
+
+    def write(self, bundle, output_file, record=None):
+        """
+        Serialize a bundle, then append record to the manifest.  Raises
+        IOError if any earlier bundle failed to write.
+        """
+        self._check()
+        if self.threads:
+            self.queue.put((bundle, output_file, record))
+        else:
+            self._write(bundle, output_file, record)
+
+    def close(self):
+        """
+        Wait for all pending bundles to be written
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._check()
+
+def bundle_name( num_bundles, slice_id=None ):
+    """
+    Return the output file name of a bundle
+    """
+    if slice_id is None:
+        return "%s.%08d.json.gz" % (_ES_INDEX.replace('-*', ''), num_bundles)
+    return "%s.s%02d.%08d.json.gz" % (_ES_INDEX.replace('-*', ''), slice_id, num_bundles)
+
+def manifest_name( slice_id=None ):
+    """
+    Return the name of the manifest of completed bundles
+    """
+    if slice_id is None:
+        return "%s.manifest" % _ES_INDEX.replace('-*', '')
+    return "%s.s%02d.manifest" % (_ES_INDEX.replace('-*', ''), slice_id)
+
+def hit_time( hit ):
+    """
+    Return the @timestamp of a hit in epoch milliseconds
+    """
+    if 'sort' in hit:
+        return int(hit['sort'][0])
+    import es_columnar
+    return int(es_columnar.parse_timestamps([hit['_source']['@timestamp']])[0])
+
+def bundle_record( bundle, num_bundles, output_file ):
+    """
+    Describe a bundle for the manifest: its number, file, document count, time
+    bounds, and the _ids of all documents that share its last timestamp
+    """
+    time_end = hit_time(bundle[-1])
+    last_ids = []
+    for hit in reversed(bundle):
+        if hit_time(hit) != time_end:
+            break
+        last_ids.append(hit['_id'])
+    return {
+        'bundle': num_bundles,
+        'file': output_file,
+        'count': len(bundle),
+        'time_start': hit_time(bundle[0]),
+        'time_end': time_end,
+        'last_ids': last_ids,
+    }
+
+def load_manifest( manifest_file ):
+    """
+    Return the manifest records of the bundles that were written with no
+    missing bundles before them, in bundle order
+    """
+    if not os.path.isfile(manifest_file):
+        return []
+    records = {}
+    with open(manifest_file, 'r') as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                ### partially written last line
+                continue
+            records[record['bundle']] = record
     num_bundles = 0
-    total_retrieved = 0
-    bundled_pages = []
-    ### Keep scrolling until we have all the data
-    while len(result['hits']['hits']) > 0:
-        t_iterate = datetime.datetime.now()
-        sid = result['_scroll_id']
-
-        docs_retrieved = len(result['hits']['hits'])
-        total_retrieved += docs_retrieved
-        print "  Retrieved %d hits, %d to go (%d total)" % (docs_retrieved,
-                                                          result['hits']['total'] - total_retrieved,
-                                                          result['hits']['total'])
-
-        ### If this page will overflow the bundle, flush the bundle first
-        if (len(bundled_pages) + docs_retrieved) > MAX_DOC_BUNDLE:
-            output_file = "%s.%08d.json.gz" % (_ES_INDEX.replace('-*', ''), num_bundles)
-            serialize_bundle(bundled_pages, output_file)
-            print "  Bundled %d documents into %s" % (len(bundled_pages), output_file)
-            bundled_pages = []
-            num_bundles += 1
-
-        bundled_pages += result['hits']['hits']
-
-        ### Fetch a new page
-        t0 = datetime.datetime.now()
-        result = esdb.scroll(scroll_id=sid, scroll='1m')
-        tf = datetime.datetime.now()
-        print "  Fetching data took %.2f seconds" % (tf - t0).total_seconds()
-        print "Total cycle took %.2f seconds" % (tf - t_iterate).total_seconds()
-
-    ### flush the last bundle if it's not empty
-    if len(bundled_pages) > 0:
-        output_file = "%s.%08d.json.gz" % (_ES_INDEX.replace('-*', ''), num_bundles)
-        serialize_bundle(bundled_pages, output_file)
-        print "Bundled %d documents into %s" % (len(bundled_pages), output_file)
+    while num_bundles in records:
+        num_bundles += 1
+    return [ records[x] for x in range(num_bundles) ]
+
+def truncate_manifest( manifest_file, records ):
+    """
+    Atomically rewrite a manifest so that it holds only the given records.
+    Records of bundles written after a gap would otherwise be mistaken for
+    part of the contiguous run once new bundles fill the gap.
+    """
+    temp_file = manifest_file + ".tmp"
+    with open(temp_file, 'w') as fp:
+        for record in records:
+            fp.write(json.dumps(record) + "\n")
+    os.rename(temp_file, manifest_file)
+
+def resume_query( query, time_ms ):
+    """
+    Return a copy of query whose time range starts at the second containing
+    time_ms
+    """
+    query = copy.deepcopy(query)
+    this_node = query
+    for node_name in 'query', 'bool', 'filter', 'range', '@timestamp':
+        if node_name not in this_node:
+            this_node[node_name] = {}
+        this_node = this_node[node_name]
+    this_node['gte'] = str(time_ms // 1000)
+    this_node['format'] = "epoch_second"
+    return query
 
+def serialize_bundle_npy(bundle, output_file):
+    """
+    save our bundled pages into a directory of memory-mappable .npy columns;
+    returns the path written
+    """
+    import es_columnar
+    t0 = datetime.datetime.now()
+    output_file = output_file.replace('.json.gz', '.cols')
+    es_columnar.save_bundle_npy(bundle, output_file, _SOURCE_FIELDS)
+    print "  Serialization took %.2f seconds" % (datetime.datetime.now() - t0).total_seconds()
+    return output_file
+
+def serialize_bundle_parquet(bundle, output_file):
+    """
+    save our bundled pages into a columnar parquet file; returns the path
+    written
+    """
+    import es_columnar
+    t0 = datetime.datetime.now()
+    output_file = output_file.replace('.json.gz', '.parquet')
+    es_columnar.save_bundle_parquet(bundle, output_file, _SOURCE_FIELDS)
+    print "  Serialization took %.2f seconds" % (datetime.datetime.now() - t0).total_seconds()
+    return output_file
+
+SERIALIZERS = {
+    'json': serialize_bundle_json,
+    'pickle': serialize_bundle_pickle,
+    'npy': serialize_bundle_npy,
+    'parquet': serialize_bundle_parquet,
+}
+
+def query_and_page( esdb, query, index=_ES_INDEX, scroll='1m', size=DEFAULT_PAGE_SIZE, _source=_SOURCE_FIELDS, serialize_bundle=serialize_bundle_json, slice_id=None, max_slices=None, writers=DEFAULT_WRITERS, queue_depth=DEFAULT_QUEUE_DEPTH, resume=False ):
+    """
+    Scroll through all documents matching a query and serialize them into
+    bundles.  If slice_id and max_slices are given, only consume that slice of
+    a sliced scroll.  If resume is True, pick up after the last bundle
+    recorded in the manifest.  Returns the number of documents retrieved.
+    """
+    t_begin = datetime.datetime.now()
+
+    tag = ""
+    if slice_id is not None:
+        query = copy.deepcopy(query)
+        query['slice'] = { 'id': slice_id, 'max': max_slices }
+        tag = "[slice %d/%d] " % (slice_id, max_slices)
+
+    manifest_file = manifest_name(slice_id)
+    num_bundles = 0
+    skip_time, skip_ids = None, set()
+    records = load_manifest(manifest_file) if resume else []
+    if records:
+        truncate_manifest(manifest_file, records)
+        last_record = records[-1]
+        num_bundles = last_record['bundle'] + 1
+        skip_time, skip_ids = last_record['time_end'], set(last_record['last_ids'])
+        query = resume_query(query, skip_time)
+        print "%sResuming after bundle %d (%s)" % (tag, last_record['bundle'], last_record['file'])
+    else:
+        ### starting over; forget about bundles from any previous dump
+        open(manifest_file, 'w').close()
+    writer = BundleWriter(serialize_bundle, writers, queue_depth, manifest_file)
+
+    try:
+        ### Get first set of results and a scroll id
+        result = esdb.search(
+            index=index,
+            body=query,
+            scroll=scroll,
+            size=size,
+            sort='@timestamp',
+            _source=_source,
+        )
+
+        print "%sFetching first page took %.2f seconds" % (tag, (datetime.datetime.now() - t_begin).total_seconds())
+
+        total_retrieved = 0
+        bundled_pages = []
+        ### Keep scrolling until we have all the data
+        while len(result['hits']['hits']) > 0:
+            t_iterate = datetime.datetime.now()
+            sid = result['_scroll_id']
+
+            docs_retrieved = len(result['hits']['hits'])
+            total_retrieved += docs_retrieved
+            print "%s  Retrieved %d hits, %d to go (%d total)" % (tag,
+                                                                docs_retrieved,
+                                                                result['hits']['total'] - total_retrieved,
+                                                                result['hits']['total'])
+
+            hits = result['hits']['hits']
+            if skip_time is not None:
+                ### drop documents already written before resuming
+                hits = [ hit for hit in hits
+                         if hit_time(hit) > skip_time
+                         or (hit_time(hit) == skip_time and hit['_id'] not in skip_ids) ]
+                if hit_time(result['hits']['hits'][-1]) > skip_time:
+                    skip_time = None
+
+            ### If this page will overflow the bundle, flush the bundle first
+            if (len(bundled_pages) + len(hits)) > MAX_DOC_BUNDLE and len(bundled_pages) > 0:
+                output_file = bundle_name(num_bundles, slice_id)
+                writer.write(bundled_pages, output_file, bundle_record(bundled_pages, num_bundles, output_file))
+                print "%s  Queued %d documents for %s" % (tag, len(bundled_pages), output_file)
+                bundled_pages = []
+                num_bundles += 1
+
+            bundled_pages += hits
+
+            ### Fetch a new page
+            t0 = datetime.datetime.now()
+            result = esdb.scroll(scroll_id=sid, scroll='1m')
+            tf = datetime.datetime.now()
+            print "%s  Fetching data took %.2f seconds" % (tag, (tf - t0).total_seconds())
+            print "%sTotal cycle took %.2f seconds" % (tag, (tf - t_iterate).total_seconds())
+
+        ### flush the last bundle if it's not empty
+        if len(bundled_pages) > 0:
+            output_file = bundle_name(num_bundles, slice_id)
+            writer.write(bundled_pages, output_file, bundle_record(bundled_pages, num_bundles, output_file))
+            print "%sQueued %d documents for %s" % (tag, len(bundled_pages), output_file)
+    except BaseException:
+        ### still write the bundles that were already queued and record them
+        ### in the manifest so that --resume does not fetch them again
+        exc_info = sys.exc_info()
+        try:
+            writer.close()
+        except IOError as error:
+            sys.stderr.write("%s%s\n" % (tag, error))
+        raise exc_info[0], exc_info[1], exc_info[2]
+    writer.close()
+
+    t_wall = (datetime.datetime.now() - t_begin).total_seconds()
+    print "%sPackaged %d documents in %.2f seconds (%.2f docs/sec)" % (tag,
+                                                                       total_retrieved,
+                                                                       t_wall,
+                                                                       total_retrieved/t_wall)
+    return total_retrieved
+
+def dump_slice( job ):
+    """
+    Consume one slice of a sliced scroll in a worker process.  job is a tuple
+    of (host, port, query, slice_id, max_slices, serialize_bundle, writers,
+    queue_depth, resume).
+    """
+    host, port, query, slice_id, max_slices, serialize_bundle, writers, queue_depth, resume = job
+    esdb = elasticsearch.Elasticsearch([{
+        'host': host,
+        'port': port, }])
+    return query_and_page(esdb, query,
+                          serialize_bundle=serialize_bundle,
+                          slice_id=slice_id,
+                          max_slices=max_slices,
+                          writers=writers,
+                          queue_depth=queue_depth,
+                          resume=resume)
+
+def query_and_page_sliced( host, port, query, max_slices, serialize_bundle=serialize_bundle_json, writers=DEFAULT_WRITERS, queue_depth=DEFAULT_QUEUE_DEPTH, resume=False ):
+    """
+    Dump a query using max_slices concurrent sliced scrolls
+    """
+    t_begin = datetime.datetime.now()
+    jobs = [ (host, port, query, slice_id, max_slices, serialize_bundle, writers, queue_depth, resume) for slice_id in range(max_slices) ]
+    pool = multiprocessing.Pool(max_slices)
+    total_retrieved = sum(pool.imap_unordered(dump_slice, jobs))
+    pool.close()
+    pool.join()
     t_wall = (datetime.datetime.now() - t_begin).total_seconds()
-    print "Packaged %d documents in %.2f seconds (%.2f docs/sec)" % (total_retrieved,
-                                                                     t_wall,
-                                                                     total_retrieved/t_wall)
-                                                                     
+    print "Packaged %d documents from %d slices in %.2f seconds (%.2f docs/sec)" % (total_retrieved,
+                                                                                   max_slices,
+                                                                                   t_wall,
+                                                                                   total_retrieved/t_wall)
+    return total_retrieved
+
 if __name__ == '__main__':
     ### Parse CLI options
     parser = argparse.ArgumentParser( add_help=False)
@@ -153,9 +479,18 @@ if __name__ == '__main__':
                         help="produce debug messages")
     parser.add_argument('--pickle',
                         action='store_true',
-                        help="use pickle instead of json")
+                        help="use pickle instead of json; same as --format pickle")
+    parser.add_argument('-f', '--format',
+                        type=str,
+                        default='json',
+                        choices=sorted(SERIALIZERS.keys()),
+                        help="output format of each bundle (default: json)")
     parser.add_argument('-h', '--host', type=str, default="localhost", help="hostname of ElasticSearch endpoint")
     parser.add_argument('-p', '--port', type=int, default=9200, help="port of ElasticSearch endpoint")
+    parser.add_argument('-s', '--slices', type=int, default=1, help="number of sliced scrolls to consume concurrently")
+    parser.add_argument('-w', '--writers', type=int, default=DEFAULT_WRITERS, help="number of background bundle writer threads; 0 to write synchronously")
+    parser.add_argument('-r', '--resume', action='store_true', help="continue an interrupted dump from its manifest")
+    parser.add_argument('-q', '--queue-depth', type=int, default=DEFAULT_QUEUE_DEPTH, help="maximum number of completed bundles waiting to be written")
     args = parser.parse_args()
     if not (args.tstart and args.tstop):
         parser.print_help()
@@ -188,13 +523,28 @@ if __name__ == '__main__':
     ### Print query
     print json.dumps(query,indent=4)
 
+    if args.pickle:
+        serialize_bundle = serialize_bundle_pickle
+    else:
+        serialize_bundle = SERIALIZERS[args.format]
+
+    ### Run query across concurrent slices; each worker makes its own connection
+    if args.slices > 1:
+        query_and_page_sliced(args.host, args.port, query, args.slices,
+                              serialize_bundle=serialize_bundle,
+                              writers=args.writers,
+                              queue_depth=args.queue_depth,
+                              resume=args.resume)
+        sys.exit(0)
+
     ### Try to connect
     esdb = elasticsearch.Elasticsearch([{
         'host': args.host,
         'port': args.port, }])
 
     ### Run query
-    if args.pickle:
-        query_and_page(esdb, query, serialize_bundle=serialize_bundle_pickle)
-    else:
-        query_and_page(esdb, query)
+    query_and_page(esdb, query,
+                   serialize_bundle=serialize_bundle,
+                   writers=args.writers,
+                   queue_depth=args.queue_depth,
+                   resume=args.resume)
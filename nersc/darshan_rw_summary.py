@@ -3,7 +3,7 @@
 In the absence of quarshan, this script will tear through a summary file
 generated by the following bash/awk script based on darshan-2.x logs:
 
-    for i in *.darshan.gz; do 
+    for i in *.darshan.gz; do
         echo "BEGIN $i"
         darshan-parser $i | awk '
             /(CP_BYTES_READ|CP_BYTES_WRITTEN).*/ {
@@ -18,52 +18,425 @@ generated by the following bash/awk script based on darshan-2.x logs:
     done
 
 and print summary metrics about the read/write activity.
+
+Alternatively, with --logs, skip the bash/awk step entirely and stream
+darshan-parser's output for each Darshan log (or each log in a directory)
+across a pool of processes:
+
+    ./darshan_rw_summary.py --logs -p 32 -o rw_by_job.csv /path/to/2017/2/13
+
+The bytes read and written are then reduced by file system, user, app, and
+job, and written to a CSV (or, if the output file name ends in .parquet, a
+Parquet) file in addition to printing the usual summary.
+
+The summary ranks the top --top users, apps, and jobs by bytes read and
+written on each file system, and reports percentiles of the bytes read and
+written per user, per app, and per job.  Logs whose names do not encode a
+user, app, and jobid are left out of the rankings and percentiles and counted
+separately as unattributed bytes.  Rankings come from bounded-size
+heavy-hitter sketches and percentiles from log-bucketed histograms, both of
+which can be saved with --sketch and later combined without rescanning any
+logs:
+
+    ./darshan_rw_summary.py --merge --sketch 2017-Q1.json 2017-0[123]-*.json
+
+Reported top-K byte counts are upper bounds that are exact whenever fewer
+than --capacity distinct users, apps, or jobs were seen; percentiles are
+accurate to within about 1%.  Percentiles are computed over the totals of each
+user, app, or job within one run, so a user or job whose activity is split
+across merged sketches contributes one value per sketch.
 """
 
+import os
+import re
 import sys
+import math
 import json
+import argparse
+import subprocess
+import multiprocessing
+
+### darshan-2.x and darshan-3.x (POSIX module) counters of bytes moved
+_READ_COUNTERS = set(['CP_BYTES_READ', 'POSIX_BYTES_READ'])
+_WRITE_COUNTERS = set(['CP_BYTES_WRITTEN', 'POSIX_BYTES_WRITTEN'])
+
+### user_app_id<jobid>_<...>.darshan[.gz]
+_LOG_NAME_REX = re.compile(r'^([^_]+)_(.*)_id(\d+)_')
+
+ROW_COLUMNS = ['fs', 'user', 'app', 'jobid', 'read', 'write']
 
-data = {}
-with open(sys.argv[1], 'r') as fp:
-    for line in fp:
-        """
-        BEGIN aae109_vasp_edison_normal_id21057_5-1-78490-8167977107149723115_1.darshan.gz
-        /scratch2 103024896 57412973
-        """
-        if line.startswith('BEGIN'):
-            log_name = line.split(None,1)[1]
-            user = log_name.split('_',1)[0]
+### number of keys tracked by each heavy-hitter sketch
+TOPK_CAPACITY = 1000
+
+### ratio between the bounds of adjacent quantile sketch buckets
+QUANTILE_GAMMA = 1.02
+
+PERCENTILES = [50, 90, 99]
+
+### sketches kept for each file system, keyed by the row column they rank
+_RANKED_COLUMNS = {'users': 1, 'apps': 2, 'jobs': 3}
+
+### jobid of rows from logs whose names could not be parsed
+UNKNOWN_JOBID = -1
+
+def topk_new(capacity=TOPK_CAPACITY):
+    """
+    Return an empty heavy-hitter sketch.  counts maps each tracked key to
+    [upper bound of its weight, maximum overestimate]; floor is the largest
+    weight any untracked key could have.
+    """
+    return {'capacity': capacity, 'floor': 0, 'counts': {}}
+
+def topk_prune(state):
+    """
+    Discard all but the capacity heaviest keys of a heavy-hitter sketch
+    """
+    counts = state['counts']
+    if len(counts) <= state['capacity']:
+        return state
+    ranked = sorted(counts.items(), key=lambda x: x[1][0], reverse=True)
+    state['floor'] = max(state['floor'], ranked[state['capacity']][1][0])
+    state['counts'] = dict(ranked[:state['capacity']])
+    return state
+
+def topk_add(state, key, weight):
+    """
+    Add weight to a key of a heavy-hitter sketch.  Pruning is deferred until
+    twice capacity keys are tracked so that its cost is amortized.
+    """
+    counts = state['counts']
+    if key in counts:
+        counts[key][0] += weight
+    else:
+        counts[key] = [state['floor'] + weight, state['floor']]
+        if len(counts) > 2 * state['capacity']:
+            topk_prune(state)
+
+def topk_merge(state, other):
+    """
+    Merge heavy-hitter sketch other into state
+    """
+    counts = state['counts']
+    for key in set(counts.keys()) - set(other['counts'].keys()):
+        counts[key][0] += other['floor']
+        counts[key][1] += other['floor']
+    for key, (count, error) in other['counts'].items():
+        if key in counts:
+            counts[key][0] += count
+            counts[key][1] += error
         else:
-            fs, read, write = line.split(None)
-            read = int(read)
-            write = int(write)
+            counts[key] = [state['floor'] + count, state['floor'] + error]
+    state['floor'] += other['floor']
+    state['capacity'] = max(state['capacity'], other['capacity'])
+    return topk_prune(state)
+
+def topk_top(state, num):
+    """
+    Return the num heaviest [key, weight] pairs of a heavy-hitter sketch
+    """
+    ranked = sorted(state['counts'].items(), key=lambda x: x[1][0], reverse=True)
+    return [ [key, count] for key, (count, _) in ranked[:num] ]
 
-            if fs not in data:
-                data[fs] = { 'read': 0, 'write': 0 }
-            data[fs]['read'] += read
-            data[fs]['write'] += write
+def quantiles_new(gamma=QUANTILE_GAMMA):
+    """
+    Return an empty quantile sketch.  Positive values are counted in buckets
+    whose bounds grow geometrically by gamma; buckets are keyed by strings so
+    that the sketch is JSON-serializable.
+    """
+    return {'gamma': gamma, 'count': 0, 'zeros': 0, 'buckets': {}}
 
-            if 'user_writes' not in data[fs]:
-                data[fs]['user_writes'] = {}
-            if 'user_reads' not in data[fs]:
-                data[fs]['user_reads'] = {}
+def quantiles_add(state, value):
+    """
+    Add a nonnegative value to a quantile sketch
+    """
+    state['count'] += 1
+    if value <= 0:
+        state['zeros'] += 1
+        return
+    bucket = str(int(math.ceil(math.log(value, state['gamma']))))
+    state['buckets'][bucket] = state['buckets'].get(bucket, 0) + 1
 
-            if user not in data[fs]['user_writes']:
-                data[fs]['user_writes'][user] = 0
-            if user not in data[fs]['user_reads']:
-                data[fs]['user_reads'][user] = 0
+def quantiles_merge(state, other):
+    """
+    Merge quantile sketch other, which must use the same gamma, into state
+    """
+    if state['gamma'] != other['gamma']:
+        raise ValueError("cannot merge quantile sketches with gamma %s and %s"
+                         % (state['gamma'], other['gamma']))
+    state['count'] += other['count']
+    state['zeros'] += other['zeros']
+    for bucket, count in other['buckets'].items():
+        state['buckets'][bucket] = state['buckets'].get(bucket, 0) + count
+    return state
 
-            data[fs]['user_reads'][user] += read
-            data[fs]['user_writes'][user] += write
+def quantiles_query(state, percentile):
+    """
+    Return the approximate value at a percentile of a quantile sketch
+    """
+    if state['count'] == 0:
+        return None
+    rank = percentile / 100.0 * (state['count'] - 1)
+    seen = state['zeros']
+    if rank < seen:
+        return 0.0
+    gamma = state['gamma']
+    for bucket in sorted(int(x) for x in state['buckets'].keys()):
+        seen += state['buckets'][str(bucket)]
+        if rank < seen:
+            return 2.0 * gamma ** bucket / (gamma + 1.0)
+    return 2.0 * gamma ** bucket / (gamma + 1.0)
+
+def parse_log_name(log_name):
+    """
+    Return the (user, app, jobid) encoded in a Darshan log's file name.  The
+    jobid is UNKNOWN_JOBID if the name could not be parsed.
+    """
+    match = _LOG_NAME_REX.match(os.path.basename(log_name))
+    if match:
+        return match.group(1), match.group(2), int(match.group(3))
+    return os.path.basename(log_name).split('_', 1)[0], '', UNKNOWN_JOBID
+
+def parse_darshan_log(log_name):
+    """
+    Run darshan-parser on one log and sum the bytes read and written on each
+    mount point.  Returns (log_name, {mount point: [read, write]}, error
+    message or None).  If darshan-parser fails or its output cannot be
+    parsed, the totals are empty rather than partial.
+    """
+    totals = {}
+    try:
+        proc = subprocess.Popen(['darshan-parser', log_name],
+                                stdout=subprocess.PIPE,
+                                stderr=open(os.devnull, 'w'))
+    except OSError as error:
+        return log_name, totals, str(error)
+
+    error = None
+    try:
+        for line in proc.stdout:
+            if b'_BYTES_' not in line or line.startswith(b'#'):
+                continue
+            fields = line.rstrip(b'\n').split(b'\t')
+            ### darshan-3.x prefixes each counter with its module name
+            if not fields[0].isdigit() and not fields[0].startswith(b'-'):
+                fields = fields[1:]
+            if len(fields) < 6:
+                continue
+            counter = fields[2].decode()
+            if counter in _READ_COUNTERS:
+                column = 0
+            elif counter in _WRITE_COUNTERS:
+                column = 1
+            else:
+                continue
+            fs = fields[5].decode()
+            if fs not in totals:
+                totals[fs] = [0, 0]
+            totals[fs][column] += int(fields[3])
+    except (ValueError, UnicodeDecodeError) as parse_error:
+        error = "unparseable darshan-parser output: %s" % parse_error
+        proc.kill()
+    proc.stdout.close()
+
+    if proc.wait() != 0 and error is None:
+        error = "darshan-parser exited with code %d" % proc.returncode
+    if error is not None:
+        return log_name, {}, error
+    return log_name, totals, None
+
+def expand_logs(paths):
+    """
+    Return the Darshan logs named by a list of files and directories
+    """
+    logs = []
+    for path in paths:
+        if os.path.isdir(path):
+            logs += [ os.path.join(path, x) for x in sorted(os.listdir(path)) if '.darshan' in x ]
+        else:
+            logs.append(path)
+    return logs
+
+def reduce_logs(logs, processes):
+    """
+    Parse Darshan logs in parallel and reduce their bytes read and written by
+    file system, user, app, and job.  Logs that darshan-parser fails on
+    contribute nothing.  Returns a tuple of (list of rows whose columns are
+    ROW_COLUMNS, number of logs that failed).
+    """
+    reduced = {}
+    failures = 0
+    pool = multiprocessing.Pool(processes)
+    for log_name, totals, error in pool.imap_unordered(parse_darshan_log, logs, chunksize=16):
+        if error is not None:
+            sys.stderr.write("%s: %s\n" % (log_name, error))
+            failures += 1
+            continue
+        user, app, jobid = parse_log_name(log_name)
+        for fs, (read, write) in totals.items():
+            key = (fs, user, app, jobid)
+            if key not in reduced:
+                reduced[key] = [0, 0]
+            reduced[key][0] += read
+            reduced[key][1] += write
+    pool.close()
+    pool.join()
+    return [ list(key) + value for key, value in sorted(reduced.items()) ], failures
+
+def parse_summary_file(summary_file):
+    """
+    Convert the output of the bash/awk script into rows whose columns are
+    ROW_COLUMNS
+    """
+    rows = []
+    with open(summary_file, 'r') as fp:
+        for line in fp:
+            """
+            BEGIN aae109_vasp_edison_normal_id21057_5-1-78490-8167977107149723115_1.darshan.gz
+            /scratch2 103024896 57412973
+            """
+            if line.startswith('BEGIN'):
+                log_name = line.split(None,1)[1].strip()
+                user, app, jobid = parse_log_name(log_name)
+            else:
+                fs, read, write = line.split(None)
+                rows.append([fs, user, app, jobid, int(read), int(write)])
+    return rows
+
+def save_rows(rows, output_file):
+    """
+    Write rows to a Parquet file if output_file ends in .parquet, or to a CSV
+    file otherwise
+    """
+    if output_file.endswith('.parquet'):
+        import pandas
+        pandas.DataFrame(rows, columns=ROW_COLUMNS).to_parquet(output_file)
+        return
+    with open(output_file, 'w') as fp:
+        fp.write(','.join(ROW_COLUMNS) + '\n')
+        for row in rows:
+            fp.write("%s,%s,%s,%d,%d,%d\n" % tuple(row))
+
+def new_sketches(capacity=TOPK_CAPACITY):
+    """
+    Return the empty sketches of the read or write activity of one file system
+    """
+    sketches = {'total': 0, 'unattributed': 0, 'quantiles': {}}
+    for ranked in _RANKED_COLUMNS:
+        sketches[ranked] = topk_new(capacity)
+        sketches['quantiles'][ranked] = quantiles_new()
+    return sketches
+
+def sketch_rows(rows, capacity=TOPK_CAPACITY, sketches=None):
+    """
+    Add rows whose columns are ROW_COLUMNS to the per-file system read and
+    write sketches.  Rows may be per log or per job; the bytes of each user,
+    app, and job are summed before they are added to the quantile sketches.
+    Rows with UNKNOWN_JOBID only count toward the total and unattributed
+    bytes.
+    """
+    if sketches is None:
+        sketches = {}
+    ### per-(fs, mode, ranked column) totals of each user, app, and job
+    totals = {}
+    for row in rows:
+        fs = row[0]
+        if fs not in sketches:
+            sketches[fs] = {'read': new_sketches(capacity), 'write': new_sketches(capacity)}
+        for mode, column in ('read', 4), ('write', 5):
+            value = row[column]
+            fs_sketches = sketches[fs][mode]
+            fs_sketches['total'] += value
+            if row[3] == UNKNOWN_JOBID:
+                fs_sketches['unattributed'] += value
+                continue
+            for ranked, key_column in _RANKED_COLUMNS.items():
+                key = str(row[key_column])
+                ranked_totals = totals.setdefault((fs, mode, ranked), {})
+                ranked_totals[key] = ranked_totals.get(key, 0) + value
+                if value > 0:
+                    topk_add(fs_sketches[ranked], key, value)
+
+    for (fs, mode, ranked), ranked_totals in totals.items():
+        for value in ranked_totals.values():
+            quantiles_add(sketches[fs][mode]['quantiles'][ranked], value)
+    for fs in sketches:
+        for mode in 'read', 'write':
+            for ranked in _RANKED_COLUMNS:
+                topk_prune(sketches[fs][mode][ranked])
+    return sketches
+
+def merge_sketches(sketches, other):
+    """
+    Merge the per-file system sketches in other into sketches
+    """
+    for fs, modes in other.items():
+        if fs not in sketches:
+            sketches[fs] = modes
+            continue
+        for mode, fs_sketches in modes.items():
+            sketches[fs][mode]['total'] += fs_sketches['total']
+            sketches[fs][mode]['unattributed'] += fs_sketches['unattributed']
+            for ranked in _RANKED_COLUMNS:
+                quantiles_merge(sketches[fs][mode]['quantiles'][ranked], fs_sketches['quantiles'][ranked])
+                topk_merge(sketches[fs][mode][ranked], fs_sketches[ranked])
+    return sketches
+
+def summarize(sketches, top=20):
+    """
+    Summarize the read/write activity of each file system
+    """
+    data = {}
+    for fs, modes in sketches.items():
+        data[fs] = {}
+        for mode in 'read', 'write':
+            fs_sketches = modes[mode]
+            data[fs][mode] = fs_sketches['total']
+            data[fs]['%s_gibs' % mode] = fs_sketches['total'] / 2.0 ** 30.0
+            data[fs]['%s_unattributed' % mode] = fs_sketches['unattributed']
+            for ranked in sorted(_RANKED_COLUMNS.keys()):
+                data[fs]['top_%s_%s' % (mode, ranked)] = topk_top(fs_sketches[ranked], top)
+                ### e.g., read_user_percentiles
+                data[fs]['%s_%s_percentiles' % (mode, ranked[:-1])] = dict(
+                    ("p%d" % x, quantiles_query(fs_sketches['quantiles'][ranked], x)) for x in PERCENTILES)
+            top_user = topk_top(fs_sketches['users'], 1)
+            data[fs]['max_%s_user' % mode] = top_user[0][0] if top_user else None
+    return data
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='summarize read/write activity recorded by Darshan')
+    parser.add_argument('--logs', action='store_true', help='inputs are Darshan logs or directories of logs rather than a summary file')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='number of darshan-parser processes to run concurrently with --logs')
+    parser.add_argument('-o', '--output', type=str, default=None, help='write bytes read/written by fs, user, app, and job to this .csv or .parquet file')
+    parser.add_argument('-s', '--sketch', type=str, default=None, help='save the mergeable ranking and percentile sketches to this JSON file')
+    parser.add_argument('-m', '--merge', action='store_true', help='inputs are sketch files saved by --sketch to be combined')
+    parser.add_argument('-k', '--top', type=int, default=20, help='number of top users, apps, and jobs to report (default: 20)')
+    parser.add_argument('-c', '--capacity', type=int, default=TOPK_CAPACITY, help='number of keys tracked per ranking (default: %d)' % TOPK_CAPACITY)
+    parser.add_argument('inputs', nargs='+', help='summary file, Darshan logs/directories with --logs, or sketch files with --merge')
+    args = parser.parse_args()
+
+    if args.merge:
+        sketches = {}
+        for sketch_file in args.inputs:
+            with open(sketch_file, 'r') as fp:
+                merge_sketches(sketches, json.load(fp))
+    else:
+        if args.logs:
+            logs = expand_logs(args.inputs)
+            rows, failures = reduce_logs(logs, args.processes)
+            if failures > 0:
+                sys.stderr.write("%d of %d logs failed and were excluded\n" % (failures, len(logs)))
+        else:
+            rows = []
+            for summary_file in args.inputs:
+                rows += parse_summary_file(summary_file)
 
+        if args.output is not None:
+            save_rows(rows, args.output)
 
-for fs in data.keys():
-    d = data[fs]['user_reads']
-    data[fs]['max_read_user'] = max(d, key=d.get)
-    d = data[fs]['user_writes']
-    data[fs]['max_write_user'] = max(d, key=d.get)
-    data[fs]['read_gibs'] = data[fs]['read'] / 2.0 ** 30.0
-    data[fs]['write_gibs'] = data[fs]['write'] / 2.0 ** 30.0
+        sketches = sketch_rows(rows, args.capacity)
 
+    if args.sketch is not None:
+        with open(args.sketch, 'w') as fp:
+            json.dump(sketches, fp)
 
-print json.dumps(data, indent=4)
+    print json.dumps(summarize(sketches, args.top), indent=4)
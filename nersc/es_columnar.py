@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Columnar storage for bundles of ElasticSearch collectd documents.
+
+Each bundle of hits is flattened into one typed array per source field:
+
+    timestamp         int64 milliseconds since the epoch
+    categorical       int32 codes into a per-bundle list of strings
+    everything else   float64, NaN where a document lacks the field
+
+and saved either as a directory of .npy files, which can be memory-mapped
+back in without decoding anything, or as a Parquet file.  Every bundle also
+gets a small JSON metadata file recording its document count, categories, and
+first/last timestamps so that readers can skip bundles outside of a time
+range without opening them:
+
+    import es_columnar
+    for path in es_columnar.find_bundles(glob.glob('*.cols'), t0_ms, t1_ms):
+        columns = es_columnar.load_bundle(path)
+"""
+
+import os
+import re
+import json
+import numpy
+
+TIMESTAMP_FIELD = '@timestamp'
+
+CATEGORICAL_FIELDS = [
+    'hostname',
+    'plugin',
+    'collectd_type',
+    'type_instance',
+    'plugin_instance',
+]
+
+_META_FILE = "meta.json"
+
+### UTC designator or +HH:MM, +HHMM style offset at the end of a timestamp
+_TZ_REX = re.compile(r'(Z|[+-]\d\d:?\d\d)$')
+
+def column_name(field):
+    """
+    Return a file-system-safe column name for a source field
+    """
+    return 'timestamp' if field == TIMESTAMP_FIELD else field
+
+def _split_offset(value):
+    """
+    Split an ISO 8601 string into the local time and its offset from UTC in
+    milliseconds
+    """
+    match = _TZ_REX.search(value)
+    ### a date alone (YYYY-MM-DD) has no offset
+    if match is None or match.start() <= 10:
+        return value, 0
+    offset = match.group(1)
+    if offset == 'Z':
+        return value[:match.start()], 0
+    minutes = int(offset[1:3]) * 60 + int(offset[-2:])
+    if offset[0] == '-':
+        minutes = -minutes
+    return value[:match.start()], minutes * 60000
+
+def parse_timestamps(values):
+    """
+    Convert ISO 8601 strings (with or without a UTC offset) or epoch numbers
+    into int64 epoch milliseconds
+    """
+    if len(values) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    if isinstance(values[0], (int, float)):
+        ### assume epoch_second if the values are too small to be milliseconds
+        array = numpy.array(values, dtype=numpy.float64)
+        if array.max() < 1e11:
+            array *= 1000.0
+        return array.astype(numpy.int64)
+    ### numpy does not accept UTC designators or offsets
+    local_times, offsets = zip(*[ _split_offset(x) for x in values ])
+    return (numpy.array(local_times, dtype='datetime64[ms]').astype(numpy.int64)
+            - numpy.array(offsets, dtype=numpy.int64))
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+def flatten_bundle(bundle, fields):
+    """
+    Flatten a list of ElasticSearch hits into typed columns.  Returns a tuple
+    of (dict of column name to numpy array, dict of categorical column name to
+    list of categories).
+    """
+    sources = [ hit.get('_source', {}) for hit in bundle ]
+    columns = {}
+    categories = {}
+    for field in fields:
+        values = [ source.get(field) for source in sources ]
+        name = column_name(field)
+        if field == TIMESTAMP_FIELD:
+            columns[name] = parse_timestamps(values)
+        elif field in CATEGORICAL_FIELDS:
+            labels, codes = numpy.unique([ '' if x is None else str(x) for x in values ],
+                                         return_inverse=True)
+            columns[name] = codes.astype(numpy.int32)
+            categories[name] = [ str(x) for x in labels ]
+        else:
+            columns[name] = numpy.array([ _to_float(x) for x in values ], dtype=numpy.float64)
+    return columns, categories
+
+def _metadata(columns, categories):
+    timestamps = columns.get('timestamp')
+    has_times = timestamps is not None and len(timestamps) > 0
+    return {
+        'count': int(len(next(iter(columns.values())))) if columns else 0,
+        'categories': categories,
+        'columns': sorted(columns.keys()),
+        'time_start': int(timestamps.min()) if has_times else None,
+        'time_end': int(timestamps.max()) if has_times else None,
+    }
+
+def save_bundle_npy(bundle, path, fields):
+    """
+    Save a bundle of hits as a directory of .npy columns plus metadata
+    """
+    columns, categories = flatten_bundle(bundle, fields)
+    meta_file = os.path.join(path, _META_FILE)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    elif os.path.exists(meta_file):
+        ### a rewritten bundle must not look complete until it is
+        os.unlink(meta_file)
+    for name, array in columns.items():
+        numpy.save(os.path.join(path, name + ".npy"), array)
+    ### write metadata last so that its presence marks a complete bundle
+    with open(meta_file, 'w') as fp:
+        json.dump(_metadata(columns, categories), fp)
+
+def save_bundle_parquet(bundle, path, fields):
+    """
+    Save a bundle of hits as a Parquet file with dictionary-encoded
+    categorical columns, plus a sidecar metadata file
+    """
+    import pandas
+    columns, categories = flatten_bundle(bundle, fields)
+    meta_file = path + "." + _META_FILE
+    if os.path.exists(meta_file):
+        os.unlink(meta_file)
+    frame = {}
+    for name, array in columns.items():
+        if name in categories:
+            frame[name] = pandas.Categorical.from_codes(array, categories[name])
+        else:
+            frame[name] = array
+    pandas.DataFrame(frame).to_parquet(path)
+    with open(meta_file, 'w') as fp:
+        json.dump(_metadata(columns, categories), fp)
+
+def load_metadata(path):
+    """
+    Load the metadata of a bundle saved by save_bundle_npy or
+    save_bundle_parquet
+    """
+    if os.path.isdir(path):
+        meta_file = os.path.join(path, _META_FILE)
+    else:
+        meta_file = path + "." + _META_FILE
+    with open(meta_file, 'r') as fp:
+        return json.load(fp)
+
+def load_bundle(path, mmap_mode='r'):
+    """
+    Load a columnar bundle.  Returns a tuple of (dict of column name to numpy
+    array, dict of categorical column name to list of categories).  Columns of
+    .npy bundles are memory-mapped unless mmap_mode is None.
+    """
+    meta = load_metadata(path)
+    if not os.path.isdir(path):
+        import pandas
+        frame = pandas.read_parquet(path)
+        columns = {}
+        for name in frame.columns:
+            if name in meta['categories']:
+                columns[name] = frame[name].cat.codes.values.astype(numpy.int32)
+            else:
+                columns[name] = frame[name].values
+        return columns, meta['categories']
+
+    columns = {}
+    for name in meta['columns']:
+        columns[name] = numpy.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+    return columns, meta['categories']
+
+def find_bundles(paths, time_start=None, time_end=None):
+    """
+    Return the bundles whose documents overlap [time_start, time_end], in
+    epoch milliseconds, using only their metadata
+    """
+    found = []
+    for path in paths:
+        meta = load_metadata(path)
+        if meta['time_start'] is None:
+            continue
+        if time_end is not None and meta['time_start'] > time_end:
+            continue
+        if time_start is not None and meta['time_end'] < time_start:
+            continue
+        found.append(path)
+    return found
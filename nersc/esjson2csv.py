@@ -7,38 +7,262 @@
 #  and organize the results into per-timestamp, per-bbn rows that display the
 #  queue depths of each NVMe device.
 #
+#  With --stream, the input may be a plain or gzipped ElasticSearch response or
+#  a bundle written by bb_dump_es.py.  Hits are decoded one at a time rather
+#  than loading the whole document, accumulated into flat arrays, pivoted with
+#  numpy, and written out --chunk-rows rows at a time as CSV (to stdout or
+#  --output) or, if --output ends in .parquet, as Parquet.
+#
 
 import sys
 import json
-import pandas
+import codecs
+import calendar
+import argparse
 import datetime
+import numpy
+
+NVME_DEVICES = ['nvme0n1', 'nvme1n1', 'nvme2n1', 'nvme3n1']
+
+OUTPUT_COLUMNS = ['timestamp', 'hostname'] + NVME_DEVICES
+
+### bytes of input to decode at a time
+_READ_SIZE = 2**20
+
+### number of hits to allocate room for at a time
+_GROW_SIZE = 2**16
+
+_DECODER = json.JSONDecoder()
+
+def _open_bytes(filename):
+    """
+    Open a file for reading bytes, transparently decompressing it if gzipped
+    """
+    fp = open(filename, 'rb')
+    magic = fp.read(2)
+    fp.seek(0)
+    if magic == b'\x1f\x8b':
+        import gzip
+        return gzip.GzipFile(fileobj=fp, mode='rb')
+    return fp
+
+def iter_hits(fp):
+    """
+    Incrementally decode the elements of the hits array of an ElasticSearch
+    response, or of the top-level array of a bb_dump_es.py bundle, from a
+    stream of bytes
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = u''
+    eof = False
+
+    def more():
+        chunk = fp.read(_READ_SIZE)
+        return decoder.decode(chunk, final=not chunk), not chunk
+
+    ### find the opening bracket of the array of hits
+    pos = None
+    while pos is None:
+        text, eof = more()
+        buf += text
+        stripped = buf.lstrip()
+        if stripped.startswith(u'['):
+            pos = len(buf) - len(stripped) + 1
+            break
+        start = buf.find(u'"hits"', buf.find(u'"hits"') + 1)
+        if start >= 0:
+            bracket = buf.find(u'[', start)
+            if bracket >= 0:
+                pos = bracket + 1
+                break
+        if eof:
+            raise ValueError("no array of hits found")
+
+    while True:
+        ### skip separators between elements
+        while True:
+            while pos < len(buf) and buf[pos] in u' \t\r\n,':
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            text, eof = more()
+            buf = buf[pos:] + text
+            pos = 0
+        if pos >= len(buf) or buf[pos] == u']':
+            return
+
+        try:
+            hit, end = _DECODER.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            text, eof = more()
+            buf = buf[pos:] + text
+            pos = 0
+            continue
+        yield hit
+        pos = end
+
+class _Columns(object):
+    """
+    Flat, growable arrays of (timestamp, host, device, value) for each hit
+    """
+    def __init__(self):
+        self.size = 0
+        self.timestamps = numpy.zeros(_GROW_SIZE, dtype=numpy.int64)
+        self.hosts = numpy.zeros(_GROW_SIZE, dtype=numpy.int32)
+        self.devices = numpy.zeros(_GROW_SIZE, dtype=numpy.int8)
+        self.values = numpy.zeros(_GROW_SIZE, dtype=numpy.float64)
+        self.hostnames = []
+        self.host_codes = {}
+
+    def append(self, timestamp, hostname, device, value):
+        if self.size == len(self.timestamps):
+            for name in 'timestamps', 'hosts', 'devices', 'values':
+                old = getattr(self, name)
+                new = numpy.zeros(2 * len(old), dtype=old.dtype)
+                new[:len(old)] = old
+                setattr(self, name, new)
+        if hostname not in self.host_codes:
+            self.host_codes[hostname] = len(self.hostnames)
+            self.hostnames.append(hostname)
+        i = self.size
+        self.timestamps[i] = timestamp
+        self.hosts[i] = self.host_codes[hostname]
+        self.devices[i] = device
+        self.values[i] = value
+        self.size += 1
+
+def _epoch_seconds(timestamp):
+    """
+    Convert an ElasticSearch @timestamp string, truncated to the second, into
+    epoch seconds
+    """
+    dt = datetime.datetime.strptime(timestamp.split('.')[0].rstrip('Z'), "%Y-%m-%dT%H:%M:%S")
+    return calendar.timegm(dt.timetuple())
+
+def accumulate(hits):
+    """
+    Collect the NVMe queue depth of every hit into flat arrays
+    """
+    columns = _Columns()
+    device_codes = dict((x, i) for i, x in enumerate(NVME_DEVICES))
+    for result in hits:
+        hit = result['_source']
+        device = device_codes.get(hit.get('plugin_instance'))
+        if device is None:
+            continue
+        columns.append(_epoch_seconds(hit['@timestamp']), hit['hostname'], device, hit['value'])
+    return columns
+
+def pivot(columns):
+    """
+    Pivot flat hits into one row per timestamp and host, sorted by timestamp
+    and then by host number.  Returns (timestamps, host codes, values) where
+    values has one column per NVME_DEVICES entry and NaN where a device had no
+    sample.
+    """
+    n = columns.size
+    ### rank hosts by their host number, as the original output was sorted
+    host_rank = numpy.argsort(numpy.argsort([ x.lstrip('b') for x in columns.hostnames ]))
+    ranks = host_rank[columns.hosts[:n]] if n > 0 else numpy.zeros(0, dtype=numpy.int64)
+    order = numpy.lexsort((ranks, columns.timestamps[:n]))
+    timestamps = columns.timestamps[:n][order]
+    ranks = ranks[order]
+    is_new_row = numpy.ones(n, dtype=bool)
+    is_new_row[1:] = (timestamps[1:] != timestamps[:-1]) | (ranks[1:] != ranks[:-1])
+    row_of_hit = numpy.cumsum(is_new_row) - 1
+    values = numpy.full((int(is_new_row.sum()), len(NVME_DEVICES)), numpy.nan)
+    values[row_of_hit, columns.devices[:n][order]] = columns.values[:n][order]
+    return timestamps[is_new_row], columns.hosts[:n][order][is_new_row], values
+
+def _format_value(value):
+    return '' if value != value else repr(float(value))
+
+def write_csv(fp, columns, timestamps, hosts, values, chunk_rows):
+    """
+    Write pivoted rows as CSV, chunk_rows rows at a time
+    """
+    fp.write(','.join(OUTPUT_COLUMNS) + '\n')
+    epoch = datetime.datetime(1970, 1, 1)
+    for start in range(0, len(timestamps), chunk_rows):
+        lines = []
+        for i in range(start, min(start + chunk_rows, len(timestamps))):
+            lines.append("%s,%s,%s\n" % (
+                (epoch + datetime.timedelta(seconds=int(timestamps[i]))).strftime("%Y-%m-%d %H:%M:%S"),
+                columns.hostnames[hosts[i]],
+                ','.join([ _format_value(x) for x in values[i] ])))
+        fp.write(''.join(lines))
+
+def write_parquet(filename, columns, timestamps, hosts, values, chunk_rows):
+    """
+    Write pivoted rows as Parquet, one row group per chunk_rows rows
+    """
+    import pandas
+    import pyarrow
+    import pyarrow.parquet
+    writer = None
+    for start in range(0, len(timestamps), chunk_rows):
+        stop = min(start + chunk_rows, len(timestamps))
+        frame = pandas.DataFrame({
+            'timestamp': pandas.to_datetime(timestamps[start:stop], unit='s'),
+            'hostname': pandas.Categorical.from_codes(hosts[start:stop], columns.hostnames),
+        })
+        for j, device in enumerate(NVME_DEVICES):
+            frame[device] = values[start:stop, j]
+        table = pyarrow.Table.from_pandas(frame[OUTPUT_COLUMNS], preserve_index=False)
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(filename, table.schema)
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+
+def stream_convert(input_file, output_file, chunk_rows):
+    fp = _open_bytes(input_file)
+    columns = accumulate(iter_hits(fp))
+    fp.close()
+    timestamps, hosts, values = pivot(columns)
+    if output_file is not None and output_file.endswith('.parquet'):
+        write_parquet(output_file, columns, timestamps, hosts, values, chunk_rows)
+    elif output_file is not None:
+        with open(output_file, 'w') as out:
+            write_csv(out, columns, timestamps, hosts, values, chunk_rows)
+    else:
+        write_csv(sys.stdout, columns, timestamps, hosts, values, chunk_rows)
+
+def convert(input_file):
+    import pandas
+    results = {}
+
+    ### first parse the json and group data by timestamp-bbnode
+    for result in json.load(open(input_file, 'r'))['hits']['hits']:
+        hit = result['_source']
+        timestamp = datetime.datetime.strptime(hit['@timestamp'].split('.')[0], "%Y-%m-%dT%H:%M:%S")
+        bb_nodenum = hit['hostname'].lstrip('b')
+        key = "%s_%s" % (timestamp, hit['hostname'])
+        if key not in results:
+            results[key] = {
+                'timestamp': timestamp,
+                'hostname': hit['hostname'],
+                'hostnumber': bb_nodenum,
+            }
+        nvme_device = hit['plugin_instance']
+        results[key][nvme_device] = hit['value']
+
+    print pandas.DataFrame.from_dict(results, orient='index')\
+        .sort_values(by=['timestamp', 'hostnumber'])\
+        [OUTPUT_COLUMNS]\
+        .to_csv(index=False, header=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pivot NVMe queue depths from ElasticSearch into per-node rows')
+    parser.add_argument('file', type=str, help='ElasticSearch response or bb_dump_es.py bundle')
+    parser.add_argument('-s', '--stream', action='store_true', help='decode hits incrementally; accepts gzipped input and bb_dump_es.py bundles')
+    parser.add_argument('-o', '--output', type=str, default=None, help='with --stream, write to this .csv or .parquet file instead of stdout')
+    parser.add_argument('-c', '--chunk-rows', type=int, default=100000, help='with --stream, number of rows to write at a time')
+    args = parser.parse_args()
 
-results = {}
-
-### first parse the json and group data by timestamp-bbnode
-for result in json.load(open(sys.argv[1], 'r'))['hits']['hits']:
-    hit = result['_source']
-    timestamp = datetime.datetime.strptime(hit['@timestamp'].split('.')[0], "%Y-%m-%dT%H:%M:%S")
-    bb_nodenum = hit['hostname'].lstrip('b')
-    key = "%s_%s" % (timestamp, hit['hostname'])
-    if key not in results:
-        results[key] = {
-            'timestamp': timestamp,
-            'hostname': hit['hostname'],
-            'hostnumber': bb_nodenum,
-        }
-    nvme_device = hit['plugin_instance']
-    results[key][nvme_device] = hit['value']
-
-### convert the above json into something ingestible by pandas
-dict_to_df = []
-for _, values in results.iteritems():
-    record = {}
-    for key, value in values.iteritems():
-        record[key] = value
-    dict_to_df.append(record)
-
-print pandas.DataFrame.from_dict(results, orient='index')\
-    .sort_values(by=['timestamp', 'hostnumber'])\
-    [['timestamp','hostname','nvme0n1','nvme1n1','nvme2n1','nvme3n1']]\
-    .to_csv(index=False, header=True)
+    if args.stream:
+        stream_convert(args.file, args.output, args.chunk_rows)
+    else:
+        convert(args.file)
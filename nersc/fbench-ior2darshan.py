@@ -1,15 +1,36 @@
 #!/usr/bin/env python
 """
 Find darshan logfiles corresponding to one or more IOR output logs
+
+By default, each Darshan log directory is globbed once per IOR output.  With
+--batch, each relevant YYYY/M/D directory is instead listed exactly once, the
+listings are indexed by Slurm jobid, and every IOR output is resolved against
+that index.  --index-cache FILE persists the listings between runs; a cached
+listing is reused as long as its directory's mtime has not changed.
+
+Logs are copied by --threads concurrent copy threads fed through a bounded
+queue.  With --manifest FILE, every completed copy is appended to FILE so that
+an interrupted run can be resumed without re-stat'ing its destinations.  The
+throughput and latency of the copies from each source directory are reported
+at the end.
 """
 
 import os
+import re
 import sys
 import glob
+import fnmatch
+import time
 import shutil
 import argparse
 import datetime
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 import hpcparse
+import ioutil
 
 _DARSHAN_PATHS = [
     "/global/cscratch1/sd/darshanlogs",
@@ -20,6 +41,69 @@ _DARSHAN_PATHS = [
 
 _ARGS = None
 
+### matches the same names as the glob *id<jobid>_* used without --batch
+_JOBID_REX = re.compile(r'id(\d+)_')
+
+### number of pending copies allowed per copy thread
+_QUEUE_DEPTH = 4
+
+class DarshanLogIndex(object):
+    """
+    Listings of Darshan log directories indexed by Slurm jobid.  Each
+    directory is listed at most once per run, and not at all if a cached
+    listing with the same directory mtime was loaded.
+    """
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.listings = {}
+        self._checked = set([])
+        self._jobids = {}
+        if cache_file is not None:
+            self.listings = ioutil.load_json(cache_file)
+
+    def names(self, path):
+        """
+        Return the names of all files in a directory
+        """
+        if path not in self._checked:
+            self._checked.add(path)
+            try:
+                mtime = os.stat(path).st_mtime
+                if path not in self.listings or self.listings[path]['mtime'] != mtime:
+                    self.listings[path] = {'mtime': mtime, 'names': os.listdir(path)}
+            except OSError:
+                self.listings[path] = {'mtime': None, 'names': []}
+        return self.listings[path]['names']
+
+    def find(self, path, jobid):
+        """
+        Return the full paths of all Darshan logs in a directory that were
+        generated by a Slurm jobid
+        """
+        if path not in self._jobids:
+            jobids = {}
+            for name in self.names(path):
+                for jobid in set(_JOBID_REX.findall(name)):
+                    jobids.setdefault(jobid, []).append(name)
+            self._jobids[path] = jobids
+        return [ os.path.join(path, name) for name in self._jobids[path].get(str(jobid), []) ]
+
+    def match(self, path, pattern):
+        """
+        Return the full paths of all files in a directory that match a glob
+        pattern, excluding hidden files as glob.glob does
+        """
+        return [ os.path.join(path, name) for name in self.names(path)
+                 if not name.startswith('.') and fnmatch.fnmatch(name, pattern) ]
+
+    def save(self):
+        """
+        Persist the listings to the cache file, if there is one
+        """
+        if self.cache_file is None:
+            return
+        ioutil.save_json_atomic(self.listings, self.cache_file)
+
 def main():
     ### found_files = set of darshan logs generated directly by IOR runs
     found_files = set([])
@@ -29,6 +113,10 @@ def main():
     for base_path in _DARSHAN_PATHS:
         found_dirs[base_path] = set([])
 
+    index = None
+    if _ARGS.batch:
+        index = DarshanLogIndex(_ARGS.index_cache)
+
     for filename in _ARGS.files:
         ### parse each IOR output file to extract date(s) and Slurm jobids
         jobid_str = filename.split('_')[-1].split('.')[0]
@@ -44,7 +132,11 @@ def main():
         ### search for the Slurm jobid for each IOR output file in all of the
         ### possible Darshan log directories
         for base_path in _DARSHAN_PATHS:
-            matches = glob.glob( os.path.join( base_path, str(yr), str(mo), str(dy), "*id%s_*" % jobid_str ) )
+            src_dir = os.path.join( base_path, str(yr), str(mo), str(dy) )
+            if index is not None:
+                matches = index.find(src_dir, jobid_str)
+            else:
+                matches = glob.glob( os.path.join( src_dir, "*id%s_*" % jobid_str ) )
             if len(matches) > 0:
                 for darshan_log in matches:
                     ### add the IOR job's Darshan log to found_files
@@ -60,17 +152,16 @@ def main():
     madedirs = set([])  ### track which dirs have already be mkdir'ed; do this
                         ### instead of repeatedly os.path.isdir to prevent MDS
                         ### overload and for dryruns
-    failures = set([])  ### darshan logs which failed to copy (permission
-                        ### issues, etc)
+    failures = {}       ### darshan logs which failed to copy (permission
+                        ### issues, etc) and why
+
+    copies = []         ### (source, destination directory) of every copy
 
     ### copy all Darshan logs directly corresponding to an IOR log
     for found_file, date in found_files:
         dest_dir = mk_output_dir(date, madedirs)
         madedirs.add(dest_dir)
-        try:
-            cp(found_file, dest_dir)
-        except IOError:
-            failures.add(found_file)
+        copies.append((found_file, dest_dir))
 
     if _ARGS.all:
         ### copy ALL darshan logs for days during which IOR was run
@@ -82,17 +173,25 @@ def main():
                                         str(date.day) )
                 dest_dir = mk_output_dir(date, madedirs)
                 madedirs.add(dest_dir)
-                matches = glob.glob(os.path.join(src_dir, "*.darshan*"))
+                if index is not None:
+                    matches = index.match(src_dir, "*.darshan*")
+                else:
+                    matches = glob.glob(os.path.join(src_dir, "*.darshan*"))
                 for matching_file in matches:
-                    try:
-                        cp(matching_file, dest_dir)
-                    except IOError:
-                        failures.add(matching_file)
+                    copies.append((matching_file, dest_dir))
+
+    if index is not None:
+        index.save()
+
+    stats = copy_files(copies, failures)
+    if _ARGS.srsly and len(stats) > 0:
+        print_copy_stats(stats)
 
     if len(failures) > 0:
         print "The following source files failed to copy:"
-        for failure in failures:
-            print "  %s" % failure
+        for failure in sorted(failures.keys()):
+            print "  %s: %s" % (failure, failures[failure])
+        sys.exit(1)
 
 def mk_output_dir(date, madedirs):
     if _ARGS.bin_by_date:
@@ -112,18 +211,120 @@ def mkdir(path):
         sys.stdout.write("\n")
 
 def cp(src, dest):
+    """
+    Copy src to dest and return the number of bytes copied, or None if
+    nothing was copied
+    """
     if os.path.isdir(dest):
         dest = os.path.join( dest, os.path.basename(src) )
 
     if _ARGS.ignore_existing and os.path.exists(dest):
-        return
+        return None
 
-    sys.stdout.write("cp %s %s" % (src, dest))
     if _ARGS.srsly:
         shutil.copyfile(src, dest)
-        sys.stdout.write("...done\n")
+        sys.stdout.write("cp %s %s...done\n" % (src, dest))
+        return os.path.getsize(dest)
     else:
-        sys.stdout.write("\n")
+        sys.stdout.write("cp %s %s\n" % (src, dest))
+        return None
+
+def load_manifest(manifest_file):
+    """
+    Return the set of (source, destination directory) copies recorded as
+    completed in a manifest file
+    """
+    completed = set([])
+    if manifest_file is None or not os.path.isfile(manifest_file):
+        return completed
+    with open(manifest_file, 'r') as fp:
+        for line in fp:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 2:
+                completed.add(tuple(fields))
+    return completed
+
+def copy_files(copies, failures):
+    """
+    Copy a list of (source, destination directory) tuples using a pool of
+    threads, skipping copies already recorded in the manifest.  Sources that
+    fail to copy for any reason are added to the failures dict along with
+    their error.  Returns a dict keyed by source directory of [files, bytes,
+    sum of latencies, max latency, first start, last end].
+    """
+    completed = load_manifest(_ARGS.manifest)
+    manifest = None
+    if _ARGS.manifest is not None and _ARGS.srsly:
+        manifest = open(_ARGS.manifest, 'a')
+
+    stats = {}
+    lock = threading.Lock()
+    work = queue.Queue(maxsize=_ARGS.threads * _QUEUE_DEPTH)
+
+    def copy_worker():
+        while True:
+            job = work.get()
+            if job is None:
+                break
+            src, dest_dir = job
+            t0 = time.time()
+            try:
+                nbytes = cp(src, dest_dir)
+            except Exception as error:
+                ### don't let an unexpected error kill this thread and strand
+                ### the rest of the queue
+                with lock:
+                    failures[src] = "%s: %s" % (type(error).__name__, error)
+                continue
+            t1 = time.time()
+            if nbytes is None:
+                continue
+            with lock:
+                if manifest is not None:
+                    manifest.write("%s\t%s\n" % (src, dest_dir))
+                    manifest.flush()
+                stat = stats.setdefault(os.path.dirname(src), [0, 0, 0.0, 0.0, t0, t1])
+                stat[0] += 1
+                stat[1] += nbytes
+                stat[2] += t1 - t0
+                stat[3] = max(stat[3], t1 - t0)
+                stat[4] = min(stat[4], t0)
+                stat[5] = max(stat[5], t1)
+
+    threads = [ threading.Thread(target=copy_worker) for _ in range(_ARGS.threads) ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    queued = set([])
+    for copy in copies:
+        if copy in completed or copy in queued:
+            continue
+        queued.add(copy)
+        work.put(copy)
+    for _ in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+
+    if manifest is not None:
+        manifest.close()
+    return stats
+
+def print_copy_stats(stats):
+    """
+    Print the throughput and latency of copies from each source directory
+    """
+    print "%-60s %8s %10s %10s %10s %10s" % ("source", "files", "MiB", "MiB/s", "mean(ms)", "max(ms)")
+    for src_dir in sorted(stats.keys()):
+        files, nbytes, latency, max_latency, t0, t1 = stats[src_dir]
+        print "%-60s %8d %10.2f %10.2f %10.2f %10.2f" % (
+            src_dir,
+            files,
+            nbytes / 2.0**20,
+            nbytes / 2.0**20 / max(t1 - t0, 1e-6),
+            latency / files * 1000.0,
+            max_latency * 1000.0)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -131,6 +332,10 @@ if __name__ == "__main__":
     parser.add_argument("--bin-by-date", help="bin darshan logs into YYYY-MM-DD directories", action="store_true")
     parser.add_argument("--srsly", help="actually create dirs and copy files rather than dryrun", action="store_true")
     parser.add_argument("--ignore-existing", help="don't copy files if they already exist in dest", action="store_true")
+    parser.add_argument("--batch", help="list each Darshan log directory once and match all IOR outputs against it", action="store_true")
+    parser.add_argument("--index-cache", type=str, default=None, help="with --batch, file in which to persist directory listings between runs")
+    parser.add_argument("-t", "--threads", type=int, default=8, help="number of concurrent copies (default: 8)")
+    parser.add_argument("--manifest", type=str, default=None, help="file recording completed copies; copies listed in it are skipped")
     parser.add_argument("files", nargs='*', help="IOR outputs to process")
     _ARGS = parser.parse_args()
     main()
@@ -9,21 +9,33 @@ Syntax:
 
 Output:
     New *.hdf5 files in $PWD containing a subset of datasets relevant to
-    correlating with IOR.  Any day that an IOR job touches is copied in whole,
-    but only a subset of datasets in each H5LMT are transferred.
+    correlating with IOR.  Any day that an IOR job touches is copied in whole
+    (unless --window is given), but only a subset of datasets in each H5LMT
+    are transferred.
 
 Alternatively, you can explicitly reprocess a single h5lmt file using
 
     ./this_script --h5in /path/to/rawfile.h5lmt --h5out ./my_processed_data.hdf5
+
+The relevant datasets are copied in-process with h5py directly into chunked,
+gzip-compressed output files, and multiple h5lmt files are processed
+concurrently by a pool of worker processes (--processes).  --window copies
+only the timesteps covered by the IOR runs (plus --padding seconds on either
+side) rather than whole days.  IOR timestamps are interpreted in local time,
+as are the start and end arguments of h5lmt_query.py.  The old h5copy/h5repack
+pipeline is still available with --h5tools.
 """
 import os
 import sys
+import time
 import datetime
 import tempfile
 import subprocess
 import argparse
-import StringIO
 import warnings
+import multiprocessing
+import numpy
+import h5py
 import hpcparse
 
 ### template string for h5lmt file locations
@@ -38,46 +50,51 @@ RELEVANT_DATASETS = [
     "OSSCPUGroup/OSSCPUDataSet",
 ]
 
+### the dataset containing the timestamp of each column of the other datasets
+STEPS_DATASET = "FSStepsGroup/FSStepsDataSet"
+
+### number of timesteps per chunk of the output datasets
+CHUNK_TIMESTEPS = 1024
+
 def ior_to_hdf5_files( ior_outputs ):
     """
     input: a list of file names containing IOR's stdout messages
     output: tuple containing
-        1. list of h5lmt file names corresponding to input files
+        1. dict keyed by the h5lmt file names corresponding to input files;
+           values are the [first start, last stop] epoch seconds of the IOR
+           runs that touch each file
         2. subset of input that was used to generate output #1
 
     Can handle files that contain concatenated IOR outputs.
     """
     valid_inputs = set()
-    h5lmt_files = set()
+    h5lmt_files = {}
     for filename in ior_outputs:
-        stdout_str = ""
         with open(filename, 'r') as fp:
-            for line in fp:
-                if line.startswith("Run began"):
-                    stdout_str = line
-                elif line.startswith("Run finished"):
-                    stdout_str += line
-                    ior_data = hpcparse.ior.parse(StringIO.StringIO(stdout_str))
-                    stdout_str = ""
-
-                    ### deal with malformed outputs
-                    try:
-                        date = ior_data['start'].date()
-                        date_stop = ior_data['stop'].date()
-                        fs = ior_data['path'].strip(os.sep).split(os.sep)[0]
-                    except KeyError:
-                        warnings.warn("Malformed IOR output %s" % filename)
-                        continue
-
-                    ### register the h5lmt file(s) for this run
-                    while date <= date_stop:
-                        h5input = H5LMT_PATH_TEMPLATE % (date, hpcparse.FS_MAP[fs])
-                        if os.path.isfile(h5input):
-                            h5lmt_files.add(h5input)
-                            valid_inputs.add(filename)
-                        date += datetime.timedelta(days=1)
-                elif len(stdout_str) > 0:
-                    stdout_str += line
+            for ior_data in hpcparse.ior.iter_runs(fp):
+                ### deal with malformed outputs
+                try:
+                    date = ior_data['start'].date()
+                    date_stop = ior_data['stop'].date()
+                    fs = ior_data['path'].strip(os.sep).split(os.sep)[0]
+                except KeyError:
+                    warnings.warn("Malformed IOR output %s" % filename)
+                    continue
+
+                ### register the h5lmt file(s) for this run
+                start = time.mktime(ior_data['start'].timetuple())
+                stop = time.mktime(ior_data['stop'].timetuple())
+                while date <= date_stop:
+                    h5input = H5LMT_PATH_TEMPLATE % (date, hpcparse.FS_MAP[fs])
+                    if os.path.isfile(h5input):
+                        if h5input in h5lmt_files:
+                            window = h5lmt_files[h5input]
+                            window[0] = min(window[0], start)
+                            window[1] = max(window[1], stop)
+                        else:
+                            h5lmt_files[h5input] = [start, stop]
+                        valid_inputs.add(filename)
+                    date += datetime.timedelta(days=1)
 
     return h5lmt_files, valid_inputs
 
@@ -110,6 +127,55 @@ def convert_and_copy( src, dest, datasets, srsly=False ):
 
     return ret
 
+def subset_h5lmt( src, dest, datasets, window=None ):
+    """
+    Copy datasets from a source h5lmt file into a new chunked, compressed hdf5
+    file without any external processes.  If window is a (start, stop) tuple
+    of epoch seconds, only the timesteps within [start, stop] are copied.
+    """
+    with h5py.File(src, 'r') as f_in, h5py.File(dest, 'w') as f_out:
+        columns = slice(None)
+        if window is not None:
+            steps = f_in[STEPS_DATASET][:]
+            columns = slice(numpy.searchsorted(steps, window[0], side='left'),
+                            numpy.searchsorted(steps, window[1], side='right'))
+
+        for dset in datasets:
+            group_name = os.path.dirname(dset)
+            if group_name and group_name not in f_out:
+                group = f_out.create_group(group_name)
+                for key, value in f_in[group_name].attrs.items():
+                    group.attrs[key] = value
+
+            ### every relevant dataset is indexed by timestep along its last axis
+            values = f_in[dset][..., columns]
+            chunks = values.shape[:-1] + (max(1, min(values.shape[-1], CHUNK_TIMESTEPS)),)
+            out = f_out.create_dataset(dset,
+                                       data=values,
+                                       chunks=chunks,
+                                       compression='gzip',
+                                       compression_opts=1,
+                                       shuffle=True)
+            for key, value in f_in[dset].attrs.items():
+                out.attrs[key] = value
+
+        for key, value in f_in.attrs.items():
+            f_out.attrs[key] = value
+        if window is not None:
+            f_out.attrs['window'] = numpy.array(window, dtype=numpy.int64)
+
+def subset_job( job ):
+    """
+    Run subset_h5lmt for a (src, dest, datasets, window) tuple in a worker
+    process.  Returns (dest, error message or None).
+    """
+    src, dest, datasets, window = job
+    try:
+        subset_h5lmt(src, dest, datasets, window)
+    except (IOError, OSError, KeyError, ValueError) as error:
+        return dest, str(error)
+    return dest, None
+
 def suggest_name( src ):
     """
     Suggest a new name for an h5lmt file.
@@ -131,11 +197,34 @@ def mine_ior_and_convert(args):
     h5lmt_files, valid_inputs = ior_to_hdf5_files( args.files )
 
     failed_files = set()
-    for h5lmt_file in h5lmt_files:
-        new_file = suggest_name(h5lmt_file)
-        ret = convert_and_copy(h5lmt_file, new_file, RELEVANT_DATASETS, not args.dryrun)
-        if ret != 0:
-            failed_files.add(new_file)
+    if args.h5tools:
+        for h5lmt_file in h5lmt_files:
+            new_file = suggest_name(h5lmt_file)
+            ret = convert_and_copy(h5lmt_file, new_file, RELEVANT_DATASETS, not args.dryrun)
+            if ret != 0:
+                failed_files.add(new_file)
+    else:
+        jobs = []
+        for h5lmt_file, (start, stop) in h5lmt_files.items():
+            window = None
+            if args.window:
+                window = (start - args.padding, stop + args.padding)
+            jobs.append((h5lmt_file, suggest_name(h5lmt_file), RELEVANT_DATASETS, window))
+
+        if args.dryrun:
+            for src, dest, _, window in jobs:
+                print "subset %s -> %s%s" % (src, dest,
+                    "" if window is None else " [%d, %d]" % window)
+        else:
+            pool = multiprocessing.Pool(args.processes)
+            for new_file, error in pool.imap_unordered(subset_job, jobs):
+                if error is not None:
+                    sys.stderr.write("%s: %s\n" % (new_file, error))
+                    failed_files.add(new_file)
+                elif args.verbose:
+                    sys.stderr.write("wrote %s\n" % new_file)
+            pool.close()
+            pool.join()
 
     for failed_file in failed_files:
         print "rm " + failed_file
@@ -149,14 +238,23 @@ if __name__ == '__main__':
     parser.add_argument("-v", "--verbose", help="print additional messages about what is happening", action="store_true")
     parser.add_argument("--h5in", help="hdf5 file to convert; must specify with --h5out")
     parser.add_argument("--h5out", help="output file of --h5in")
+    parser.add_argument("-p", "--processes", type=int, default=4, help="number of worker processes subsetting h5lmt files concurrently (default: 4)")
+    parser.add_argument("-w", "--window", action="store_true", help="only copy the timesteps covered by the IOR runs instead of whole days")
+    parser.add_argument("--padding", type=int, default=300, help="seconds of data to keep before and after the IOR runs with --window (default: 300)")
+    parser.add_argument("--h5tools", action="store_true", help="subset using the h5copy and h5repack commands instead of h5py")
     parser.add_argument("files", nargs='*', help="IOR outputs to process")
     args = parser.parse_args()
 
     if args.h5in is not None and args.h5out is None:
         sys.exit("--h5out must be specified with --h5in")
     elif args.h5in is not None and args.h5out is not None:
-        ret = convert_and_copy(args.h5in, args.h5out, RELEVANT_DATASETS, srsly=True)
-        if ret != 0:
-            sys.exit("convert_and_copy returned error %d" % ret)
+        if args.h5tools:
+            ret = convert_and_copy(args.h5in, args.h5out, RELEVANT_DATASETS, srsly=True)
+            if ret != 0:
+                sys.exit("convert_and_copy returned error %d" % ret)
+        else:
+            _, error = subset_job((args.h5in, args.h5out, RELEVANT_DATASETS, None))
+            if error is not None:
+                sys.exit("subset_h5lmt failed: %s" % error)
     else:
         mine_ior_and_convert(args)
@@ -8,13 +8,33 @@
 #  create your own private database and copy both sets of tables there.  This
 #  allows correlation between ALTD job ids and actual job info.
 #
+#  --custom --single-pass computes every coverage bucket for every month in one
+#  pass.  Each linkline is classified once by whether it references darshan and
+#  mpi, the flags are reduced per job into a temporary table, and two streamed
+#  queries against it return every job and every ALTD-only job, which are
+#  bucketed into months in Python.  Unlike the month-by-month queries, jobs are
+#  matched to ALTD records from anywhere in the date range, so a job that
+#  completes in the month after it was launched is still counted as an ALTD job.
+#
+#  --cache FILE copies the ALTD job/linkline tables and the jobs summary table
+#  into a local SQLite database, with each linkline's darshan and mpi flags
+#  computed once, and runs the analysis against it.  The cache records which
+#  date intervals of each table it holds, and each run only fetches the parts of
+#  [startdate, stopdate) that are not covered yet.  Days from today onward are
+#  never marked as covered since they may still be incomplete.  --offline skips
+#  contacting MySQL altogether, analyzes whatever is in the cache, and warns
+#  about any part of the date range that the cache does not cover.
+#
 #  Glenn K. Lockwood, Lawrence Berkeley National Laboratory         August 2016
 
 import re
 import os
 import sys
 import argparse
+import bisect
+import sqlite3
 import MySQLdb
+import MySQLdb.cursors
 import datetime
 import dateutil.relativedelta
 
@@ -68,6 +88,253 @@ FROM ( %(all_jobs_query)s) AS a
 %(join_type)s JOIN ( %(all_altds_query)s ) AS b ON a.stepid = b.jobid
 """
 
+### one row per ALTD job with flags indicating whether any of the job's
+### linklines included darshan and/or mpi
+_ALTD_FLAGS_QUERY = """
+SELECT
+    jobid,
+    DATE(MIN(run_date)) AS day,
+    MAX(has_darshan AND has_mpi) AS darshan_mpi,
+    MAX(NOT has_darshan AND has_mpi) AS nondarshan_mpi,
+    MAX(has_darshan AND NOT has_mpi) AS darshan_nonmpi,
+    MAX(NOT has_darshan AND NOT has_mpi) AS nondarshan_nonmpi
+FROM (
+    SELECT
+        concat(jobs.job_launch_id, '.edique02') AS jobid,
+        jobs.run_date,
+        linklines.linkline LIKE '%%darshan%%' AS has_darshan,
+        linklines.linkline LIKE '%%mpi%%' AS has_mpi
+    FROM
+        altd_edison_jobs AS jobs
+    INNER JOIN altd_edison_link_tags AS tags ON tags.tag_id = jobs.tag_id
+    INNER JOIN altd_edison_linkline AS linklines ON tags.linkline_id = linklines.linking_inc
+    WHERE
+        jobs.run_date >= '%(date_start)s'
+    AND jobs.run_date < '%(date_stop)s'
+) AS classified
+GROUP BY jobid
+"""
+
+### temporary table holding _ALTD_FLAGS_QUERY so that the linklines are only
+### classified once.  MySQL cannot refer to a temporary table more than once in
+### a single statement, so the coverage rows come from two separate queries.
+_FLAGS_TABLE = "altd_coverage_flags"
+
+_CREATE_FLAGS_TABLE = """
+CREATE TEMPORARY TABLE %(flags_table)s (INDEX (jobid))
+%(altd_flags_query)s
+"""
+
+### coverage rows:
+###   day, cycles, in db, in altd, darshan_mpi, nondarshan_mpi, darshan_nonmpi,
+###   nondarshan_nonmpi
+### one row per job in the jobs database...
+_COVERAGE_JOBS_QUERY = """
+SELECT
+    DATE(FROM_UNIXTIME(s.completion)),
+    s.numnodes * s.wallclock / 3600.0,
+    1,
+    b.jobid IS NOT NULL,
+    b.darshan_mpi,
+    b.nondarshan_mpi,
+    b.darshan_nonmpi,
+    b.nondarshan_nonmpi
+FROM
+    summary AS s
+LEFT JOIN %(flags_table)s AS b ON s.stepid = b.jobid
+WHERE
+    s.hostname = 'edison'
+AND s.`completion` >= UNIX_TIMESTAMP('%(date_start)s 00:00:00')
+AND s.`completion` < UNIX_TIMESTAMP('%(date_stop)s 00:00:00')
+"""
+
+### ...and one row per ALTD job that is not in the jobs database
+_COVERAGE_ALTD_ONLY_QUERY = """
+SELECT
+    b.day, NULL, 0, 1, NULL, NULL, NULL, NULL
+FROM
+    %(flags_table)s AS b
+LEFT JOIN (
+    SELECT
+        stepid
+    FROM
+        summary
+    WHERE
+        hostname = 'edison'
+    AND `completion` >= UNIX_TIMESTAMP('%(date_start)s 00:00:00')
+    AND `completion` < UNIX_TIMESTAMP('%(date_stop)s 00:00:00')
+) AS s ON s.stepid = b.jobid
+WHERE s.stepid IS NULL
+"""
+
+_COVERAGE_FIELDS = [
+    "start",
+    "total jobs",
+    "altd jobs",
+    "non-altd jobs",
+    "darshan mpi jobs",
+    "non-darshan mpi jobs",
+    "darshan non-mpi jobs",
+    "non-darshan non-mpi jobs",
+    "jobs in altd but not db",
+    "total cycles",
+    "altd cycles",
+    "non-altd cycles",
+    "darshan mpi cycles",
+    "non-darshan mpi cycles",
+    "darshan non-mpi cycles",
+    "non-darshan non-mpi cycles"
+]
+
+### coverage buckets corresponding to the four linkline flag columns
+_FLAG_BUCKETS = [
+    "darshan mpi",
+    "non-darshan mpi",
+    "darshan non-mpi",
+    "non-darshan non-mpi",
+]
+
+### local cache of the ALTD and jobs databases
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS linklines (
+    linking_inc INTEGER PRIMARY KEY,
+    has_darshan INTEGER,
+    has_mpi INTEGER
+);
+CREATE TABLE IF NOT EXISTS altd_jobs (
+    job_launch_id INTEGER,
+    run_date TEXT,
+    linkline_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS altd_jobs_job_launch_id ON altd_jobs (job_launch_id);
+CREATE INDEX IF NOT EXISTS altd_jobs_run_date ON altd_jobs (run_date);
+CREATE TABLE IF NOT EXISTS jobs (
+    stepid TEXT PRIMARY KEY,
+    job_launch_id INTEGER,
+    completion INTEGER,
+    day TEXT,
+    cycles REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_job_launch_id ON jobs (job_launch_id);
+CREATE INDEX IF NOT EXISTS jobs_day ON jobs (day);
+CREATE TABLE IF NOT EXISTS cache_intervals (
+    name TEXT,
+    start TEXT,
+    stop TEXT
+);
+"""
+
+_CACHE_ALTD_FETCH_QUERY = """
+SELECT
+    jobs.job_launch_id,
+    jobs.run_date,
+    tags.linkline_id
+FROM
+    altd_edison_jobs AS jobs
+INNER JOIN altd_edison_link_tags AS tags ON tags.tag_id = jobs.tag_id
+WHERE
+    jobs.run_date >= '%(date_start)s'
+AND jobs.run_date < '%(date_stop)s'
+"""
+
+_CACHE_JOBS_FETCH_QUERY = """
+SELECT
+    stepid,
+    completion,
+    DATE(FROM_UNIXTIME(completion)),
+    numnodes * wallclock / 3600.0
+FROM
+    summary
+WHERE
+    hostname = 'edison'
+AND `completion` >= UNIX_TIMESTAMP('%(date_start)s 00:00:00')
+AND `completion` < UNIX_TIMESTAMP('%(date_stop)s 00:00:00')
+"""
+
+_CACHE_LINKLINES_FETCH_QUERY = """
+SELECT
+    linking_inc,
+    linkline LIKE '%%darshan%%',
+    linkline LIKE '%%mpi%%'
+FROM
+    altd_edison_linkline
+WHERE
+    linking_inc IN (%(linkline_ids)s)
+"""
+
+### per-cached-table (fetch query, insert statement, date column, row converter)
+_CACHE_TABLES = {
+    'altd_jobs': (
+        _CACHE_ALTD_FETCH_QUERY,
+        "INSERT INTO altd_jobs VALUES (?, ?, ?)",
+        "run_date",
+        lambda row: (int(row[0]), str(row[1]), int(row[2])),
+    ),
+    'jobs': (
+        _CACHE_JOBS_FETCH_QUERY,
+        "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)",
+        "day",
+        lambda row: (row[0],
+                     int(row[0].split('.', 1)[0]) if row[0].endswith('.edique02') else None,
+                     int(row[1]),
+                     str(row[2]),
+                     float(row[3] or 0.0)),
+    ),
+}
+
+_CACHE_BATCH_SIZE = 10000
+
+### same flags as _ALTD_FLAGS_QUERY, but from the local cache
+_CACHE_FLAGS_CTE = """
+WITH flags AS (
+    SELECT
+        a.job_launch_id,
+        substr(MIN(a.run_date), 1, 10) AS day,
+        MAX(l.has_darshan AND l.has_mpi) AS darshan_mpi,
+        MAX(NOT l.has_darshan AND l.has_mpi) AS nondarshan_mpi,
+        MAX(l.has_darshan AND NOT l.has_mpi) AS darshan_nonmpi,
+        MAX(NOT l.has_darshan AND NOT l.has_mpi) AS nondarshan_nonmpi
+    FROM
+        altd_jobs AS a
+    INNER JOIN linklines AS l ON l.linking_inc = a.linkline_id
+    WHERE
+        a.run_date >= :date_start
+    AND a.run_date < :date_stop
+    GROUP BY a.job_launch_id
+)
+"""
+
+### same rows as _COVERAGE_JOBS_QUERY and _COVERAGE_ALTD_ONLY_QUERY, but from
+### the local cache
+_CACHE_COVERAGE_QUERY = _CACHE_FLAGS_CTE + """
+SELECT
+    j.day,
+    j.cycles,
+    1,
+    f.job_launch_id IS NOT NULL,
+    f.darshan_mpi,
+    f.nondarshan_mpi,
+    f.darshan_nonmpi,
+    f.nondarshan_nonmpi
+FROM
+    jobs AS j
+LEFT JOIN flags AS f ON f.job_launch_id = j.job_launch_id
+WHERE
+    j.day >= :date_start
+AND j.day < :date_stop
+UNION ALL
+SELECT
+    f.day, NULL, 0, 1, NULL, NULL, NULL, NULL
+FROM
+    flags AS f
+WHERE NOT EXISTS (
+    SELECT 1 FROM jobs AS j
+    WHERE j.job_launch_id = f.job_launch_id
+    AND j.day >= :date_start
+    AND j.day < :date_stop
+)
+"""
+
 def query_mysql( cursor, query_str ):
     return cursor.execute( query_str )
 #   print query_str
@@ -156,6 +423,200 @@ def craft_all_altds_query( date_start, date_stop, include=[], exclude=[] ):
             "date_stop": date_stop.strftime(_DATE_FMT),
         }
 
+def craft_coverage_queries( date_start, date_stop ):
+    """
+    Statements to build the per-job ALTD flags table for the whole date range
+    and then return one row per job and per ALTD-only job.  Returns (create
+    flags table statement, list of coverage queries, drop flags table
+    statement).
+    """
+    dates = {
+        "date_start": date_start.strftime(_DATE_FMT),
+        "date_stop": date_stop.strftime(_DATE_FMT),
+        "flags_table": _FLAGS_TABLE,
+    }
+    dates['altd_flags_query'] = _ALTD_FLAGS_QUERY % dates
+    return ( _CREATE_FLAGS_TABLE % dates,
+             [ _COVERAGE_JOBS_QUERY % dates, _COVERAGE_ALTD_ONLY_QUERY % dates ],
+             "DROP TEMPORARY TABLE IF EXISTS %s" % _FLAGS_TABLE )
+
+def month_starts( date_start, date_stop ):
+    """
+    Return the first day of every month-long bin between two dates
+    """
+    months = []
+    t = date_start
+    while t < date_stop:
+        months.append(t)
+        t += dateutil.relativedelta.relativedelta(months=1)
+    return months
+
+def tally_coverage( rows, months ):
+    """
+    Bin rows of (day, cycles, in db, in altd, darshan_mpi, nondarshan_mpi,
+    darshan_nonmpi, nondarshan_nonmpi) into months and count the jobs and
+    cycles in each coverage bucket.  Returns one dict per month keyed by
+    _COVERAGE_FIELDS.
+    """
+    tallies = []
+    for month in months:
+        tally = dict((x, 0.0 if x.endswith("cycles") else 0) for x in _COVERAGE_FIELDS)
+        tally['start'] = month.strftime(_DATE_FMT)
+        tallies.append(tally)
+
+    for row in rows:
+        day = row[0]
+        if isinstance(day, datetime.datetime):
+            day = day.date()
+        elif not isinstance(day, datetime.date):
+            day = str_to_date(day)
+        index = bisect.bisect_right(months, day) - 1
+        if index < 0:
+            continue
+        tally = tallies[index]
+
+        in_db, in_altd = row[2], row[3]
+        if not in_db:
+            tally['jobs in altd but not db'] += 1
+            continue
+
+        cycles = float(row[1] or 0.0)
+        tally['total jobs'] += 1
+        tally['total cycles'] += cycles
+        if not in_altd:
+            tally['non-altd jobs'] += 1
+            tally['non-altd cycles'] += cycles
+            continue
+
+        tally['altd jobs'] += 1
+        tally['altd cycles'] += cycles
+        for bucket, flag in zip(_FLAG_BUCKETS, row[4:8]):
+            if flag:
+                tally[bucket + ' jobs'] += 1
+                tally[bucket + ' cycles'] += cycles
+
+    return tallies
+
+def print_coverage( tallies ):
+    """
+    Print coverage tallies as CSV
+    """
+    print ','.join(_COVERAGE_FIELDS)
+    for tally in tallies:
+        print ",".join( [ str(tally.get(x, "-")) for x in _COVERAGE_FIELDS ] )
+
+def open_cache( cache_file ):
+    """
+    Open (and create if necessary) the local SQLite cache
+    """
+    cache = sqlite3.connect( cache_file )
+    cache.executescript( _CACHE_SCHEMA )
+    return cache
+
+def _copy_rows( cache, db, table, date_start, date_stop ):
+    """
+    Copy one date range of a table from MySQL into the cache
+    """
+    fetch_query, insert_sql, _, convert = _CACHE_TABLES[table]
+    cursor = db.cursor(MySQLdb.cursors.SSCursor)
+    cursor.execute( fetch_query % {
+        "date_start": date_start.strftime(_DATE_FMT),
+        "date_stop": date_stop.strftime(_DATE_FMT),
+    })
+    while True:
+        rows = cursor.fetchmany( _CACHE_BATCH_SIZE )
+        if not rows:
+            break
+        cache.executemany( insert_sql, [ convert(row) for row in rows ] )
+    cursor.close()
+
+def cached_intervals( cache, table ):
+    """
+    Return the sorted, non-overlapping [start, stop) date intervals of a table
+    that are in the cache
+    """
+    intervals = [ (str_to_date(start), str_to_date(stop)) for start, stop in cache.execute(
+        "SELECT start, stop FROM cache_intervals WHERE name = ?", (table,) ) ]
+    return merge_intervals( intervals )
+
+def merge_intervals( intervals ):
+    """
+    Merge overlapping and adjacent [start, stop) intervals
+    """
+    merged = []
+    for start, stop in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def cache_gaps( cache, table, date_start, date_stop ):
+    """
+    Return the [start, stop) intervals of [date_start, date_stop) that are not
+    in the cache for a table
+    """
+    gaps = []
+    t = date_start
+    for start, stop in cached_intervals( cache, table ):
+        if stop <= t:
+            continue
+        if start >= date_stop:
+            break
+        if start > t:
+            gaps.append((t, start))
+        t = stop
+    if t < date_stop:
+        gaps.append((t, date_stop))
+    return gaps
+
+def refresh_cache( cache, db, date_start, date_stop, tables=('altd_jobs', 'jobs'), today=None ):
+    """
+    Bring the cached tables up to date for [date_start, date_stop) by fetching
+    every part of it that is not covered by the cache yet.  Days from today
+    onward are fetched but not recorded as covered, since they may still be
+    incomplete, so they are fetched again by the next run.
+    """
+    if today is None:
+        today = datetime.date.today()
+
+    for table in tables:
+        date_column = _CACHE_TABLES[table][2]
+        intervals = cached_intervals( cache, table )
+        for gap_start, gap_stop in cache_gaps( cache, table, date_start, date_stop ):
+            ### drop anything left over from an incomplete earlier fetch
+            cache.execute( "DELETE FROM %s WHERE %s >= ? AND %s < ?" % (table, date_column, date_column),
+                           (gap_start.strftime(_DATE_FMT), gap_stop.strftime(_DATE_FMT)) )
+            _copy_rows( cache, db, table, gap_start, gap_stop )
+            if gap_start < min(gap_stop, today):
+                intervals.append((gap_start, min(gap_stop, today)))
+        cache.execute( "DELETE FROM cache_intervals WHERE name = ?", (table,) )
+        cache.executemany( "INSERT INTO cache_intervals VALUES (?, ?, ?)",
+                           [ (table, start.strftime(_DATE_FMT), stop.strftime(_DATE_FMT))
+                             for start, stop in merge_intervals( intervals ) ] )
+
+    ### classify the linklines referenced by any newly cached ALTD records
+    missing = [ row[0] for row in cache.execute(
+        "SELECT DISTINCT linkline_id FROM altd_jobs WHERE linkline_id NOT IN (SELECT linking_inc FROM linklines)" ) ]
+    cursor = db.cursor()
+    for i in range( 0, len(missing), _CACHE_BATCH_SIZE ):
+        cursor.execute( _CACHE_LINKLINES_FETCH_QUERY % {
+            "linkline_ids": ",".join( [ str(x) for x in missing[i:i + _CACHE_BATCH_SIZE] ] )
+        })
+        cache.executemany( "INSERT OR REPLACE INTO linklines VALUES (?, ?, ?)",
+                           [ (int(a), int(b), int(c)) for a, b, c in cursor.fetchall() ] )
+    cursor.close()
+    cache.commit()
+
+def query_cache( cache, date_start, date_stop, query=_CACHE_COVERAGE_QUERY ):
+    """
+    Return the coverage rows of [date_start, date_stop) from the cache
+    """
+    return cache.execute( query, {
+        "date_start": date_start.strftime(_DATE_FMT),
+        "date_stop": date_stop.strftime(_DATE_FMT),
+    })
+
 def str_to_date( date_str ):
     dt = datetime.datetime.strptime( date_str, _DATE_FMT )
     return datetime.date( year=dt.year, month=dt.month, day=dt.day )
@@ -174,14 +635,23 @@ def main():
     parser.add_argument( '--password', '-P', type=str, default=os.environ.get('ALTD_PASSWORD'))
     parser.add_argument( '--db', '-d', type=str, default=os.environ.get('ALTD_DB'))
     parser.add_argument( '--custom', '-c', action='store_true')
+    parser.add_argument( '--single-pass', '-s', action='store_true',
+        help='with --custom, compute all months from one streamed query' )
+    parser.add_argument( '--cache', type=str, default=None,
+        help='SQLite file in which to cache the databases; the analysis runs against it' )
+    parser.add_argument( '--offline', action='store_true',
+        help='with --cache, do not refresh the cache from MySQL' )
     args = parser.parse_args()
     if not (args.startdate and args.stopdate):
         parser.print_help()
         sys.exit(1)
 
+    if args.offline and args.cache is None:
+        parser.error( "--offline requires --cache" )
+
     if args.password is None:
         args.password = ""          ### allow empty passwords
-    if args.host is None or args.user is None or args.password is None or args.db is None:
+    if not args.offline and (args.host is None or args.user is None or args.password is None or args.db is None):
         parser.print_help()
         sys.stderr.write( """
 ALTD host, login username and password, and database name must all be
@@ -193,6 +663,30 @@ specified either through command-line parameters or environment variables
     date_start = str_to_date( args.startdate )
     date_stop = str_to_date( args.stopdate )
 
+    if args.cache is not None:
+        cache = open_cache( args.cache )
+        ### the jobs table is only present in --custom databases
+        tables = ('altd_jobs', 'jobs') if args.custom else ('altd_jobs',)
+        if args.offline:
+            for table in tables:
+                for gap_start, gap_stop in cache_gaps( cache, table, date_start, date_stop ):
+                    sys.stderr.write( "warning: %s is not cached for %s to %s; coverage will be incomplete\n" % (
+                        table, gap_start.strftime(_DATE_FMT), gap_stop.strftime(_DATE_FMT) ) )
+        else:
+            db = MySQLdb.connect(
+                host=args.host,
+                user=args.user,
+                passwd=args.password,
+                db=args.db )
+            refresh_cache( cache, db, date_start, date_stop, tables )
+            db.close()
+        if args.custom:
+            analysis_custom_cache( date_start, date_stop, cache )
+        else:
+            analysis_only_altd_cache( date_start, date_stop, cache )
+        cache.close()
+        return
+
     ### connect to the ALTD database
     db = MySQLdb.connect( 
         host=args.host,
@@ -201,31 +695,34 @@ specified either through command-line parameters or environment variables
         db=args.db )
     cursor = db.cursor()
 
-    if args.custom:
+    if args.custom and args.single_pass:
+        analysis_custom_db_single_pass( date_start, date_stop, db )
+    elif args.custom:
         analysis_custom_db( date_start, date_stop, cursor )
     else:
         analysis_only_altd( date_start, date_stop, cursor )
 
+def analysis_custom_db_single_pass( date_start, date_stop, db ):
+    create_flags, coverage_queries, drop_flags = craft_coverage_queries( date_start, date_stop )
+    cursor = db.cursor()
+    cursor.execute( create_flags )
+
+    def iter_rows():
+        ### stream rows from the server rather than buffering the whole result
+        for query_str in coverage_queries:
+            stream = db.cursor(MySQLdb.cursors.SSCursor)
+            stream.execute( query_str )
+            for row in stream:
+                yield row
+            stream.close()
+
+    print_coverage( tally_coverage( iter_rows(), month_starts( date_start, date_stop ) ) )
+    cursor.execute( drop_flags )
+    cursor.close()
+
 def analysis_custom_db( date_start, date_stop, cursor ):
     ### begin looping over months and calculate coverage
-    field_names = [
-        "start",
-        "total jobs",
-        "altd jobs",
-        "non-altd jobs",
-        "darshan mpi jobs",
-        "non-darshan mpi jobs",
-        "darshan non-mpi jobs",
-        "non-darshan non-mpi jobs",
-        "jobs in altd but not db",
-        "total cycles",
-        "altd cycles",
-        "non-altd cycles",
-        "darshan mpi cycles",
-        "non-darshan mpi cycles",
-        "darshan non-mpi cycles",
-        "non-darshan non-mpi cycles"
-    ]
+    field_names = _COVERAGE_FIELDS
     print ','.join(field_names)
 
     fmt_string = ",".join( [ r'%(' + x + r')s,' for x in field_names ] )
@@ -368,5 +865,30 @@ def analysis_only_altd( date_start, date_stop, cursor ):
 
         t = tf
 
+def analysis_custom_cache( date_start, date_stop, cache ):
+    rows = query_cache( cache, date_start, date_stop )
+    print_coverage( tally_coverage( rows, month_starts( date_start, date_stop ) ) )
+
+def analysis_only_altd_cache( date_start, date_stop, cache ):
+    months = month_starts( date_start, date_stop )
+    with_darshan = [ 0 ] * len(months)
+    without_darshan = [ 0 ] * len(months)
+    query = _CACHE_FLAGS_CTE + "SELECT day, darshan_mpi, nondarshan_mpi FROM flags"
+    for day, darshan_mpi, nondarshan_mpi in query_cache( cache, date_start, date_stop, query ):
+        index = bisect.bisect_right( months, str_to_date( day ) ) - 1
+        if darshan_mpi:
+            with_darshan[index] += 1
+        if nondarshan_mpi:
+            without_darshan[index] += 1
+
+    print "%12s %12s %10s %10s" % ( "start", "end", "w/ darshan", "no darshan" )
+    for index, t0 in enumerate(months):
+        tf = t0 + dateutil.relativedelta.relativedelta(months=1)
+        print "%12s %12s %10ld %10ld" % (
+            t0.strftime(_DATE_FMT),
+            tf.strftime(_DATE_FMT),
+            with_darshan[index],
+            without_darshan[index] )
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+Retrieve arbitrary time ranges of LMT data that span multiple daily h5lmt
+files.
+
+First build an index of the time range and OST names covered by each h5lmt
+file:
+
+    ./h5lmt_query.py index -o h5lmt_index.json /path/to/daily/*/*.h5lmt
+
+Then query a file system over any [start, end) window:
+
+    ./h5lmt_query.py query -i h5lmt_index.json cori_snx11168 \\
+        "2017-02-27 23:50:00" "2017-02-28 00:10:00"
+
+Only the h5lmt files that overlap the window are opened, and only the
+timesteps within the window are read from them.  OSTs are aligned by name
+across files, so a window spanning a day in which OSTs were added is stitched
+into a single (OST, timestep) array with NaNs where an OST did not exist.
+
+Re-running the index command only re-reads files that are new or whose mtime
+has changed.
+"""
+
+import os
+import sys
+import time
+import argparse
+import datetime
+import warnings
+import numpy
+import h5py
+import ioutil
+
+_DATE_FMT = "%Y-%m-%d %H:%M:%S"
+
+_STEPS_DATASET = 'FSStepsGroup/FSStepsDataSet'
+_OST_NAMES_DATASET = 'OSTReadGroup/OSTBulkReadDataSet'
+
+### (OST, timestep) datasets that can be queried
+OST_DATASETS = [
+    'OSTReadGroup/OSTBulkReadDataSet',
+    'OSTWriteGroup/OSTBulkWriteDataSet',
+    'FSMissingGroup/FSMissingDataSet',
+]
+
+def file_system_name(h5lmt_file):
+    """
+    Return the file system name encoded in an h5lmt file name, e.g.,
+    cori_snx11168 for .../2017-02-27/cori_snx11168.h5lmt
+    """
+    return os.path.basename(h5lmt_file).split('.', 1)[0]
+
+def index_h5lmt(h5lmt_file):
+    """
+    Return the index record for a single h5lmt file
+    """
+    with h5py.File(h5lmt_file, 'r') as f:
+        steps = f[_STEPS_DATASET][:]
+        ost_dataset = f[_OST_NAMES_DATASET]
+        if 'OSTNames' in ost_dataset.attrs:
+            ost_names = [ x.decode() if isinstance(x, bytes) else str(x)
+                          for x in ost_dataset.attrs['OSTNames'] ]
+        else:
+            ost_names = [ "%d" % x for x in range(ost_dataset.shape[0]) ]
+
+    deltas = numpy.diff(steps)
+    return {
+        'file_system': file_system_name(h5lmt_file),
+        'mtime': os.path.getmtime(h5lmt_file),
+        'first': int(steps[0]),
+        'last': int(steps[-1]),
+        'num_steps': int(len(steps)),
+        'timestep': int(deltas[0]) if len(deltas) > 0 else 0,
+        'uniform': bool(len(deltas) == 0 or (deltas == deltas[0]).all()),
+        'ost_names': ost_names,
+    }
+
+def load_index(index_file):
+    """
+    Load an index of h5lmt files keyed by absolute path
+    """
+    return ioutil.load_json(index_file)
+
+def save_index(index, index_file):
+    """
+    Atomically write an index of h5lmt files
+    """
+    ioutil.save_json_atomic(index, index_file)
+
+def update_index(index, h5lmt_files):
+    """
+    Add or refresh the index records of h5lmt files that are new or whose
+    mtime has changed.  Returns the number of files that were (re)indexed.
+    """
+    updated = 0
+    for h5lmt_file in h5lmt_files:
+        key = os.path.abspath(h5lmt_file)
+        try:
+            mtime = os.path.getmtime(key)
+            if key in index and index[key]['mtime'] == mtime:
+                continue
+            index[key] = index_h5lmt(key)
+        except (IOError, OSError, KeyError, IndexError) as error:
+            warnings.warn("%s: %s" % (h5lmt_file, error))
+            continue
+        updated += 1
+    return updated
+
+def _step_range(record, h5lmt_file, start, end):
+    """
+    Return the [i0, i1) timestep indices of a file that fall within
+    [start, end)
+    """
+    if record['uniform'] and record['timestep'] > 0:
+        step = record['timestep']
+        i0 = max(0, -(-(start - record['first']) // step))
+        i1 = min(record['num_steps'], -(-(end - record['first']) // step))
+        return i0, i1
+    with h5py.File(h5lmt_file, 'r') as f:
+        steps = f[_STEPS_DATASET][:]
+    return numpy.searchsorted(steps, start), numpy.searchsorted(steps, end)
+
+def query(index, file_system, start, end, datasets=None):
+    """
+    Read the samples of a file system that fall within [start, end), where
+    start and end are epoch seconds, from every indexed h5lmt file that
+    overlaps the window.
+
+    Returns a tuple of
+        1. numpy array of the epoch timestamp of each timestep
+        2. list of OST names corresponding to the rows of each dataset
+        3. dict keyed by dataset name of (OST, timestep) float64 arrays
+    """
+    if datasets is None:
+        datasets = OST_DATASETS
+
+    ### find overlapping files in time order
+    matches = []
+    for h5lmt_file, record in index.items():
+        if record['file_system'] != file_system:
+            continue
+        if record['last'] < start or record['first'] >= end:
+            continue
+        matches.append((record['first'], h5lmt_file, record))
+    matches.sort()
+
+    ### read only the relevant slice of each file
+    pieces = []
+    ost_names = []
+    ost_rows = {}
+    for _, h5lmt_file, record in matches:
+        i0, i1 = _step_range(record, h5lmt_file, start, end)
+        if i1 <= i0:
+            continue
+        for name in record['ost_names']:
+            if name not in ost_rows:
+                ost_rows[name] = len(ost_names)
+                ost_names.append(name)
+        with h5py.File(h5lmt_file, 'r') as f:
+            piece = {
+                'steps': f[_STEPS_DATASET][i0:i1],
+                'rows': [ ost_rows[x] for x in record['ost_names'] ],
+            }
+            for dataset in datasets:
+                piece[dataset] = f[dataset][:, i0:i1]
+        pieces.append(piece)
+
+    ### stitch the slices together, aligning OSTs by name
+    num_steps = sum(len(x['steps']) for x in pieces)
+    timestamps = numpy.zeros(num_steps, dtype=numpy.int64)
+    results = {}
+    for dataset in datasets:
+        results[dataset] = numpy.full((len(ost_names), num_steps), numpy.nan)
+    column = 0
+    for piece in pieces:
+        width = len(piece['steps'])
+        timestamps[column:column + width] = piece['steps']
+        for dataset in datasets:
+            results[dataset][piece['rows'], column:column + width] = piece[dataset]
+        column += width
+
+    return timestamps, ost_names, results
+
+def _to_epoch(date_str):
+    ### local time, like the IOR timestamps used by fbench-ior2hdf5.py --window
+    return int(time.mktime(datetime.datetime.strptime(date_str, _DATE_FMT).timetuple()))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='query LMT data across multiple h5lmt files')
+    subparsers = parser.add_subparsers(dest='command')
+
+    index_parser = subparsers.add_parser('index', help='index h5lmt files')
+    index_parser.add_argument('-o', '--output', type=str, required=True, help='index file to create or update')
+    index_parser.add_argument('files', nargs='+', help='h5lmt files to index')
+
+    query_parser = subparsers.add_parser('query', help='retrieve a time range of data')
+    query_parser.add_argument('-i', '--index', type=str, required=True, help='index file created by the index command')
+    query_parser.add_argument('-d', '--dataset', action='append', default=None,
+                              help='dataset to retrieve; may be repeated (default: %s)' % ', '.join(OST_DATASETS))
+    query_parser.add_argument('--npz', type=str, default=None, help='save the stitched arrays to this .npz file instead of printing')
+    query_parser.add_argument('file_system', type=str, help='file system name, e.g., cori_snx11168')
+    query_parser.add_argument('start', type=str, help='start of window (inclusive, local time) in %s format' % _DATE_FMT.replace('%', '%%'))
+    query_parser.add_argument('end', type=str, help='end of window (exclusive, local time) in %s format' % _DATE_FMT.replace('%', '%%'))
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'index':
+        index = load_index(args.output)
+        updated = update_index(index, args.files)
+        save_index(index, args.output)
+        sys.stderr.write("Indexed %d new or changed files (%d total)\n" % (updated, len(index)))
+        return
+
+    datasets = args.dataset if args.dataset else OST_DATASETS
+    timestamps, ost_names, results = query(load_index(args.index),
+                                           args.file_system,
+                                           _to_epoch(args.start),
+                                           _to_epoch(args.end),
+                                           datasets)
+    if args.npz is not None:
+        arrays = dict((x.replace('/', '_'), y) for x, y in results.items())
+        numpy.savez(args.npz, timestamps=timestamps, ost_names=numpy.array(ost_names), **arrays)
+        return
+
+    ### print the sum over all OSTs of each dataset at each timestep
+    sys.stdout.write("timestamp,%s\n" % ','.join(datasets))
+    for column, timestamp in enumerate(timestamps):
+        sys.stdout.write("%d,%s\n" % (
+            timestamp,
+            ','.join([ "%.2f" % numpy.nansum(results[x][:, column]) for x in datasets ])))
+
+if __name__ == '__main__':
+    main()
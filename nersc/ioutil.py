@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+I/O helpers shared by the h5lmt and Darshan scripts in this directory:
+
+    iter_slabs         chunk-aligned timestep ranges over an (OST, timestep)
+                       h5lmt dataset
+    load_json          load a JSON file, or {} if it does not exist yet
+    save_json_atomic   write a JSON file without ever exposing a partial one
+"""
+
+import os
+import json
+
+### upper bound on the size of each slab read from an OST dataset at once
+SLAB_BYTES = 64 * 2**20
+
+def iter_slabs(dataset, slab_bytes=SLAB_BYTES):
+    """
+    Yield (start, stop) timestep ranges that cover an (OST, timestep) dataset
+    in slabs of at most slab_bytes that are aligned to the dataset's HDF5
+    chunk boundaries
+    """
+    num_osts, num_timesteps = dataset.shape
+    bytes_per_timestep = max(1, num_osts * dataset.dtype.itemsize)
+    if dataset.chunks is not None:
+        chunk_timesteps = dataset.chunks[1]
+    else:
+        chunk_timesteps = 1
+    slab_timesteps = (slab_bytes // bytes_per_timestep) // chunk_timesteps * chunk_timesteps
+    slab_timesteps = max(chunk_timesteps, slab_timesteps)
+    for start in range(0, num_timesteps, slab_timesteps):
+        yield start, min(start + slab_timesteps, num_timesteps)
+
+def load_json(path):
+    """
+    Load a JSON file, returning an empty dict if it does not exist
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+def save_json_atomic(obj, path):
+    """
+    Write obj to a JSON file by way of a temporary file and a rename so that
+    readers and interrupted runs never see a partially written file
+    """
+    temp_file = path + ".tmp"
+    with open(temp_file, 'w') as fp:
+        json.dump(obj, fp)
+    os.rename(temp_file, path)
@@ -2,38 +2,319 @@
 #
 #  basic code to identify missing data in h5lmt and associate it with a timestamp
 #
+#  With --gaps, loads the missing data mask once and prints one line per
+#  contiguous run of missing samples on an OST:
+#
+#    ost start_step end_step start_epoch end_epoch
+#        read_before read_after write_before write_after
+#
+#  where end_step is the last missing timestep and the before/after columns are
+#  the samples adjacent to the gap (-1.0 if the gap touches the edge of the
+#  day).  --interpolate adds the number of bytes read and written during each
+#  gap as estimated by linear interpolation across it.
+#
+#  With --repair OUTDIR, fills in the missing samples of one or more h5lmt files
+#  in parallel and writes complete, gzip-compressed copies of them to
+#  OUTDIR/YYYY-MM-DD/filesystem.h5lmt.  The read/write datasets keep their
+#  original dtype, and every other dataset, group and attribute is copied
+#  as-is except for the missing data mask:
+#
+#    FSMissingGroup/FSMissingDataSet   flags only the samples that are still
+#                                      missing after the repair
+#    FSMissingGroup/FSRepairedDataSet  flags the samples that were filled in
+#
+#  Downstream tools such as summarize_daily_h5lmt_parallel.py read
+#  FSMissingDataSet, so their missing_pct counts only unrepaired gaps.  Two
+#  repair methods are available:
+#
+#    linear  - the traffic during a gap was lost; fill each gap by linear
+#              interpolation between its neighboring samples
+#    counter - the traffic during a gap was accumulated into the first sample
+#              after it; spread that sample evenly over itself and the gap
+#
+#  Samples that a method cannot fill (OSTs with no valid samples for linear,
+#  gaps at the end of the day for counter) are left as they were and reported.
+#
 
+import argparse
+import multiprocessing
+import numpy
 import h5py
 import sys
 import os
 
-filepath = os.path.abspath( sys.argv[1] )
-f = h5py.File( filepath, 'r' )
+def print_missing_samples(f):
+    """
+    Print every missing sample along with its neighboring read values
+    """
+    read_bytes = 0
+    ost_num = 0
+    h5_dataset = f['FSMissingGroup/FSMissingDataSet']
+    for ost_row in h5_dataset:
+        for timestep_num, value in enumerate( ost_row ):
+            if value == 0:
+                continue
 
-read_bytes = 0
-ost_num = 0
-h5_dataset = f['FSMissingGroup/FSMissingDataSet']
-for ost_row in h5_dataset:
-    for timestep_num, value in enumerate( ost_row ):
-        if value == 0:
+            val_after = -1.0
+            val_before= -1.0
+            if timestep_num > 0:
+                val_before= f['OSTReadGroup/OSTBulkReadDataSet'][ost_num,timestep_num-1]
+            if timestep_num+1 < h5_dataset.shape[1]:
+                val_after = f['OSTReadGroup/OSTBulkReadDataSet'][ost_num,timestep_num+1]
+
+            # (57, 17270, 1455177550, 1, 1316454.3999999999, 55705.599999999999, 1344307.2)
+            print "%3d %5d %10d %2d %12.2f %12.2f %12.2f" % (
+                ost_num,
+                timestep_num,
+                f['FSStepsGroup/FSStepsDataSet'][timestep_num],
+                value,
+                val_before,
+                f['OSTReadGroup/OSTBulkReadDataSet'][ost_num,timestep_num],
+                val_after
+            )
+
+        ost_num += 1
+
+def find_gaps(missing):
+    """
+    Find contiguous runs of nonzero values in each row of a 2D (OST, timestep)
+    missing data mask.  Returns three equal-length arrays containing the OST
+    index, first missing timestep, and one past the last missing timestep of
+    each gap, sorted by OST and then by timestep.
+    """
+    num_osts, num_timesteps = missing.shape
+    padded = numpy.zeros((num_osts, num_timesteps + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = (missing != 0)
+    edges = numpy.diff(padded, axis=1)
+    gap_osts, gap_starts = numpy.nonzero(edges == 1)
+    _, gap_stops = numpy.nonzero(edges == -1)
+    return gap_osts, gap_starts, gap_stops
+
+def interpolate_gaps(values, missing):
+    """
+    Replace the missing samples in each row of a 2D (OST, timestep) array by
+    linearly interpolating between the valid samples on either side of each
+    gap.  Gaps at the start or end of a row take the nearest valid value.  Rows
+    with no valid samples are left untouched.  Modifies values in place and
+    returns a boolean mask of the samples filled.
+    """
+    timesteps = numpy.arange(values.shape[1])
+    filled = numpy.zeros(values.shape, dtype=bool)
+    for row in numpy.nonzero(missing.any(axis=1))[0]:
+        row_missing = missing[row] != 0
+        if row_missing.all():
             continue
+        values[row, row_missing] = numpy.interp(timesteps[row_missing],
+                                                timesteps[~row_missing],
+                                                values[row, ~row_missing])
+        filled[row] = row_missing
+    return filled
+
+def spread_counter_gaps(values, missing):
+    """
+    Assume the first valid sample after each gap in a 2D (OST, timestep) array
+    of rates accumulated the traffic of the whole gap, and spread it evenly
+    over itself and the gap so that the total bytes are conserved.  Gaps at
+    the end of a row are left untouched.  Modifies values in place and returns
+    a boolean mask of the samples filled.
+    """
+    gap_osts, gap_starts, gap_stops = find_gaps(missing)
+    has_after = gap_stops < values.shape[1]
+    filled = numpy.zeros(values.shape, dtype=bool)
+    for ost, start, stop in zip(gap_osts[has_after], gap_starts[has_after], gap_stops[has_after]):
+        values[ost, start:stop + 1] = values[ost, stop] / (stop + 1 - start)
+        filled[ost, start:stop] = True
+    return filled
+
+_REPAIR_FUNCTIONS = {
+    'linear': interpolate_gaps,
+    'counter': spread_counter_gaps,
+}
+
+_REPAIR_DATASETS = [
+    'OSTReadGroup/OSTBulkReadDataSet',
+    'OSTWriteGroup/OSTBulkWriteDataSet',
+]
+
+_MISSING_DATASET = 'FSMissingGroup/FSMissingDataSet'
+
+_REPAIRED_DATASET = 'FSMissingGroup/FSRepairedDataSet'
+
+def _copy_attrs(src, dest):
+    for key, value in src.attrs.items():
+        dest.attrs[key] = value
+
+def _create_dataset(f_out, name, values):
+    """
+    Create a gzip-compressed dataset, chunked by blocks of timesteps if it is
+    an (OST, timestep) array
+    """
+    kwargs = {}
+    if values.ndim > 0 and values.size > 0:
+        kwargs = { 'compression': 'gzip', 'compression_opts': 1, 'shuffle': True }
+    if values.ndim == 2 and values.size > 0:
+        kwargs['chunks'] = (values.shape[0], max(1, min(values.shape[1], 1024)))
+    return f_out.create_dataset(name, data=values, **kwargs)
+
+def repair_h5lmt(job):
+    """
+    Repair the missing samples of one h5lmt file and write a new compressed
+    copy of the whole file.  job is a (src, dest, method) tuple.  Returns
+    (src, number of samples repaired, number of missing samples left
+    unrepaired, error message or None).
+    """
+    src, dest, method = job
+    try:
+        dest_dir = os.path.dirname(dest)
+        if dest_dir and not os.path.isdir(dest_dir):
+            try:
+                os.makedirs(dest_dir)
+            except OSError:
+                ### another worker may have created it
+                if not os.path.isdir(dest_dir):
+                    raise
+        with h5py.File(src, 'r') as f_in, h5py.File(dest, 'w') as f_out:
+            missing = f_in[_MISSING_DATASET][:, :]
+
+            ### repair both datasets before copying anything so that the
+            ### missing data mask can be cleared where both were filled
+            replaced = {}
+            filled = missing != 0
+            for name in _REPAIR_DATASETS:
+                values = f_in[name][...]
+                repaired = values.astype(numpy.float64)
+                filled &= _REPAIR_FUNCTIONS[method](repaired, missing)
+                if numpy.issubdtype(values.dtype, numpy.integer):
+                    repaired = numpy.rint(repaired)
+                replaced[name] = repaired.astype(values.dtype)
+            replaced[_MISSING_DATASET] = numpy.where(filled, 0, missing).astype(missing.dtype)
+
+            def copy_object(name, obj):
+                if isinstance(obj, h5py.Group):
+                    _copy_attrs(obj, f_out.require_group(name))
+                    return
+                if name == _REPAIRED_DATASET:
+                    ### merged into the new repaired mask below
+                    return
+                values = replaced[name] if name in replaced else obj[...]
+                out = _create_dataset(f_out, name, values)
+                _copy_attrs(obj, out)
+                if name in replaced:
+                    out.attrs['repair_method'] = method
+
+            f_in.visititems(copy_object)
+            _copy_attrs(f_in, f_out)
+            repaired_mask = filled
+            if _REPAIRED_DATASET in f_in:
+                repaired_mask = repaired_mask | (f_in[_REPAIRED_DATASET][:, :] != 0)
+            out = _create_dataset(f_out, _REPAIRED_DATASET, repaired_mask.astype(missing.dtype))
+            out.attrs['repair_method'] = method
+        num_repaired = int(filled.sum())
+        num_left = int((replaced[_MISSING_DATASET] != 0).sum())
+        return src, num_repaired, num_left, None
+    except (IOError, KeyError, ValueError, OSError) as error:
+        return src, 0, 0, str(error)
+
+def repair_files(h5lmt_files, output_dir, method, threads):
+    """
+    Repair many h5lmt files in parallel.  Each output file is written to
+    output_dir/<name of the input file's parent directory>/<input file name>
+    """
+    jobs = []
+    for h5lmt_file in h5lmt_files:
+        filepath = os.path.abspath(h5lmt_file)
+        date_str, fs_str = filepath.split(os.sep)[-2:]
+        jobs.append((filepath, os.path.join(output_dir, date_str, fs_str), method))
+
+    pool = multiprocessing.Pool(threads)
+    failures = 0
+    for src, num_repaired, num_left, error in pool.imap_unordered(repair_h5lmt, jobs):
+        if error is None:
+            print "%s: repaired %d samples" % (src, num_repaired)
+            if num_left > 0:
+                sys.stderr.write("%s: warning: %d missing samples could not be repaired by %s\n"
+                                 % (src, num_left, method))
+        else:
+            sys.stderr.write("%s: %s\n" % (src, error))
+            failures += 1
+    pool.close()
+    pool.join()
+    return failures
+
+def neighbors(values, gap_rows, gap_starts, gap_stops):
+    """
+    Return the values immediately before and after each gap, or -1.0 where a
+    gap touches the start or end of a row
+    """
+    num_timesteps = values.shape[1]
+    before = numpy.full(len(gap_starts), -1.0)
+    after = numpy.full(len(gap_starts), -1.0)
+    has_before = gap_starts > 0
+    has_after = gap_stops < num_timesteps
+    before[has_before] = values[gap_rows[has_before], gap_starts[has_before] - 1]
+    after[has_after] = values[gap_rows[has_after], gap_stops[has_after]]
+    return before, after
+
+def print_gaps(f, interpolate=False):
+    """
+    Print one line per contiguous gap in an h5lmt file's missing data
+    """
+    missing = f['FSMissingGroup/FSMissingDataSet'][:, :]
+    steps = f['FSStepsGroup/FSStepsDataSet'][:]
+    gap_osts, gap_starts, gap_stops = find_gaps(missing)
+    if len(gap_osts) == 0:
+        return
+
+    ### only read the rows of OSTs that actually have gaps
+    osts = numpy.unique(gap_osts)
+    gap_rows = numpy.searchsorted(osts, gap_osts)
+    neighbor_columns = []
+    fill_columns = []
+    for dataset in 'OSTReadGroup/OSTBulkReadDataSet', 'OSTWriteGroup/OSTBulkWriteDataSet':
+        values = f[dataset][list(osts), :].astype(numpy.float64)
+        before, after = neighbors(values, gap_rows, gap_starts, gap_stops)
+        neighbor_columns += [ before, after ]
+        if interpolate:
+            timestep = float(numpy.median(numpy.diff(steps)))
+            interpolate_gaps(values, missing[osts, :])
+            cumulative = numpy.zeros((values.shape[0], values.shape[1] + 1))
+            cumulative[:, 1:] = numpy.cumsum(values, axis=1)
+            filled = cumulative[gap_rows, gap_stops] - cumulative[gap_rows, gap_starts]
+            fill_columns.append(filled * timestep)
+
+    print "# ost start_step end_step start_epoch end_epoch read_before read_after write_before write_after%s" % (
+        " read_fill_bytes write_fill_bytes" if interpolate else "")
+    for index in range(len(gap_osts)):
+        line = "%3d %5d %5d %10d %10d" % (
+            gap_osts[index],
+            gap_starts[index],
+            gap_stops[index] - 1,
+            steps[gap_starts[index]],
+            steps[gap_stops[index] - 1])
+        values = [ column[index] for column in neighbor_columns + fill_columns ]
+        print line + ''.join([ " %12.2f" % x for x in values ])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='report missing data in an h5lmt file')
+    parser.add_argument('file', type=str, nargs='+', help='h5lmt file(s) to process; only --repair accepts more than one')
+    parser.add_argument('-g', '--gaps', action='store_true', help='print a table of contiguous gaps instead of every missing sample')
+    parser.add_argument('-i', '--interpolate', action='store_true', help='with --gaps, estimate bytes moved during each gap by linear interpolation')
+    parser.add_argument('-r', '--repair', type=str, default=None, metavar='OUTDIR', help='write repaired copies of the input files into OUTDIR')
+    parser.add_argument('-m', '--method', type=str, default='linear', choices=sorted(_REPAIR_FUNCTIONS.keys()), help='repair method (default: linear)')
+    parser.add_argument('-t', '--threads', type=int, default=8, help='number of files to repair concurrently')
+    args = parser.parse_args()
+
+    if args.repair is not None:
+        if repair_files(args.file, args.repair, args.method, args.threads) > 0:
+            sys.exit(1)
+        sys.exit(0)
+    elif len(args.file) > 1:
+        parser.error("only --repair accepts more than one file")
+
+    filepath = os.path.abspath( args.file[0] )
+    f = h5py.File( filepath, 'r' )
 
-        val_after = -1.0
-        val_before= -1.0
-        if timestep_num > 0:
-            val_before= f['OSTReadGroup/OSTBulkReadDataSet'][ost_num,timestep_num-1]
-        if timestep_num+1 < h5_dataset.shape[1]:
-            val_after = f['OSTReadGroup/OSTBulkReadDataSet'][ost_num,timestep_num+1]
-
-        # (57, 17270, 1455177550, 1, 1316454.3999999999, 55705.599999999999, 1344307.2)
-        print "%3d %5d %10d %2d %12.2f %12.2f %12.2f" % ( 
-            ost_num, 
-            timestep_num,
-            f['FSStepsGroup/FSStepsDataSet'][timestep_num],
-            value,
-            val_before,
-            f['OSTReadGroup/OSTBulkReadDataSet'][ost_num,timestep_num],
-            val_after
-        )
-
-    ost_num += 1
+    if args.gaps:
+        print_gaps(f, interpolate=args.interpolate)
+    else:
+        print_missing_samples(f)
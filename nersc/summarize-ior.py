@@ -5,25 +5,40 @@ Syntax:
 
     ./summarize-ior.py <ior-stdout.0> [ior-stdout.1 [...]]
 
+Use --parquet or --csv to instead save every run_summary row of every input
+file, with the input_summary fields of its run, as a single table.  The
+abbreviated "Max Write:"/"Max Read:" lines are not included.
+
 Relies on the hpcparse Python package available at
 
     https://www.github.com/glennklockwood/atgtools
 """
-import sys
 import json
+import argparse
 import hpcparse.ior
 
 if __name__ == '__main__':
-    input_files = sys.argv[1:]
-    jobs_table = {}
-    for input_file in input_files:
-        raw_data = hpcparse.ior.parse(open(input_file, 'r'))
-        for i in raw_data['run_summary']:
-            run_key = "%d-%d" % (raw_data['input_summary']['nodes'], raw_data['input_summary']['ppn'])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--processes", type=int, default=None, help="number of parsing processes; 1 parses in-process (default: one per CPU)")
+    parser.add_argument("--parquet", type=str, default=None, help="save all runs as a Parquet table to this file")
+    parser.add_argument("--csv", type=str, default=None, help="save all runs as a CSV table to this file")
+    parser.add_argument("files", nargs='+', help="IOR outputs to process")
+    args = parser.parse_args()
+
+    rows = hpcparse.ior.parse_files(args.files, processes=args.processes)
+
+    if args.parquet is not None or args.csv is not None:
+        dataframe = hpcparse.ior.to_dataframe(rows)
+        if args.parquet is not None:
+            dataframe.to_parquet(args.parquet)
+        if args.csv is not None:
+            dataframe.to_csv(args.csv, index=False)
+    else:
+        jobs_table = {}
+        for row in rows:
+            run_key = "%d-%d" % (row['nodes'], row['ppn'])
             if run_key not in jobs_table:
                 jobs_table[run_key] = {}
-            for run_record in raw_data['run_summary']:
-                op_key = run_record['operation']
-                jobs_table[run_key][op_key] = run_record['avg_mibs']
+            jobs_table[run_key][row['operation']] = row['avg_mibs']
 
-    print json.dumps(jobs_table, indent=4, sort_keys=True)
+        print json.dumps(jobs_table, indent=4, sort_keys=True)
@@ -4,24 +4,45 @@ Scrape large numbers of h5lmt files to determine how much data was read and
 written to Lustre over the lifetime of a file system.
 """
 
+import os
 import sys
 import json
 import argparse
 import datetime
 import warnings
 import multiprocessing
+import numpy
+import pandas
 import h5py
+import ioutil
 
 BYTES_TO_GIBS = 2.0**-30
 
+### save the summary store after this many newly summarized files
+STORE_SAVE_INTERVAL = 100
+
+### minimum number of seconds between progress updates
+PROGRESS_INTERVAL = 1.0
+
 METADATA_OPS = [ 'open', 'close', 'getattr', 'rename', 'unlink', 'rmdir', 'link' ]
-RW_ADD_KEYS = [ 'read_gibs', 'write_gibs', 'missing_pct' ]
+RW_ADD_KEYS = [ 'read_gibs', 'write_gibs' ]
+RW_MAX_KEYS = [ 'peak_read_gibs', 'peak_write_gibs', 'worst_ost_missing_pct' ]
+RW_COUNT_KEYS = [ 'missing_samples', 'total_samples' ]
+
+### metrics that are recalculated from summed numerators and denominators
+### after reduction
+RW_RATIO_KEYS = {
+    'missing_pct': ('missing_samples', 'total_samples'),
+}
 
 HEADER_KEYS = {
     'date': 'Date',
     'read_gibs': 'GiB Read',
     'write_gibs': 'GiB Write',
     'missing_pct': "% Missing",
+    'peak_read_gibs': "Pk Rd GiB/s",
+    'peak_write_gibs': "Pk Wr GiB/s",
+    'worst_ost_missing_pct': "Worst OST %",
     'open': "open",
     'close': "close",
     'getattr': 'stat',
@@ -32,26 +53,55 @@ HEADER_KEYS = {
 }
 
 
+def reduce_h5lmt_rw(f, slab_bytes=ioutil.SLAB_BYTES):
+    """
+    Make a single pass over the read, write, and missing datasets of an open
+    h5lmt file one slab at a time and return the per-timestep aggregate read
+    and write rates (bytes/sec summed over all OSTs) along with the number of
+    missing and total samples overall and per OST
+    """
+    read_dset = f['/OSTReadGroup/OSTBulkReadDataSet']
+    write_dset = f['/OSTWriteGroup/OSTBulkWriteDataSet']
+    missing_dset = f['/FSMissingGroup/FSMissingDataSet']
+
+    num_timesteps = read_dset.shape[1]
+    result = {
+        'read_rates': numpy.zeros(num_timesteps),
+        'write_rates': numpy.zeros(num_timesteps),
+        'ost_missing_samples': numpy.zeros(missing_dset.shape[0], dtype=numpy.int64),
+        'timesteps': missing_dset.shape[1],
+    }
+    for start, stop in ioutil.iter_slabs(read_dset, slab_bytes):
+        result['read_rates'][start:stop] = read_dset[:, start:stop].sum(axis=0)
+        result['write_rates'][start:stop] = write_dset[:, start:stop].sum(axis=0)
+        result['ost_missing_samples'] += missing_dset[:, start:stop].sum(axis=1).astype(numpy.int64)
+    result['missing_samples'] = int(result['ost_missing_samples'].sum())
+    result['total_samples'] = result['ost_missing_samples'].shape[0] * result['timesteps']
+    return result
+
 def summarize_h5lmt_rw(h5lmt_file):
-    sys.stderr.write("Processing %s\n" % h5lmt_file)
     try:
-        f = h5py.File(h5lmt_file, 'r')
-        timestep = f['/FSStepsGroup/FSStepsDataSet'][1] - f['/FSStepsGroup/FSStepsDataSet'][0]
-        date = f['/FSStepsGroup/FSStepsDataSet'].attrs['day']
+        with h5py.File(h5lmt_file, 'r') as f:
+            timestep = f['/FSStepsGroup/FSStepsDataSet'][1] - f['/FSStepsGroup/FSStepsDataSet'][0]
+            date = f['/FSStepsGroup/FSStepsDataSet'].attrs['day']
+            reduced = reduce_h5lmt_rw(f)
         return {
             'date': date,
             'datetime_date': datetime.datetime.strptime(date, "%Y-%m-%d"),
-            'read_gibs': f['/OSTReadGroup/OSTBulkReadDataSet'][:,:].sum() * timestep * BYTES_TO_GIBS,
-
-            'write_gibs': f['/OSTWriteGroup/OSTBulkWriteDataSet'][:,:].sum() * timestep * BYTES_TO_GIBS,
-            'missing_pct': float(f['/FSMissingGroup/FSMissingDataSet'][:,:].sum()) / (f['/FSMissingGroup/FSMissingDataSet'].shape[0]*f['/FSMissingGroup/FSMissingDataSet'].shape[1]),
+            'read_gibs': reduced['read_rates'].sum() * timestep * BYTES_TO_GIBS,
+            'write_gibs': reduced['write_rates'].sum() * timestep * BYTES_TO_GIBS,
+            'missing_pct': float(reduced['missing_samples']) / reduced['total_samples'],
+            'missing_samples': reduced['missing_samples'],
+            'total_samples': reduced['total_samples'],
+            'worst_ost_missing_pct': float(reduced['ost_missing_samples'].max()) / reduced['timesteps'],
+            'peak_read_gibs': reduced['read_rates'].max() * BYTES_TO_GIBS,
+            'peak_write_gibs': reduced['write_rates'].max() * BYTES_TO_GIBS,
         }
     except (IOError, KeyError, ValueError) as error:
         warnings.warn("%s: %s" % (h5lmt_file, error))
         return {}
 
 def summarize_h5lmt_metadata(h5lmt_file):
-    sys.stderr.write("Processing %s\n" % h5lmt_file)
     try:
         f = h5py.File(h5lmt_file, 'r')
         timestep = f['/FSStepsGroup/FSStepsDataSet'][1] - f['/FSStepsGroup/FSStepsDataSet'][0]
@@ -68,6 +118,249 @@ def summarize_h5lmt_metadata(h5lmt_file):
         warnings.warn("%s: %s" % (h5lmt_file, error))
         return {}
 
+### state inherited by each worker process from init_worker()
+_WORKER_STATE = {}
+
+def init_worker(shared_records, record_fields, process_function):
+    """
+    Give a worker process access to the shared-memory record array
+    """
+    _WORKER_STATE['records'] = shared_records
+    _WORKER_STATE['fields'] = record_fields
+    _WORKER_STATE['function'] = process_function
+
+def summarize_into_shared(indexed_file):
+    """
+    Summarize one h5lmt file and write its summary into its fixed-width slot
+    of the shared record array rather than returning it to the parent.  The
+    first field of each record is the date's proleptic Gregorian ordinal, or
+    NaN if the file could not be summarized.  Returns the slot index.
+    """
+    index, h5lmt_file = indexed_file
+    records = _WORKER_STATE['records']
+    fields = _WORKER_STATE['fields']
+    result = _WORKER_STATE['function'](h5lmt_file)
+
+    offset = index * (len(fields) + 1)
+    if 'datetime_date' in result:
+        records[offset] = result['datetime_date'].toordinal()
+        for field_index, field in enumerate(fields):
+            records[offset + 1 + field_index] = result[field]
+    else:
+        records[offset] = float('nan')
+    return index
+
+def iter_shared_records(h5lmt_files, process_function, record_fields, threads):
+    """
+    Summarize h5lmt files across a pool of worker processes that write their
+    numeric results into a shared-memory array of fixed-width records, so
+    that nothing but an index is pickled per file.  Yields (index, records)
+    in the order in which files finish, where records is a numpy view of
+    shape (len(h5lmt_files), len(record_fields) + 1) over the shared array.
+    Progress is reported on stderr.
+    """
+    num_files = len(h5lmt_files)
+    if num_files == 0:
+        return
+    record_width = len(record_fields) + 1
+    shared_records = multiprocessing.RawArray('d', num_files * record_width)
+    records = numpy.ctypeslib.as_array(shared_records).reshape(num_files, record_width)
+    pool = multiprocessing.Pool(threads,
+                                initializer=init_worker,
+                                initargs=(shared_records, record_fields, process_function))
+
+    t0 = datetime.datetime.now()
+    last_report = 0.0
+    chunksize = max(1, min(64, num_files // (threads * 4)))
+    try:
+        for count, index in enumerate(pool.imap_unordered(summarize_into_shared,
+                                                          enumerate(h5lmt_files),
+                                                          chunksize)):
+            ### report progress at most once per PROGRESS_INTERVAL seconds
+            elapsed = (datetime.datetime.now() - t0).total_seconds()
+            if elapsed - last_report >= PROGRESS_INTERVAL or count + 1 == num_files:
+                last_report = elapsed
+                sys.stderr.write("\rSummarized %d of %d files (%.1f files/sec)" % (
+                    count + 1,
+                    num_files,
+                    (count + 1) / elapsed if elapsed > 0.0 else 0.0))
+            yield index, records
+    finally:
+        sys.stderr.write("\n")
+        pool.close()
+        pool.join()
+
+def summarize_records(h5lmt_files, process_function, record_fields, threads):
+    """
+    Summarize h5lmt files into an array of records as described in
+    iter_shared_records() without materializing a summary per file
+    """
+    records = numpy.zeros((0, len(record_fields) + 1))
+    for _, records in iter_shared_records(h5lmt_files, process_function, record_fields, threads):
+        pass
+    return records
+
+def record_to_summary(record, record_fields):
+    """
+    Convert one record of a shared record array back into a summary dict, or
+    an empty dict if its file could not be summarized
+    """
+    date_ordinal = record[0]
+    if date_ordinal != date_ordinal: # NaN means failure
+        return {}
+    datetime_date = datetime.datetime.fromordinal(int(date_ordinal))
+    result = {
+        'date': datetime_date.strftime("%Y-%m-%d"),
+        'datetime_date': datetime_date,
+    }
+    for field_index, field in enumerate(record_fields):
+        result[field] = record[1 + field_index]
+    for field in RW_COUNT_KEYS:
+        if field in result:
+            result[field] = int(result[field])
+    return result
+
+def summaries_to_records(results, record_fields):
+    """
+    Convert summary dicts into an array of records as described in
+    iter_shared_records()
+    """
+    records = numpy.full((len(results), len(record_fields) + 1), numpy.nan)
+    for index, result in enumerate(results):
+        if 'datetime_date' in result:
+            records[index, 0] = result['datetime_date'].toordinal()
+            for field_index, field in enumerate(record_fields):
+                records[index, 1 + field_index] = result[field]
+    return records
+
+def iter_summaries(h5lmt_files, process_function, record_fields, threads):
+    """
+    Summarize h5lmt files across a pool of worker processes and yield
+    (h5lmt_file, summary) tuples in the order in which they finish.  Summaries
+    of files that could not be processed are empty dicts.
+    """
+    for index, records in iter_shared_records(h5lmt_files, process_function, record_fields, threads):
+        yield h5lmt_files[index], record_to_summary(records[index], record_fields)
+
+def load_store(store_file):
+    """
+    Load the persistent per-file summary store.  The store maps a summary mode
+    (rw or metadata) to a dict keyed by absolute h5lmt path whose values
+    contain the file's mtime and its summary (without datetime_date).
+    """
+    return ioutil.load_json(store_file)
+
+def save_store(store, store_file):
+    """
+    Atomically write the per-file summary store
+    """
+    ioutil.save_json_atomic(store, store_file)
+
+def update_store(store_root, mode, store_file, h5lmt_files, process_function, record_fields, threads, required_keys=()):
+    """
+    Summarize only those h5lmt files that are missing from the store's mode
+    section, whose mtime has changed since they were summarized, or whose
+    stored summary lacks any of required_keys, saving the store periodically
+    so that an interrupted run can resume where it left off.  Returns the list
+    of summaries for all h5lmt_files.
+    """
+    if mode not in store_root:
+        store_root[mode] = {}
+    store = store_root[mode]
+
+    mtimes = {}
+    stale_files = []
+    for h5lmt_file in h5lmt_files:
+        key = os.path.abspath(h5lmt_file)
+        try:
+            mtimes[key] = os.path.getmtime(h5lmt_file)
+        except OSError as error:
+            warnings.warn("%s: %s" % (h5lmt_file, error))
+            continue
+        record = store.get(key)
+        if record is None \
+        or record['mtime'] != mtimes[key] \
+        or not all(x in record['summary'] for x in required_keys):
+            stale_files.append(h5lmt_file)
+
+    summaries = iter_summaries(stale_files, process_function, record_fields, threads)
+    for index, (h5lmt_file, result) in enumerate(summaries):
+        ### failed files are not recorded so that they are retried next time
+        if 'datetime_date' in result:
+            key = os.path.abspath(h5lmt_file)
+            summary = dict((x, y) for x, y in result.items() if x != 'datetime_date')
+            store[key] = { 'mtime': mtimes[key], 'summary': summary }
+        if (index + 1) % STORE_SAVE_INTERVAL == 0:
+            save_store(store_root, store_file)
+    if stale_files:
+        save_store(store_root, store_file)
+
+    results = []
+    for key in mtimes:
+        if key in store:
+            result = dict(store[key]['summary'])
+            result['datetime_date'] = datetime.datetime.strptime(result['date'], "%Y-%m-%d")
+            results.append(result)
+    return results
+
+def reduction_key(date, reduce_on):
+    """
+    Return the key of the date, week, month, or year (or 'all' for a single
+    grand total) into which a datetime.date is reduced
+    """
+    if reduce_on == 'week':
+        ### Monday of each date's week
+        return (date - datetime.timedelta(days=date.weekday())).strftime("%Y-%m-%d")
+    elif reduce_on == 'month':
+        return date.strftime("%Y-%m")
+    elif reduce_on == 'date':
+        return date.strftime("%Y-%m-%d")
+    elif reduce_on == 'year':
+        return date.strftime("%Y")
+    elif reduce_on == 'all':
+        return "summary"
+    raise Exception("reduce_on must be week|month|date|year")
+
+def reduce_records(records, record_fields, reduce_on, add_keys, max_keys=(), ratio_keys=None):
+    """
+    Reduce an array of per-file records (see iter_shared_records) by date,
+    week, month, or year (or 'all' for a single grand total) directly with
+    numpy.  add_keys are summed, max_keys take their maximum, and ratio_keys
+    are recalculated from their summed numerators and denominators so they
+    remain exact weighted fractions.  Returns a DataFrame indexed by reduction
+    key with one column per metric plus 'n', the number of files reduced into
+    each row.
+    """
+    if ratio_keys is None:
+        ratio_keys = {}
+    records = records[records[:, 0] == records[:, 0]]
+    if len(records) == 0:
+        return pandas.DataFrame()
+
+    ### only the distinct dates need to be converted into reduction keys
+    ordinals, date_index = numpy.unique(records[:, 0].astype(numpy.int64), return_inverse=True)
+    date_keys = [ reduction_key(datetime.date.fromordinal(int(x)), reduce_on) for x in ordinals ]
+    keys, key_index = numpy.unique(date_keys, return_inverse=True)
+    groups = key_index[date_index]
+
+    reduced = pandas.DataFrame(index=[ str(x) for x in keys ])
+    reduced['n'] = numpy.bincount(groups, minlength=len(keys))
+    for metric in add_keys:
+        column = records[:, 1 + record_fields.index(metric)]
+        reduced[metric] = numpy.bincount(groups, weights=column, minlength=len(keys))
+        if metric in RW_COUNT_KEYS:
+            reduced[metric] = reduced[metric].astype(numpy.int64)
+    for metric in max_keys:
+        column = records[:, 1 + record_fields.index(metric)]
+        maxima = numpy.full(len(keys), -numpy.inf)
+        numpy.maximum.at(maxima, groups, column)
+        reduced[metric] = maxima
+
+    for metric, (numerator, denominator) in ratio_keys.items():
+        reduced[metric] = reduced[numerator].astype(float) / reduced[denominator]
+    reduced['date'] = reduced.index
+    return reduced
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='aggregate bytes in/out from h5lmt')
     parser.add_argument('file', type=str, nargs='+', help='h5lmt file(s) to process')
@@ -76,77 +369,60 @@ if __name__ == "__main__":
     parser.add_argument('-j', '--json', action='store_true', help='output in json instead of a text table')
     parser.add_argument('--reduce-on', type=str, default='date', help='reduce on (date|week|month|year)')
     parser.add_argument('-s', '--summary', action='store_true', help='print final summary of totals')
+    parser.add_argument('--store', type=str, default=None, help='persistent per-file summary store; only new or changed files are processed')
     args = parser.parse_args()
 
     if args.metadata:
         process_function = summarize_h5lmt_metadata
         metrics = METADATA_OPS
+        add_metrics = METADATA_OPS
+        max_metrics = []
+        ratio_metrics = {}
     else:
         process_function = summarize_h5lmt_rw
-        metrics = RW_ADD_KEYS
+        metrics = RW_ADD_KEYS + list(RW_RATIO_KEYS.keys()) + RW_MAX_KEYS
+        add_metrics = RW_ADD_KEYS + RW_COUNT_KEYS
+        max_metrics = RW_MAX_KEYS
+        ratio_metrics = RW_RATIO_KEYS
 
-    pool = multiprocessing.Pool(args.threads)
-    results = pool.map(process_function, args.file)
+    record_fields = sorted(set(metrics + add_metrics + max_metrics))
+    if args.store is not None:
+        results = update_store(load_store(args.store),
+                               'metadata' if args.metadata else 'rw',
+                               args.store,
+                               args.file,
+                               process_function,
+                               record_fields,
+                               args.threads,
+                               required_keys=add_metrics + max_metrics)
+        records = summaries_to_records(results, record_fields)
+    else:
+        records = summarize_records(args.file, process_function, record_fields, args.threads)
 
-    ### results contains one record per h5lmt file; now reduce based on day,
+    ### records contains one row per h5lmt file; now reduce based on day,
     ### week, month, etc
-    reduced_results = {}
-    for result in results:
-        if 'datetime_date' not in result:
-            continue
-        if args.reduce_on == 'week':
-            key = datetime.datetime.strptime(result['datetime_date'].strftime("%Y %W 1"), "%Y %W %w").strftime("%Y-%m-%d")
-        elif args.reduce_on == 'month':
-            key = result['datetime_date'].strftime("%Y-%m")
-        elif args.reduce_on == 'date':
-            key = result['datetime_date'].strftime("%Y-%m-%d")
-        elif args.reduce_on == 'year':
-            key = result['datetime_date'].strftime("%Y")
-        else:
-            raise Exception("reduce_on must be week|month|date|year")
-        if key not in reduced_results:
-            reduced_results[key] = { 'n': 0, }
-            for metric in metrics:
-                reduced_results[key][metric] = 0.0
-        reduced_results[key]['n'] += 1
-        reduced_results[key]['date'] = str(key)
-        for metric in metrics:
-            reduced_results[key][metric] += result[metric]
+    reduced_results = reduce_records(records, record_fields, args.reduce_on, add_metrics, max_metrics, ratio_metrics)
 
     if args.json:
-        print json.dumps(reduced_results, indent=4, sort_keys=True)
+        json_results = {}
+        for key, row in reduced_results.iterrows():
+            json_results[key] = dict((x, row[x]) for x in ['n', 'date'] + metrics + add_metrics)
+            json_results[key]['n'] = int(json_results[key]['n'])
+        print json.dumps(json_results, indent=4, sort_keys=True)
     else:
         ### Print column header
         header_str = "%(date)10s"
+        print_str = "%(date)10s"
         for metric in metrics:
             header_str += " %%(%s)12s" % metric
+            print_str += " %%(%s)12.2f" % metric
         print header_str % HEADER_KEYS
 
         ### Print data
-        missing_pct_bogus = False
-        metric_totals = {}
-        last_print_str = ""
-        for key in sorted(reduced_results.keys()):
-            result = reduced_results[key]
-            if result['n'] > 1:
-                missing_pct_bogus = True
-            print_str = "%(date)10s"
-            for metric in metrics:
-                print_str += " %%(%s)12.2f" % metric
-                ### calculate summary of each metric
-                if metric not in metric_totals:
-                    metric_totals[metric] = 0.0
-                metric_totals[metric] += result[metric]
-            print print_str % result
-            last_print_str = print_str
-
-        if args.summary:
-            metric_totals['date'] = "summary"
-            print
-            print last_print_str % metric_totals
+        for key in sorted(reduced_results.index):
+            print print_str % reduced_results.loc[key].to_dict()
 
-        ### The logic to recalculate missing data percentages based on reduced data
-        ### isn't included, so just throw a warning if reduction corrupted the
-        ### meaning of this field
-        if not args.metadata and missing_pct_bogus:
-            warnings.warn("Reduced one or more days' outputs; missing_pct is no longer a percent")
+        if args.summary and len(reduced_results) > 0:
+            summary = reduce_records(records, record_fields, 'all', add_metrics, max_metrics, ratio_metrics)
+            print
+            print print_str % summary.loc['summary'].to_dict()
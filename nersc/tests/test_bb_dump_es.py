@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Check that a sliced dump by bb_dump_es.py retrieves every document exactly
+once and writes each slice to its own series of bundles.  ElasticSearch is
+stood in for by a fake module that serves a fixed set of documents through
+sliced scrolls.
+"""
+
+import os
+import re
+import sys
+import json
+import gzip
+import types
+import shutil
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+NUM_DOCS = 2345
+
+PAGE_SIZE = 100
+
+### 2017-01-01 00:00:00 UTC in epoch milliseconds
+_TIME_START = 1483228800000
+
+def make_hit(doc_id):
+    time_ms = _TIME_START + 1000 * (doc_id // 3)
+    return {
+        '_id': "doc%05d" % doc_id,
+        '_source': {
+            '@timestamp': time_ms,
+            'hostname': "bb%02d" % (doc_id % 7),
+            'plugin': 'disk',
+            'value': float(doc_id),
+        },
+        'sort': [ time_ms ],
+    }
+
+class ScrollError(Exception):
+    pass
+
+class FakeElasticsearch(object):
+    """
+    Serve NUM_DOCS documents, sorted by time, through optionally sliced
+    scrolls.  A document belongs to slice doc_id % max.  The gte bound (in
+    epoch seconds) of a @timestamp range filter is honored.  If fail_after
+    is given, that scroll call raises ScrollError.
+    """
+    def __init__(self, hosts=None, fail_after=None):
+        self.hosts = hosts
+        self.fail_after = fail_after
+        self.scrolls = 0
+
+    def _page(self, slice_id, max_slices, time_min, offset):
+        doc_ids = [ x for x in range(NUM_DOCS)
+                    if x % max_slices == slice_id and make_hit(x)['sort'][0] >= time_min ]
+        return {
+            '_scroll_id': "%d:%d:%d:%d" % (slice_id, max_slices, time_min, offset + PAGE_SIZE),
+            'hits': {
+                'total': len(doc_ids),
+                'hits': [ make_hit(x) for x in doc_ids[offset:offset + PAGE_SIZE] ],
+            },
+        }
+
+    def search(self, index=None, body=None, scroll=None, size=None, sort=None, _source=None):
+        query_slice = body.get('slice', { 'id': 0, 'max': 1 })
+        time_range = body.get('query', {}).get('bool', {}).get('filter', {}).get('range', {})
+        time_min = int(time_range.get('@timestamp', {}).get('gte', 0)) * 1000
+        return self._page(query_slice['id'], query_slice['max'], time_min, 0)
+
+    def scroll(self, scroll_id=None, scroll=None):
+        self.scrolls += 1
+        if self.scrolls == self.fail_after:
+            raise ScrollError("scroll id %s expired" % scroll_id)
+        slice_id, max_slices, time_min, offset = [ int(x) for x in scroll_id.split(':') ]
+        return self._page(slice_id, max_slices, time_min, offset)
+
+_FAKE_ELASTICSEARCH = types.ModuleType("elasticsearch")
+_FAKE_ELASTICSEARCH.Elasticsearch = FakeElasticsearch
+_FAKE_ELASTICSEARCH.helpers = types.ModuleType("elasticsearch.helpers")
+sys.modules.setdefault("elasticsearch", _FAKE_ELASTICSEARCH)
+sys.modules.setdefault("elasticsearch.helpers", _FAKE_ELASTICSEARCH.helpers)
+
+import bb_dump_es
+
+_BUNDLE_REX = re.compile(r'^cori-collectd\.s(\d\d)\.(\d{8})\.json\.gz$')
+
+class TestSlicedDump(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.max_doc_bundle = bb_dump_es.MAX_DOC_BUNDLE
+        bb_dump_es.MAX_DOC_BUNDLE = 250
+
+    def tearDown(self):
+        bb_dump_es.MAX_DOC_BUNDLE = self.max_doc_bundle
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_sliced_dump(self):
+        max_slices = 4
+        total = bb_dump_es.query_and_page_sliced("localhost", 9200, { 'query': {} }, max_slices)
+        self.assertEqual(total, NUM_DOCS)
+
+        doc_ids = []
+        bundles = {}
+        for filename in sorted(os.listdir('.')):
+            if filename.endswith('.manifest'):
+                continue
+            match = _BUNDLE_REX.match(filename)
+            self.assertTrue(match, "unexpected output file %s" % filename)
+            slice_id, num_bundle = int(match.group(1)), int(match.group(2))
+            bundles.setdefault(slice_id, []).append(num_bundle)
+            with gzip.open(filename, 'r') as fp:
+                bundle = json.load(fp)
+            self.assertTrue(0 < len(bundle) <= bb_dump_es.MAX_DOC_BUNDLE)
+            for hit in bundle:
+                doc_id = int(hit['_id'][3:])
+                self.assertEqual(doc_id % max_slices, slice_id,
+                                 "%s holds %s of another slice" % (filename, hit['_id']))
+                doc_ids.append(doc_id)
+
+        ### every document was written exactly once
+        self.assertEqual(len(doc_ids), NUM_DOCS)
+        self.assertEqual(sorted(doc_ids), list(range(NUM_DOCS)))
+
+        ### each slice wrote its own contiguously numbered bundles and manifest
+        self.assertEqual(sorted(bundles.keys()), list(range(max_slices)))
+        for slice_id, nums in bundles.items():
+            self.assertEqual(nums, list(range(len(nums))))
+            with open(bb_dump_es.manifest_name(slice_id), 'r') as fp:
+                records = [ json.loads(line) for line in fp ]
+            self.assertEqual(sorted([ x['file'] for x in records ]),
+                             [ bb_dump_es.bundle_name(x, slice_id) for x in nums ])
+            self.assertEqual(sum([ x['count'] for x in records ]),
+                             len([ x for x in range(NUM_DOCS) if x % max_slices == slice_id ]))
+
+    def test_manifest_files(self):
+        for fmt in 'pickle', 'npy', 'json':
+            bb_dump_es.query_and_page(FakeElasticsearch(), { 'query': {} },
+                                      serialize_bundle=bb_dump_es.SERIALIZERS[fmt])
+            with open(bb_dump_es.manifest_name(), 'r') as fp:
+                records = [ json.loads(line) for line in fp ]
+            self.assertEqual(sum([ x['count'] for x in records ]), NUM_DOCS)
+            for record in records:
+                self.assertTrue(os.path.exists(record['file']),
+                                "%s manifest lists missing %s" % (fmt, record['file']))
+
+    def test_scroll_error_keeps_queued_bundles(self):
+        def serialize_slowly(bundle, output_file):
+            time.sleep(0.2)
+            return bb_dump_es.serialize_bundle_json(bundle, output_file)
+        ### pages of 100 documents make bundles of 200, so three bundles are
+        ### queued by the time the seventh scroll fails
+        esdb = FakeElasticsearch(fail_after=7)
+        self.assertRaises(ScrollError, bb_dump_es.query_and_page, esdb, { 'query': {} },
+                          serialize_bundle=serialize_slowly, writers=2, queue_depth=2)
+        with open(bb_dump_es.manifest_name(), 'r') as fp:
+            records = [ json.loads(line) for line in fp ]
+        self.assertEqual(sorted([ x['bundle'] for x in records ]), [ 0, 1, 2 ])
+        for record in records:
+            self.assertTrue(os.path.exists(record['file']))
+
+    def test_resume(self):
+        query = { 'query': {} }
+        ### first run dies after writing bundles 0-2 of 200 documents each
+        self.assertRaises(ScrollError, bb_dump_es.query_and_page,
+                          FakeElasticsearch(fail_after=7), query)
+
+        ### pretend that bundle 1 never finished while bundle 2 did
+        manifest_file = bb_dump_es.manifest_name()
+        with open(manifest_file, 'r') as fp:
+            lines = [ line for line in fp if json.loads(line)['bundle'] != 1 ]
+        with open(manifest_file, 'w') as fp:
+            fp.writelines(lines)
+
+        ### second run resumes after bundle 0 with smaller bundles and dies
+        ### again; the stale record of bundle 2 must not be picked up next
+        bb_dump_es.MAX_DOC_BUNDLE = 150
+        self.assertRaises(ScrollError, bb_dump_es.query_and_page,
+                          FakeElasticsearch(fail_after=2), query, resume=True)
+
+        ### third run finishes
+        bb_dump_es.query_and_page(FakeElasticsearch(), query, resume=True)
+
+        with open(manifest_file, 'r') as fp:
+            records = [ json.loads(line) for line in fp ]
+        self.assertEqual(sorted([ x['bundle'] for x in records ]), list(range(len(records))))
+        doc_ids = []
+        for record in records:
+            with gzip.open(record['file'], 'r') as fp:
+                doc_ids += [ int(hit['_id'][3:]) for hit in json.load(fp) ]
+        self.assertEqual(sorted(doc_ids), list(range(NUM_DOCS)))
+
+class TestBundleWriter(unittest.TestCase):
+    def test_write_aborts_after_error(self):
+        def serialize_bundle(bundle, output_file):
+            if output_file == 'bad':
+                raise IOError("disk full")
+        writer = bb_dump_es.BundleWriter(serialize_bundle, writers=2, queue_depth=2)
+        writer.write([], 'bad')
+        ### wait for a writer thread to hit the error
+        for _ in range(500):
+            if writer.error is not None:
+                break
+            time.sleep(0.01)
+        self.assertRaises(IOError, writer.write, [], 'good')
+        self.assertRaises(IOError, writer.close)
+
+if __name__ == '__main__':
+    unittest.main()
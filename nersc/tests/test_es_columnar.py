@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Check timestamp parsing and rewriting of columnar bundles in es_columnar.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import es_columnar
+
+### 2017-01-01 00:00:00 UTC in epoch milliseconds
+_TIME_MS = 1483228800000
+
+class TestParseTimestamps(unittest.TestCase):
+    def test_utc_offsets(self):
+        values = [
+            '2017-01-01T00:00:00Z',
+            '2017-01-01T00:00:00.000+00:00',
+            '2017-01-01T01:00:00+01:00',
+            '2016-12-31T17:00:00-0700',
+            '2017-01-01T00:00:00',
+            '2017-01-01',
+        ]
+        self.assertEqual(list(es_columnar.parse_timestamps(values)), [ _TIME_MS ] * len(values))
+
+    def test_epoch(self):
+        self.assertEqual(list(es_columnar.parse_timestamps([ _TIME_MS // 1000 ])), [ _TIME_MS ])
+        self.assertEqual(list(es_columnar.parse_timestamps([ _TIME_MS ])), [ _TIME_MS ])
+
+class TestSaveBundle(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rewrite_npy(self):
+        path = os.path.join(self.tmpdir, 'bundle.cols')
+        fields = [ '@timestamp', 'hostname', 'value' ]
+        bundle = [ { '_source': { '@timestamp': _TIME_MS + x, 'hostname': 'bb%02d' % x, 'value': x } }
+                   for x in range(4) ]
+        es_columnar.save_bundle_npy(bundle, path, fields)
+
+        ### a rewrite that dies partway through must not leave the old
+        ### metadata describing the new columns
+        def fail(*args, **kwargs):
+            raise IOError("disk full")
+        save = es_columnar.numpy.save
+        es_columnar.numpy.save = fail
+        try:
+            self.assertRaises(IOError, es_columnar.save_bundle_npy, bundle[:2], path, fields)
+        finally:
+            es_columnar.numpy.save = save
+        self.assertFalse(os.path.exists(os.path.join(path, 'meta.json')))
+
+        es_columnar.save_bundle_npy(bundle[:2], path, fields)
+        columns, categories = es_columnar.load_bundle(path)
+        self.assertEqual(es_columnar.load_metadata(path)['count'], 2)
+        self.assertEqual(list(columns['timestamp']), [ _TIME_MS, _TIME_MS + 1 ])
+        self.assertEqual(categories['hostname'], [ 'bb00', 'bb01' ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Check that the SQLite cache of get_darshan_coverage_altd.py gives the same
+coverage as the month-by-month MySQL queries, no matter how the cache was
+filled.  MySQL is stood in for by an in-memory SQLite database that is
+populated with synthetic ALTD and jobs records.
+"""
+
+import os
+import sys
+import types
+import sqlite3
+import calendar
+import datetime
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+class FakeCursor(object):
+    """
+    Just enough of a MySQLdb cursor on top of a sqlite3 connection
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, query_str):
+        self.rows = self.conn.execute(query_str).fetchall()
+        return len(self.rows)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+class FakeConnection(object):
+    """
+    A MySQL database stood in for by SQLite, with the MySQL functions that the
+    queries use
+    """
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.create_function("UNIX_TIMESTAMP", 1,
+            lambda x: calendar.timegm(datetime.datetime.strptime(x, "%Y-%m-%d %H:%M:%S").timetuple()))
+        self.conn.create_function("FROM_UNIXTIME", 1,
+            lambda x: datetime.datetime.utcfromtimestamp(x).strftime("%Y-%m-%d %H:%M:%S"))
+        self.conn.create_function("concat", -1, lambda *args: "".join([ str(x) for x in args ]))
+        self.conn.executescript("""
+            CREATE TABLE summary (stepid TEXT, hostname TEXT, completion INTEGER, numnodes INTEGER, wallclock INTEGER);
+            CREATE TABLE altd_edison_jobs (job_launch_id INTEGER, tag_id INTEGER, run_date TEXT);
+            CREATE TABLE altd_edison_link_tags (tag_id INTEGER, linkline_id INTEGER);
+            CREATE TABLE altd_edison_linkline (linking_inc INTEGER, linkline TEXT);
+        """)
+
+    def cursor(self, cursorclass=None):
+        return FakeCursor(self.conn)
+
+    def close(self):
+        pass
+
+_FAKE_MYSQLDB = types.ModuleType("MySQLdb")
+_FAKE_MYSQLDB.cursors = types.ModuleType("MySQLdb.cursors")
+_FAKE_MYSQLDB.cursors.SSCursor = object
+sys.modules.setdefault("MySQLdb", _FAKE_MYSQLDB)
+sys.modules.setdefault("MySQLdb.cursors", _FAKE_MYSQLDB.cursors)
+
+import get_darshan_coverage_altd as coverage
+
+_LINKLINES = [
+    (1, "-lmpich -ldarshan"),
+    (2, "-lmpich"),
+    (3, "-ldarshan"),
+    (4, "-lm"),
+]
+
+def fill_database(db, date_start, date_stop):
+    """
+    Insert a few jobs per day.  Each job is launched and completes on the same
+    day so that the month-by-month queries and the cache agree exactly.
+    Every tenth job is only in ALTD and every seventh job is only in the jobs
+    database.
+    """
+    jobid = 1000
+    tag_id = 0
+    day = date_start
+    while day < date_stop:
+        for hour in range(0, 24, 7):
+            jobid += 1
+            run_date = datetime.datetime(day.year, day.month, day.day, hour, 5)
+            if jobid % 7 != 0:
+                for linkline_id in set([ 1 + jobid % 4, 1 + jobid // 3 % 4 ]):
+                    tag_id += 1
+                    db.conn.execute("INSERT INTO altd_edison_jobs VALUES (?, ?, ?)",
+                                    (jobid, tag_id, run_date.strftime("%Y-%m-%d %H:%M:%S")))
+                    db.conn.execute("INSERT INTO altd_edison_link_tags VALUES (?, ?)",
+                                    (tag_id, linkline_id))
+            if jobid % 10 != 0:
+                completion = calendar.timegm(run_date.timetuple()) + 1800
+                db.conn.execute("INSERT INTO summary VALUES (?, 'edison', ?, ?, ?)",
+                                ("%d.edique02" % jobid, completion, 1 + jobid % 5, 60 * (jobid % 90)))
+        day += datetime.timedelta(days=1)
+    db.conn.executemany("INSERT INTO altd_edison_linkline VALUES (?, ?)", _LINKLINES)
+
+def per_month_tallies(db, date_start, date_stop):
+    """
+    Run the month-by-month MySQL queries and return one dict per month keyed
+    by coverage field
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        coverage.analysis_custom_db(date_start, date_stop, db.cursor())
+        lines = sys.stdout.getvalue().splitlines()
+    finally:
+        sys.stdout = stdout
+    tallies = []
+    for line in lines[1:]:
+        tallies.append(dict(zip(coverage._COVERAGE_FIELDS, line.split(','))))
+    return tallies
+
+def cache_tallies(cache, date_start, date_stop):
+    return coverage.tally_coverage(coverage.query_cache(cache, date_start, date_stop),
+                                   coverage.month_starts(date_start, date_stop))
+
+class TestCacheCoverage(unittest.TestCase):
+    def setUp(self):
+        self.date_start = datetime.date(2016, 6, 1)
+        self.date_stop = datetime.date(2017, 1, 1)
+        self.db = FakeConnection()
+        fill_database(self.db, self.date_start, self.date_stop)
+        self.cache = coverage.open_cache(":memory:")
+
+    def tearDown(self):
+        self.cache.close()
+
+    def assertMatchesPerMonth(self):
+        expected = per_month_tallies(self.db, self.date_start, self.date_stop)
+        actual = cache_tallies(self.cache, self.date_start, self.date_stop)
+        self.assertEqual(len(expected), len(actual))
+        for want, got in zip(expected, actual):
+            self.assertEqual(want['start'], got['start'])
+            self.assertTrue(got['total jobs'] > 0)
+            for field in coverage._COVERAGE_FIELDS[1:]:
+                value = 0.0 if want[field] == 'None' else float(want[field])
+                self.assertAlmostEqual(value, got[field], places=6,
+                                       msg="%s %s: %s != %s" % (want['start'], field, value, got[field]))
+
+    def refresh(self, date_start, date_stop):
+        coverage.refresh_cache(self.cache, self.db, date_start, date_stop,
+                               today=datetime.date(2026, 1, 1))
+
+    def test_single_refresh(self):
+        self.refresh(self.date_start, self.date_stop)
+        self.assertMatchesPerMonth()
+
+    def test_gap(self):
+        self.refresh(datetime.date(2016, 6, 1), datetime.date(2016, 9, 1))
+        self.refresh(datetime.date(2016, 10, 1), datetime.date(2017, 1, 1))
+        for table in 'altd_jobs', 'jobs':
+            self.assertEqual(coverage.cache_gaps(self.cache, table, self.date_start, self.date_stop),
+                             [(datetime.date(2016, 9, 1), datetime.date(2016, 10, 1))])
+        self.refresh(self.date_start, self.date_stop)
+        for table in 'altd_jobs', 'jobs':
+            self.assertEqual(coverage.cache_gaps(self.cache, table, self.date_start, self.date_stop), [])
+        self.assertMatchesPerMonth()
+
+    def test_backfill(self):
+        self.refresh(datetime.date(2016, 9, 15), self.date_stop)
+        self.refresh(self.date_start, self.date_stop)
+        self.assertEqual(coverage.cached_intervals(self.cache, 'jobs'),
+                         [(self.date_start, self.date_stop)])
+        self.assertMatchesPerMonth()
+
+    def test_overlapping_refreshes(self):
+        self.refresh(datetime.date(2016, 7, 1), datetime.date(2016, 11, 1))
+        self.refresh(datetime.date(2016, 6, 1), datetime.date(2016, 8, 1))
+        self.refresh(datetime.date(2016, 10, 1), self.date_stop)
+        self.assertMatchesPerMonth()
+
+    def test_today_is_refetched(self):
+        today = datetime.date(2016, 12, 15)
+        coverage.refresh_cache(self.cache, self.db, self.date_start, self.date_stop, today=today)
+        self.assertEqual(coverage.cache_gaps(self.cache, 'jobs', self.date_start, self.date_stop),
+                         [(today, self.date_stop)])
+        ### a job that completes later in the day is picked up by the next run
+        self.db.conn.execute("INSERT INTO summary VALUES ('99999.edique02', 'edison', ?, 1, 3600)",
+                             (calendar.timegm(datetime.datetime(2016, 12, 15, 23).timetuple()),))
+        coverage.refresh_cache(self.cache, self.db, self.date_start, self.date_stop,
+                               today=datetime.date(2026, 1, 1))
+        self.assertMatchesPerMonth()
+
+if __name__ == '__main__':
+    unittest.main()